@@ -1,16 +1,141 @@
 # app.py — Dual workflow: 1360×768 (work) + 1920×1080 (report)
-import io, time, datetime, os, uuid, json
+import io, time, datetime, os, uuid, json, hashlib, atexit, threading, tempfile, resource, signal, shutil
 from pathlib import Path
 import sys
 from typing import List, Dict
-from threading import Thread
+from threading import Lock
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 # --- HELPERS: BACKGROUND ---
-def run_in_bg(task, *args):
-    Thread(target=task, args=args).start()
+# Dos pools acotats substitueixen els fils solts: E/S (pujades a GCS, Firestore) i CPU (imatges, DOCX, IA).
+# Cada pool admet com a molt workers + cua tasques; quan és ple, qui envia espera (backpressure)
+# i, si passa el temps d'espera, executa la tasca ell mateix: mai es perd una pujada.
+# Les tasques llargues que demana l'usuari (IA, informes) fan servir try_submit: si no hi ha lloc, 503.
+# En aturar el procés (SIGTERM de Cloud Run / atexit) es buiden les cues abans de sortir.
+class BoundedExecutor:
+    def __init__(self, name, workers, max_queue, submit_timeout):
+        self.name = name
+        self.workers = max(1, workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"bg-{name}")
+        self.slots = threading.BoundedSemaphore(self.workers + max(0, max_queue))
+        self.max_queue = max(0, max_queue)
+        self.submit_timeout = submit_timeout
+        self.lock = Lock()
+        self.inflight = set()
+        self.closed = False
+        self.metrics = {'submitted': 0, 'completed': 0, 'failed': 0, 'ran_inline': 0,
+                        'rejected': 0, 'waited': 0, 'wait_s': 0.0, 'max_pending': 0}
+
+    def _run(self, task, args):
+        try:
+            return task(*args)
+        except Exception as e:
+            with self.lock: self.metrics['failed'] += 1
+            print(f"ERROR BG[{self.name}] {getattr(task, '__name__', task)}: {e}")
+            raise
+        finally:
+            with self.lock: self.metrics['completed'] += 1
+
+    def _acquire(self, timeout):
+        started = time.perf_counter()
+        acquired = not self.closed and self.slots.acquire(timeout=timeout)
+        waited = time.perf_counter() - started
+        with self.lock:
+            self.metrics['submitted'] += 1
+            if waited > 0.001: self.metrics['waited'] += 1; self.metrics['wait_s'] += waited
+        return acquired
+
+    def _enqueue(self, task, args):
+        try:
+            fut = self.pool.submit(self._run, task, args)
+        except RuntimeError:  # pool aturat entre la comprovació i l'enviament
+            self.slots.release()
+            return None
+        with self.lock:
+            self.inflight.add(fut)
+            self.metrics['max_pending'] = max(self.metrics['max_pending'], len(self.inflight))
+        fut.add_done_callback(self._done)
+        return fut
+
+    def submit(self, task, *args):
+        fut = self._enqueue(task, args) if self._acquire(self.submit_timeout) else None
+        if fut is None:
+            # Pool ple o aturant-se: la feina es fa al fil de qui l'envia
+            with self.lock: self.metrics['ran_inline'] += 1
+            print(f"ADVERTÈNCIA: BG[{self.name}] ple o tancat, execució directa de {getattr(task, '__name__', task)}")
+            return self._inline(task, args)
+        return fut
+
+    def try_submit(self, task, *args):
+        """Com submit, però sense esperar ni executar al fil de qui envia: retorna None si no hi ha lloc."""
+        fut = self._enqueue(task, args) if self._acquire(0) else None
+        if fut is None:
+            with self.lock: self.metrics['rejected'] += 1
+            print(f"ADVERTÈNCIA: BG[{self.name}] ple o tancat, rebutjada {getattr(task, '__name__', task)}")
+        return fut
+
+    def _inline(self, task, args):
+        fut = Future()
+        try: fut.set_result(self._run(task, args))
+        except Exception as e: fut.set_exception(e)
+        return fut
+
+    def _done(self, fut):
+        with self.lock: self.inflight.discard(fut)
+        self.slots.release()
+
+    def drain(self, timeout):
+        """Deixa d'acceptar feina nova i espera les tasques pendents fins a timeout segons."""
+        self.closed = True
+        with self.lock: pending = set(self.inflight)
+        done, not_done = wait(pending, timeout=timeout)
+        if not_done: print(f"ADVERTÈNCIA: BG[{self.name}] {len(not_done)} tasques sense acabar en aturar")
+        self.pool.shutdown(wait=False)
+        return len(not_done)
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.inflight)
+            return dict(self.metrics, wait_s=round(self.metrics['wait_s'], 3), pending=pending,
+                        running=min(pending, self.workers), queued=max(0, pending - self.workers),
+                        workers=self.workers, max_queue=self.max_queue, closed=self.closed)
+
+BG_SUBMIT_TIMEOUT = float(os.environ.get("BG_SUBMIT_TIMEOUT", "30"))
+BG_RETRY_AFTER = int(os.environ.get("BG_RETRY_AFTER", "5"))  # segons suggerits al client quan un pool és ple
+BG_DRAIN_TIMEOUT = float(os.environ.get("BG_DRAIN_TIMEOUT", "8"))  # Cloud Run dona 10 s després del SIGTERM
+BG_IO = BoundedExecutor("io", int(os.environ.get("BG_IO_WORKERS", "4")),
+                        int(os.environ.get("BG_IO_QUEUE", "64")), BG_SUBMIT_TIMEOUT)
+BG_CPU = BoundedExecutor("cpu", int(os.environ.get("BG_CPU_WORKERS", "2")),
+                         int(os.environ.get("BG_CPU_QUEUE", "16")), BG_SUBMIT_TIMEOUT)
+# Les crides a la IA passen la major part del temps esperant la xarxa: pool propi perquè no bloquegin els informes
+BG_AI = BoundedExecutor("ai", int(os.environ.get("BG_AI_WORKERS", "4")),
+                        int(os.environ.get("BG_AI_QUEUE", "16")), BG_SUBMIT_TIMEOUT)
+BG_EXECUTORS = (BG_AI, BG_CPU, BG_IO)  # IA i CPU primer: les seves tasques encara poden encuar pujades
+
+def drain_background(timeout=None):
+    deadline = time.monotonic() + (BG_DRAIN_TIMEOUT if timeout is None else timeout)
+    for ex in BG_EXECUTORS:
+        if not ex.closed: ex.drain(max(0.0, deadline - time.monotonic()))
+    # Les tasques acabades poden haver deixat sessions per pujar: no esperem a l'atexit (pot ser massa tard)
+    SESSION_STORE.flush()
+
+def install_drain_on_sigterm():
+    """Encadena el drenatge al gestor de SIGTERM existent (gunicorn o el per defecte)."""
+    if threading.current_thread() is not threading.main_thread(): return
+    previous = signal.getsignal(signal.SIGTERM)
+    def handler(signum, frame):
+        print("DEBUG: SIGTERM - buidant cues de fons")
+        drain_background()
+        if callable(previous): previous(signum, frame)
+        elif previous == signal.SIG_DFL: raise SystemExit(0)
+    signal.signal(signal.SIGTERM, handler)
+
+atexit.register(drain_background)
+install_drain_on_sigterm()
 
 # Flask & Firebase
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, make_response, session, send_file
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, send_from_directory, jsonify, make_response, session, send_file
 try:
     import firebase_admin
     from firebase_admin import credentials, firestore, storage
@@ -23,6 +148,11 @@ from werkzeug.utils import secure_filename
 
 # Image & Docx
 from PIL import Image, UnidentifiedImageError
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
+    print("WARNING: Pillow sense LittleCMS: els perfils de color es conserven sense convertir a sRGB")
 from docx import Document
 from docx.shared import Inches, Pt, Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH as Align
@@ -30,6 +160,11 @@ from docx.enum.table import WD_TABLE_ALIGNMENT, WD_ALIGN_VERTICAL
 from docx.enum.section import WD_SECTION_START
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI, CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.part import Part
+from docx.opc.pkgwriter import _ContentTypesItem
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
 # Vertex AI & Google AI
 try:
@@ -65,9 +200,12 @@ WORK_DIR    = UPLOAD_DIR / "work"
 EDITED_DIR  = UPLOAD_DIR / "edited"
 SESSIONS_DIR = UPLOAD_DIR / "sessions"
 REPORTS_DIR = UPLOAD_DIR / "reports"
+RENDITIONS_DIR = UPLOAD_DIR / "renditions"
+THUMBS_DIR  = UPLOAD_DIR / "thumbs"
+CAPTIONS_DIR = UPLOAD_DIR / "captions"
 STATIC_DIR  = BASE_DIR / "static"
 
-for d in (UPLOAD_DIR, MASTER_DIR, WORK_DIR, EDITED_DIR, SESSIONS_DIR, REPORTS_DIR):
+for d in (UPLOAD_DIR, MASTER_DIR, WORK_DIR, EDITED_DIR, SESSIONS_DIR, REPORTS_DIR, RENDITIONS_DIR, THUMBS_DIR, CAPTIONS_DIR):
     d.mkdir(parents=True, exist_ok=True)
 
 # --- FIREBASE INIT ---
@@ -81,33 +219,268 @@ if firebase_admin and not firebase_admin._apps:
 
 db = firestore.client(database_id='infofotovector') if (firestore and firebase_admin and firebase_admin._apps) else None
 
+# --- HELPERS: STORAGE ---
+# Un sol client GCS per procés (amb pool de connexions HTTP configurable) i un sol handle de bucket.
+# Les baixades van directes i un 404 és un "miss": no fem HEAD (blob.exists) abans de cada baixada.
+GCS_HTTP_POOL_SIZE = int(os.environ.get("GCS_HTTP_POOL_SIZE", "32"))
+GCS_TIMEOUT = float(os.environ.get("GCS_TIMEOUT", "60"))
+# Informes: pujada resumable per blocs (múltiple de 256 KiB) perquè un tall no obligui a repetir-la sencera
+REPORT_UPLOAD_CHUNK_BYTES = int(os.environ.get("REPORT_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024
+STORAGE_METRICS = {'requests': 0, 'errors': 0, 'misses': 0, 'bytes_up': 0, 'bytes_down': 0, 'latency_s': 0.0}
+_storage_lock = Lock()
+_bucket = None
+
+try:
+    from google.api_core.exceptions import Conflict, FailedPrecondition, NotFound, PreconditionFailed
+except ImportError:
+    Conflict = FailedPrecondition = NotFound = PreconditionFailed = None
+
+def _make_pooled_bucket():
+    """Client google-cloud-storage amb credencials de Firebase i un HTTPAdapter de GCS_HTTP_POOL_SIZE connexions."""
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage as gcs
+    credentials = firebase_admin.get_app().credential.get_credential()
+    http = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+    http.mount("https://", adapter)
+    client = gcs.Client(project=os.environ.get('PROJECT_ID', 'infofoto-vector-art'), credentials=credentials, _http=http)
+    return client.bucket(BUCKET_NAME)
+
 def get_bucket():
+    global _bucket
+    if _bucket is not None: return _bucket
     if not (storage and firebase_admin and firebase_admin._apps): return None
-    try: return storage.bucket(name=BUCKET_NAME)
-    except: return None
+    with _storage_lock:
+        if _bucket is None:
+            try: _bucket = _make_pooled_bucket()
+            except Exception as e:
+                print(f"ADVERTÈNCIA: STORAGE - Client amb pool no disponible ({e}); uso el de Firebase")
+                try: _bucket = storage.bucket(name=BUCKET_NAME)
+                except: return None
+    return _bucket
+
+def record_storage_request(started, bytes_up=0, bytes_down=0, error=False, miss=False):
+    with _storage_lock:
+        STORAGE_METRICS['requests'] += 1
+        STORAGE_METRICS['latency_s'] += time.perf_counter() - started
+        STORAGE_METRICS['bytes_up'] += bytes_up
+        STORAGE_METRICS['bytes_down'] += bytes_down
+        if error: STORAGE_METRICS['errors'] += 1
+        if miss: STORAGE_METRICS['misses'] += 1
+
+def storage_stats():
+    with _storage_lock:
+        stats = dict(STORAGE_METRICS)
+    stats['avg_latency_ms'] = round(stats['latency_s'] * 1000 / stats['requests'], 1) if stats['requests'] else 0.0
+    stats['latency_s'] = round(stats['latency_s'], 3)
+    return stats
+
+# --- HELPERS: CACHE LOCAL D'OBJECTES GCS ---
+# A Cloud Run /tmp és RAM: les fotos baixades o pujades a MASTER/WORK/EDITED/THUMBS i els informes
+# generats queden sota un pressupost de bytes amb expulsió LRU. Només s'expulsa el que ja és a GCS
+# (mai en mode local) i mai un fitxer fixat (p. ex. per un informe en curs o una pujada pendent).
+LOCAL_CACHE_BYTES = int(os.environ.get("LOCAL_CACHE_BYTES", str(192 * 1024 * 1024)))
+
+class LocalObjectCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.index = None  # path -> [mida, darrer_accés]
+        self.pins = {}     # path -> comptador
+        self.hits = self.misses = self.evictions = self.evicted_bytes = 0
+
+    def managed_dirs(self):
+        return (MASTER_DIR, WORK_DIR, EDITED_DIR, THUMBS_DIR, REPORTS_DIR)
+
+    def _ensure_index(self):
+        if self.index is not None: return
+        self.index = {}
+        for d in self.managed_dirs():
+            for p in d.glob("*"):
+                if p.is_file() and not p.name.startswith("."):
+                    st = p.stat(); self.index[str(p)] = [st.st_size, st.st_mtime]
+
+    def hit(self, path: Path):
+        with self.lock:
+            self.hits += 1
+            self._ensure_index()
+            entry = self.index.get(str(path))
+            if entry: entry[1] = time.time()
+            else:
+                try: self.index[str(path)] = [path.stat().st_size, time.time()]
+                except FileNotFoundError: pass
+
+    def admit(self, path: Path, miss=True):
+        """Registra un fitxer nou (baixat o escrit) i expulsa el que sobri."""
+        try: size = path.stat().st_size
+        except FileNotFoundError: return
+        with self.lock:
+            if miss: self.misses += 1
+            self._ensure_index()
+            self.index[str(path)] = [size, time.time()]
+        self.evict()
+
+    def pin(self, paths):
+        with self.lock:
+            for p in paths: self.pins[str(p)] = self.pins.get(str(p), 0) + 1
+
+    def unpin(self, paths):
+        with self.lock:
+            for p in paths:
+                n = self.pins.get(str(p), 0) - 1
+                if n > 0: self.pins[str(p)] = n
+                else: self.pins.pop(str(p), None)
+
+    @contextmanager
+    def pinned(self, paths):
+        paths = list(paths)
+        self.pin(paths)
+        try: yield
+        finally: self.unpin(paths)
+
+    def evict(self):
+        if not IS_PROD: return  # en local no hi ha còpia a GCS: no s'esborra res
+        with self.lock:
+            self._ensure_index()
+            total = sum(e[0] for e in self.index.values())
+            if total <= self.max_bytes: return
+            for path, (size, _) in sorted(self.index.items(), key=lambda kv: kv[1][1]):
+                if total <= self.max_bytes: break
+                if path in self.pins: continue
+                try: Path(path).unlink(missing_ok=True)
+                except Exception: continue
+                del self.index[path]
+                total -= size; self.evictions += 1; self.evicted_bytes += size
+
+    def forget(self, path: Path):
+        """El fitxer s'ha esborrat: deixa de comptar i de tenir fixacions."""
+        with self.lock:
+            if self.index is not None: self.index.pop(str(path), None)
+            self.pins.pop(str(path), None)
+
+    def stats(self):
+        with self.lock:
+            self._ensure_index()
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'evicted_bytes': self.evicted_bytes, 'bytes': sum(e[0] for e in self.index.values()),
+                    'files': len(self.index), 'pinned': len(self.pins), 'max_bytes': self.max_bytes}
+
+LOCAL_CACHE = LocalObjectCache(LOCAL_CACHE_BYTES)
+
+def storage_save_pinned(local_path: Path, storage_rel_path: str):
+    """Puja un fitxer que s'ha fixat abans de programar la pujada; només el desfixa si ha arribat a GCS."""
+    if storage_save(local_path, storage_rel_path): LOCAL_CACHE.unpin([local_path])
+    elif IS_PROD: print(f"ADVERTÈNCIA: {local_path.name} no és a GCS: es manté fixat a la cache local")
+
+def storage_save_or_pin(local_path: Path, storage_rel_path: str):
+    """Pujada síncrona; si falla, el fitxer local és l'única còpia i queda fixat (no s'expulsa)."""
+    if storage_save(local_path, storage_rel_path): return True
+    if IS_PROD:
+        LOCAL_CACHE.pin([local_path])
+        print(f"ADVERTÈNCIA: {local_path.name} no és a GCS: es manté fixat a la cache local")
+    return False
 
-# --- HELPERS: STORAGE ---
-def storage_save(local_path: Path, storage_rel_path: str):
-    if not IS_PROD: return
+def storage_save(local_path: Path, storage_rel_path: str, chunk_size=None):
+    """Puja un fitxer des del disc. Amb chunk_size la pujada és resumable (per blocs). Retorna si s'ha desat."""
+    if not IS_PROD: return False
     bucket = get_bucket()
     if bucket:
+        started = time.perf_counter()
         try:
-            blob = bucket.blob(storage_rel_path)
-            blob.upload_from_filename(str(local_path))
-        except Exception as e: print(f"Error upload {storage_rel_path}: {e}")
+            blob = bucket.blob(storage_rel_path, chunk_size=chunk_size) if chunk_size else bucket.blob(storage_rel_path)
+            blob.upload_from_filename(str(local_path), timeout=GCS_TIMEOUT)
+            record_storage_request(started, bytes_up=local_path.stat().st_size)
+            return True
+        except Exception as e:
+            record_storage_request(started, error=True)
+            print(f"Error upload {storage_rel_path}: {e}")
+    return False
 
-def storage_download(storage_rel_path: str, local_path: Path):
+def storage_download(storage_rel_path: str, local_path: Path, timeout=None):
     if not IS_PROD: return False
     bucket = get_bucket()
     if bucket:
+        # Baixada a un fitxer temporal + os.replace: mai deixem un fitxer a mitges al seu lloc definitiu
+        tmp_path = local_path.with_name(f".{local_path.name}.{uuid.uuid4().hex[:8]}.part")
+        started = time.perf_counter()
         try:
             blob = bucket.blob(storage_rel_path)
-            if blob.exists():
-                blob.download_to_filename(str(local_path))
-                return True
-        except: pass
+            blob.download_to_filename(str(tmp_path), timeout=timeout or GCS_TIMEOUT)
+            os.replace(tmp_path, local_path)
+            record_storage_request(started, bytes_down=local_path.stat().st_size)
+            LOCAL_CACHE.admit(local_path)
+            return True
+        except Exception as e:
+            is_miss = NotFound is not None and isinstance(e, NotFound)
+            record_storage_request(started, error=not is_miss, miss=is_miss)
+        finally:
+            try: tmp_path.unlink(missing_ok=True)
+            except Exception: pass
     return False
 
+# Cerca en bloc: per a cada nom, la primera capa (prefix GCS + carpeta local) on existeix, per ordre
+# de prioritat. Les consultes remotes (stat) i les baixades de les variants guanyadores van en paral·lel.
+GCS_FETCH_WORKERS = int(os.environ.get("GCS_FETCH_WORKERS", "16"))
+STORAGE_FETCH_POOL = ThreadPoolExecutor(max_workers=max(1, GCS_FETCH_WORKERS), thread_name_prefix="gcs-fetch")
+
+def storage_exists(storage_rel_path: str, timeout=None):
+    bucket = get_bucket() if IS_PROD else None
+    if not bucket: return False
+    started = time.perf_counter()
+    try:
+        blob = bucket.get_blob(storage_rel_path, timeout=timeout or GCS_TIMEOUT)
+        record_storage_request(started, miss=blob is None)
+        return blob is not None
+    except Exception:
+        record_storage_request(started, error=True)
+        return False
+
+def storage_fetch_many(names, tiers, timeout=None, pin=False):
+    """
+    tiers: [(prefix_gcs, carpeta_local)] de més a menys prioritari.
+    Retorna {nom: path_local} amb la millor variant de cada nom (els noms que no existeixen no hi són).
+    Amb pin=True els fitxers retornats queden fixats a LOCAL_CACHE (el caller els ha de desfixar).
+    """
+    names = list(dict.fromkeys(names))
+    remote = bool(IS_PROD and get_bucket())
+    # 1. Candidats: capes fins a la primera que ja tenim en local (les de davant s'han de consultar a GCS)
+    candidates, to_stat = {}, []
+    for name in names:
+        cands = []
+        for prefix, local_dir in tiers:
+            local_path = local_dir / name
+            if local_path.exists():
+                cands.append((prefix, local_path, True)); break
+            if remote:
+                cands.append((prefix, local_path, False)); to_stat.append(f"{prefix}/{name}")
+        candidates[name] = cands
+
+    exists = dict(zip(to_stat, STORAGE_FETCH_POOL.map(lambda rel: storage_exists(rel, timeout), to_stat)))
+
+    # 2. Guanyador per nom; baixada en paral·lel de les variants remotes
+    result, downloads = {}, {}
+    for name, cands in candidates.items():
+        for prefix, local_path, is_local in cands:
+            if is_local:
+                if pin: LOCAL_CACHE.pin([local_path])
+                LOCAL_CACHE.hit(local_path)
+                result[name] = local_path; break
+            if exists.get(f"{prefix}/{name}"):
+                if pin: LOCAL_CACHE.pin([local_path])
+                downloads[name] = STORAGE_FETCH_POOL.submit(storage_download, f"{prefix}/{name}", local_path, timeout)
+                result[name] = local_path; break
+    for name, fut in downloads.items():
+        if not fut.result():
+            # La baixada ha fallat: ens quedem amb la millor variant local, si n'hi ha
+            if pin: LOCAL_CACHE.unpin([result[name]])
+            local_fallback = [p for _, p, is_local in candidates[name] if is_local]
+            if local_fallback:
+                if pin: LOCAL_CACHE.pin(local_fallback[:1])
+                result[name] = local_fallback[0]
+            else: del result[name]
+    return result
+
 # --- FLASK APP INIT ---
 app = Flask(__name__, template_folder=str(BASE_DIR/"templates"), static_folder=str(BASE_DIR/"static"))
 app.secret_key = os.environ.get("SECRET_KEY", "clau-secreta-pro-2025")
@@ -127,26 +500,463 @@ def get_sid():
     session['sid'] = sid
     return sid
 
+# Capa de sessió en memòria: lectures des de memòria mentre la còpia local és vigent,
+# escriptures marcades com a brutes i pujades a GCS en segon pla (agrupades per sid).
+# Totes les escriptures són mutacions (funcions sobre el dict de sessió) serialitzades per un
+# bloqueig per sid; la pujada a GCS porta la precondició if_generation_match i, si una altra instància
+# ha escrit entremig, es tornen a aplicar les mutacions pendents sobre la versió remota i es reintenta.
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "30"))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2"))
+SESSION_CONFLICT_RETRIES = int(os.environ.get("SESSION_CONFLICT_RETRIES", "5"))
+# Sessions que no s'han pogut pujar (error o massa conflictes): reintent amb espera creixent fins a aquest màxim
+SESSION_RETRY_MAX_S = float(os.environ.get("SESSION_RETRY_MAX_S", "30"))
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "gcs").lower()  # 'gcs' (JSON al bucket) o 'firestore'
+
+try:
+    from google.cloud.firestore import ArrayUnion, ArrayRemove, DELETE_FIELD
+    from google.cloud.firestore_v1.field_path import FieldPath
+except ImportError:
+    ArrayUnion = ArrayRemove = DELETE_FIELD = FieldPath = None
+
+def session_copy(data):
+    return json.loads(json.dumps(data))
+
+class SessionPatch:
+    """Mutació a nivell de camp: es pot tornar a aplicar sobre una versió més nova de la sessió."""
+    def __init__(self):
+        self.ops = []
+
+    def set(self, field, value):
+        self.ops.append(('set', field, session_copy(value))); return self
+
+    def append_unique(self, field, values):
+        self.ops.append(('append_unique', field, list(values))); return self
+
+    def remove(self, field, value):
+        self.ops.append(('remove', field, value)); return self
+
+    def set_item(self, field, key, value):
+        self.ops.append(('set_item', field, key, session_copy(value))); return self
+
+    def delete_item(self, field, key):
+        self.ops.append(('delete_item', field, key)); return self
+
+    def __call__(self, data):
+        for op, field, *args in self.ops:
+            if op == 'set': data[field] = session_copy(args[0])
+            elif op == 'append_unique':
+                current = data.setdefault(field, [])
+                current.extend(v for v in args[0] if v not in current)
+            elif op == 'remove':
+                if args[0] in data.get(field, []): data[field] = [v for v in data[field] if v != args[0]]
+            elif op == 'set_item': data.setdefault(field, {})[args[0]] = session_copy(args[1])
+            elif op == 'delete_item': data.get(field, {}).pop(args[0], None)
+        return data
+
+class SessionConflict(Exception):
+    """La versió remota ha canviat des de la que coneixíem."""
+
+# Interfície dels backends de sessió:
+#   read(sid, known_version=None) -> (data, version); data és None si no existeix o no ha canviat
+#   write(sid, data, version, pending) -> (version nova, data remota o None); pot llançar SessionConflict.
+#     Si el servidor fusiona canvis d'altres escriptors, retorna el document tal com ha quedat a la versió nova.
+# 'pending' són les mutacions encara no pujades (SessionPatch o funcions), en ordre.
+class GCSSessionBackend:
+    """Un JSON per sessió al bucket; la generació de l'objecte fa de versió."""
+    name = "gcs"
+
+    def read(self, sid, known_version=None):
+        bucket = get_bucket()
+        if not bucket: return None, known_version
+        started = time.perf_counter()
+        try:
+            blob = bucket.get_blob(f"sessions/{sid}.json", timeout=GCS_TIMEOUT)
+            record_storage_request(started, miss=blob is None)
+            if blob is None: return None, known_version
+            if known_version is not None and blob.generation == known_version:
+                return None, known_version
+            started = time.perf_counter()
+            raw = blob.download_as_bytes(if_generation_match=blob.generation, timeout=GCS_TIMEOUT)
+            record_storage_request(started, bytes_down=len(raw))
+            return json.loads(raw), blob.generation
+        except Exception as e:
+            record_storage_request(started, error=True)
+            print(f"ADVERTÈNCIA: SESSION - Error llegint {sid} de GCS: {e}")
+            return None, known_version
+
+    def write(self, sid, data, version, pending):
+        bucket = get_bucket()
+        if not bucket: raise RuntimeError("bucket no disponible")
+        started = time.perf_counter()
+        try:
+            blob = bucket.blob(f"sessions/{sid}.json")
+            payload = json.dumps(data)
+            blob.upload_from_string(payload, content_type="application/json", timeout=GCS_TIMEOUT,
+                                    if_generation_match=version or 0)
+            record_storage_request(started, bytes_up=len(payload))
+            return blob.generation, None
+        except Exception as e:
+            record_storage_request(started, error=True)
+            if PreconditionFailed is not None and isinstance(e, PreconditionFailed): raise SessionConflict(str(e))
+            raise
+
+class FirestoreSessionBackend:
+    """Un document per sessió a la col·lecció 'sessions'; update_time fa de versió.
+
+    Si totes les mutacions pendents són SessionPatch, s'envien com a actualitzacions de camp
+    (ArrayUnion/ArrayRemove per a les llistes, camins amb punt per als diccionaris): Firestore les
+    fusiona al servidor i no hi ha conflicte possible. Una substitució completa (put o mutació
+    arbitrària) porta la precondició last_update_time, com if_generation_match a GCS.
+    Després d'escriure es torna a llegir el document perquè la versió correspongui a les dades."""
+    name = "firestore"
+
+    def __init__(self, client, collection="sessions"):
+        self.client = client
+        self.collection = collection
+        self.fields = {}  # sid -> (update_time, camps de primer nivell): per esborrar-los en una substitució
+
+    def _ref(self, sid):
+        return self.client.collection(self.collection).document(sid)
+
+    def read(self, sid, known_version=None):
+        try:
+            snap = self._ref(sid).get()
+        except Exception as e:
+            print(f"ADVERTÈNCIA: SESSION - Error llegint {sid} de Firestore: {e}")
+            return None, known_version
+        if not snap.exists: return None, known_version
+        if known_version is not None and snap.update_time == known_version: return None, known_version
+        data = snap.to_dict()
+        self.fields[sid] = (snap.update_time, set(data))
+        return data, snap.update_time
+
+    @staticmethod
+    def field_updates(pending):
+        """Tradueix una llista de SessionPatch a un dict per a DocumentReference.update(); None si no es pot."""
+        updates = {}
+        for patch in pending:
+            for op, field, *args in patch.ops:
+                if op == 'set':
+                    for k in [k for k in updates if k == field or k.startswith(f"{field}.")]: del updates[k]
+                    updates[field] = args[0]
+                elif field in updates:
+                    return None  # ja hi ha una altra escriptura sobre el camp sencer: no es poden combinar
+                elif op == 'append_unique': updates[field] = ArrayUnion(args[0])
+                elif op == 'remove': updates[field] = ArrayRemove([args[0]])
+                elif op == 'set_item': updates[FieldPath(field, args[0]).to_api_repr()] = args[1]
+                elif op == 'delete_item': updates[FieldPath(field, args[0]).to_api_repr()] = DELETE_FIELD
+        return updates
+
+    def write(self, sid, data, version, pending):
+        ref = self._ref(sid)
+        updates = None
+        if pending and all(isinstance(p, SessionPatch) for p in pending) and version is not None:
+            updates = self.field_updates(pending)
+        try:
+            if updates:
+                ref.update(updates)
+            elif version is None:
+                ref.create(data)
+            else:
+                known_at, known_fields = self.fields.get(sid, (None, set()))
+                replace = {FieldPath(k).to_api_repr(): v for k, v in data.items()}
+                if known_at == version:
+                    replace.update({FieldPath(k).to_api_repr(): DELETE_FIELD for k in known_fields - set(data)})
+                ref.update(replace, option=self.client.write_option(last_update_time=version))
+        except Exception as e:
+            if any(cls is not None and isinstance(e, cls) for cls in (Conflict, FailedPrecondition)):
+                raise SessionConflict(str(e))
+            raise
+        snap = ref.get()
+        merged = snap.to_dict()
+        self.fields[sid] = (snap.update_time, set(merged))
+        return snap.update_time, merged
+
+def make_session_backend(kind=None):
+    kind = (kind or SESSION_BACKEND).lower()
+    if kind == "firestore":
+        if db is not None and ArrayUnion is not None: return FirestoreSessionBackend(db)
+        print("ADVERTÈNCIA: SESSION_BACKEND=firestore però Firestore no està disponible; s'usa GCS")
+    return GCSSessionBackend()
+
+class SessionStore:
+    def __init__(self, backend=None):
+        self.backend = backend or make_session_backend()
+        self.lock = Lock()
+        self.entries = {}  # sid -> {'data', 'dirty', 'checked_at', 'version', 'pending'}
+        self.wakeup = threading.Event()
+        self.flusher = None
+        self.counters = {'mem_hits': 0, 'remote_reads': 0, 'remote_revalidations': 0, 'remote_writes': 0,
+                         'coalesced_writes': 0, 'conflicts': 0, 'conflict_failures': 0}
+        self.sid_locks = {}
+
+    def _local_path(self, sid):
+        return SESSIONS_DIR / f"{sid}.json"
+
+    def _write_local(self, sid, data):
+        local_path = self._local_path(sid)
+        tmp_path = local_path.with_name(f".{local_path.name}.{uuid.uuid4().hex[:8]}.part")
+        with open(tmp_path, 'w') as f: json.dump(data, f)
+        os.replace(tmp_path, local_path)
+
+    def _fetch_remote(self, sid, known_version=None):
+        """Retorna (data, version) del backend; (None, version) si no ha canviat o no existeix."""
+        if not IS_PROD: return None, known_version
+        return self.backend.read(sid, known_version)
+
+    def get(self, sid):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry and (entry['dirty'] or not IS_PROD or now - entry['checked_at'] < SESSION_CACHE_TTL):
+                self.counters['mem_hits'] += 1
+                return session_copy(entry['data'])
+            known_version = entry['version'] if entry else None
+
+        if entry:
+            # Revalidació barata (a GCS només metadades): si ningú l'ha tocat, la còpia en memòria és vigent
+            data, version = self._fetch_remote(sid, known_version)
+            with self.lock: self.counters['remote_revalidations'] += 1
+        else:
+            data, version = self._fetch_remote(sid)
+            with self.lock: self.counters['remote_reads'] += 1
+            if data is None:
+                local_path = self._local_path(sid)
+                if local_path.exists():
+                    try:
+                        with open(local_path, 'r') as f: data = json.load(f)
+                    except: pass
+
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry and entry['dirty']:
+                return session_copy(entry['data'])
+            if data is not None:
+                entry = self.entries[sid] = {'data': data, 'dirty': False, 'checked_at': now,
+                                             'version': version, 'pending': []}
+                if IS_PROD: self._write_local(sid, data)
+            elif entry:
+                entry['checked_at'] = now
+            else:
+                return {}
+            return session_copy(entry['data'])
+
+    def sid_lock(self, sid):
+        with self.lock:
+            return self.sid_locks.setdefault(sid, threading.RLock())
+
+    def mutate(self, sid, fn):
+        """Aplica fn(data) sota el bloqueig del sid i la deixa pendent de pujar; retorna el que retorna fn.
+
+        fn s'ha de poder tornar a executar: en cas de conflicte es reaplica sobre la versió remota."""
+        with self.sid_lock(sid):
+            data = self.get(sid)
+            result = fn(data)
+            snapshot = session_copy(data)
+            with self.lock:
+                entry = self.entries.get(sid)
+                if entry and entry['dirty']: self.counters['coalesced_writes'] += 1
+                pending = (entry['pending'] if entry and entry['dirty'] else []) + [fn] if IS_PROD else []
+                self.entries[sid] = {'data': snapshot, 'dirty': IS_PROD, 'checked_at': time.time(),
+                                     'version': entry['version'] if entry else None, 'pending': pending}
+                self._write_local(sid, snapshot)
+        if IS_PROD:
+            self._ensure_flusher()
+            self.wakeup.set()
+        return result
+
+    def patch(self, sid, patch: SessionPatch):
+        return self.mutate(sid, patch)
+
+    def put(self, sid, data):
+        """Substitució completa del document (l'últim que escriu guanya)."""
+        snapshot = session_copy(data)
+        def replace(current):
+            current.clear(); current.update(session_copy(snapshot))
+        self.mutate(sid, replace)
+
+    def _ensure_flusher(self):
+        with self.lock:
+            if self.flusher and self.flusher.is_alive(): return
+            self.flusher = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        retry_s = 0
+        while True:
+            # Sense res pendent s'espera una mutació; si alguna sessió ha quedat bruta, es reintenta igualment
+            self.wakeup.wait(timeout=retry_s or None)
+            # Esperem l'interval per agrupar les escriptures del mateix sid en una sola pujada
+            time.sleep(SESSION_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+            with self.lock: dirty = any(e['dirty'] for e in self.entries.values())
+            retry_s = min(max(retry_s * 2, SESSION_FLUSH_INTERVAL, 0.1), SESSION_RETRY_MAX_S) if dirty else 0
+
+    def _rebase(self, sid):
+        """Conflicte: baixa la versió remota i hi torna a aplicar les mutacions pendents."""
+        remote, version = self._fetch_remote(sid)
+        if version is None: return None
+        with self.sid_lock(sid):
+            with self.lock:
+                entry = self.entries.get(sid)
+                if not entry: return None
+                data = remote if remote is not None else {}
+                for fn in entry['pending']: fn(data)
+                entry.update(data=data, version=version, checked_at=time.time())
+                self._write_local(sid, data)
+                return session_copy(data), version, len(entry['pending'])
+
+    def _upload(self, sid, data, version, n_ops):
+        for attempt in range(SESSION_CONFLICT_RETRIES + 1):
+            with self.lock:
+                entry = self.entries.get(sid)
+                pending = list(entry['pending'][:n_ops]) if entry else []
+            try:
+                new_version, remote = self.backend.write(sid, data, version, pending)
+            except SessionConflict:
+                with self.lock: self.counters['conflicts'] += 1
+                print(f"DEBUG: SESSION - Conflicte de versió a {sid}, reaplicant canvis (intent {attempt + 1})")
+                rebased = self._rebase(sid)
+                if not rebased: break
+                data, version, n_ops = rebased
+                continue
+            except Exception as e:
+                print(f"ADVERTÈNCIA: SESSION - Error pujant {sid} ({self.backend.name}): {e}")
+                return
+            with self.sid_lock(sid), self.lock:
+                self.counters['remote_writes'] += 1
+                entry = self.entries.get(sid)
+                if entry:
+                    # Les mutacions fetes mentre pujàvem queden pendents per a la següent passada
+                    entry['pending'] = entry['pending'][n_ops:]
+                    entry.update(dirty=bool(entry['pending']), version=new_version, checked_at=time.time())
+                    if remote is not None:
+                        # El servidor ha fusionat camps d'altres escriptors: la còpia local ha de ser la de new_version
+                        for fn in entry['pending']: fn(remote)
+                        entry['data'] = remote
+                        self._write_local(sid, remote)
+            return
+        with self.lock: self.counters['conflict_failures'] += 1
+        print(f"ADVERTÈNCIA: SESSION - {sid} sense pujar després de {SESSION_CONFLICT_RETRIES} conflictes")
+
+    def flush(self):
+        if not IS_PROD: return  # en local la sessió només viu al disc
+        with self.lock:
+            dirty = [(sid, session_copy(e['data']), e['version'], len(e['pending']))
+                     for sid, e in self.entries.items() if e['dirty']]
+        for sid, data, version, n_ops in dirty:
+            self._upload(sid, data, version, n_ops)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, backend=self.backend.name, cached=len(self.entries),
+                        dirty=sum(1 for e in self.entries.values() if e['dirty']))
+
+SESSION_STORE = SessionStore()  # drain_background (SIGTERM i atexit) en puja les sessions pendents
+
 def load_gcs_session(sid=None):
     if not sid: sid = get_sid()
-    local_path = SESSIONS_DIR / f"{sid}.json"
-    if IS_PROD: storage_download(f"sessions/{sid}.json", local_path)
-    if local_path.exists():
-        try:
-            with open(local_path, 'r') as f: return json.load(f)
-        except: pass
-    return {}
+    return SESSION_STORE.get(sid)
 
 def save_gcs_session(data, sid=None):
     if not sid: sid = get_sid()
-    local_path = SESSIONS_DIR / f"{sid}.json"
-    with open(local_path, 'w') as f: json.dump(data, f)
-    storage_save(local_path, f"sessions/{sid}.json")
+    SESSION_STORE.put(sid, data)
 
 def update_gcs_session(updates, sid=None):
-    data = load_gcs_session(sid)
-    data.update(updates)
-    save_gcs_session(data, sid)
+    if not sid: sid = get_sid()
+    patch = SessionPatch()
+    for field, value in updates.items(): patch.set(field, value)
+    SESSION_STORE.patch(sid, patch)
+
+def patch_gcs_session(patch: SessionPatch, sid=None):
+    if not sid: sid = get_sid()
+    SESSION_STORE.patch(sid, patch)
+
+# --- HELPERS: BUS D'ESTAT (SSE) ---
+# Els missatges de progrés es publiquen en un bus en memòria per sid; /status_stream els empeny
+# al navegador amb Server-Sent Events sense tocar GCS. Si el client cau en una altra instància
+# (el bus no coneix el sid), el stream envia l'estat de la sessió i demana tornar al polling.
+# Cada generació porta un run id (status_run a la sessió): els esdeveniments d'una execució anterior
+# que encara siguin al bus d'aquesta instància no es fan passar per l'estat de l'actual.
+STATUS_STREAM_KEEPALIVE = float(os.environ.get("STATUS_STREAM_KEEPALIVE", "15"))
+STATUS_STREAM_MAX_S = float(os.environ.get("STATUS_STREAM_MAX_S", "300"))
+STATUS_BUS_TTL = 3600
+
+def is_final_status(message):
+    return message == "[READY]" or message.startswith("[ERROR]")
+
+class StatusBus:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = {}  # sid -> {'seq', 'status', 'ts'}
+        self.seq = 0
+        self.subscribers = 0
+        self.published = 0
+
+    def publish(self, sid, message, run=None):
+        if not sid: return
+        with self.cond:
+            # Sense run explícit, el missatge és progrés de l'execució en curs del sid
+            if run is None: run = (self.events.get(sid) or {}).get('run')
+            self.seq += 1; self.published += 1
+            self.events[sid] = {'seq': self.seq, 'status': message, 'ts': time.time(), 'run': run}
+            cutoff = time.time() - STATUS_BUS_TTL
+            for old in [k for k, e in self.events.items() if e['ts'] < cutoff]: del self.events[old]
+            self.cond.notify_all()
+
+    def latest(self, sid):
+        with self.cond:
+            e = self.events.get(sid)
+            return dict(e) if e else None
+
+    def wait(self, sid, after_seq, timeout):
+        """Retorna el primer esdeveniment del sid posterior a after_seq, o None si passa el timeout."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                e = self.events.get(sid)
+                if e and e['seq'] > after_seq: return dict(e)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return None
+                self.cond.wait(remaining)
+
+    @contextmanager
+    def subscription(self):
+        with self.cond: self.subscribers += 1
+        try: yield
+        finally:
+            with self.cond: self.subscribers -= 1
+
+    def stats(self):
+        with self.cond:
+            return {'sids': len(self.events), 'subscribers': self.subscribers, 'published': self.published}
+
+STATUS_BUS = StatusBus()
+
+def set_status(message, sid, patch=None, run=None):
+    """Desa status_message (i la resta de canvis de patch) a la sessió i el publica al bus."""
+    patch = (patch or SessionPatch()).set('status_message', message)
+    if run: patch.set('status_run', run)
+    patch_gcs_session(patch, sid)
+    STATUS_BUS.publish(sid, message, run)
+
+def status_for_run(sid, run=None):
+    """Retorna (esdeveniment del bus, None) si el bus porta l'execució run; si no, (None, estat de la sessió)."""
+    sdata = None
+    if not run:
+        sdata = load_gcs_session(sid)
+        run = sdata.get('status_run')
+    event = STATUS_BUS.latest(sid)
+    if event and event.get('run') == run: return event, None
+    if sdata is None: sdata = load_gcs_session(sid)
+    if run and sdata.get('status_run') != run:
+        return None, 'Processant...'  # la sessió d'aquesta instància encara no ha vist l'execució nova
+    return None, sdata.get('status_message', 'Processant...')
+
+def sse_event(data, event=None):
+    head = f"event: {event}\n" if event else ""
+    return head + "".join(f"data: {line}\n" for line in json.dumps(data).splitlines()) + "\n"
 
 def set_vertical_alignment(section, align='center'):
     sectPr = section._sectPr
@@ -170,6 +980,14 @@ def add_field(p, c):
 
 from docx.enum.text import WD_TAB_ALIGNMENT
 
+def footer_text(nat_code: str, dil_code: str = ""):
+    # Construir text: NAT XXXX/XX - ART MNORD - Dil. XXXX
+    parts_line = []
+    if nat_code: parts_line.append(f"NAT {nat_code}")
+    parts_line.append("ART MNORD")
+    if dil_code: parts_line.append(f"Dil. {dil_code}")
+    return " - ".join(parts_line)
+
 def create_footer(sec, nat_code: str, dil_code: str = "", qualitat: str = "atenea"):
     # Netejar footer existents
     ft = sec.footer
@@ -185,13 +1003,7 @@ def create_footer(sec, nat_code: str, dil_code: str = "", qualitat: str = "atene
     # Format de tabuladors: Un a la dreta per la paginació
     p.paragraph_format.tab_stops.add_tab_stop(Inches(6.5), WD_TAB_ALIGNMENT.RIGHT)
     
-    # Construir text: NAT XXXX/XX - ART MNORD - Dil. XXXX
-    parts_line = []
-    if nat_code: parts_line.append(f"NAT {nat_code}")
-    parts_line.append("ART MNORD")
-    if dil_code: parts_line.append(f"Dil. {dil_code}")
-    
-    full_text = " - ".join(parts_line)
+    full_text = footer_text(nat_code, dil_code)
     
     # Afegeix contingut
     r1 = p.add_run(full_text)
@@ -211,6 +1023,41 @@ def create_footer(sec, nat_code: str, dil_code: str = "", qualitat: str = "atene
     p.add_run(" / ").font.size = Pt(12); p.runs[-1].font.name = "Arial"
     add_field(p, 'NUMPAGES')
 
+# El logotip es llegeix un sol cop per procés: bytes i mida en memòria. python-docx deduplica la
+# imatge dins del document, i la capçalera i el peu es defineixen una vegada i les seccions
+# següents hi queden enllaçades (is_linked_to_previous), de manera que el DOCX només en porta una còpia.
+_logo_cache = None
+_logo_lock = Lock()
+
+def load_logo():
+    """Retorna (bytes, (amplada_px, alçada_px)) del logotip definitiu, o None si no hi és."""
+    global _logo_cache
+    if _logo_cache is not None: return _logo_cache or None
+    with _logo_lock:
+        if _logo_cache is None:
+            _logo_cache = ()
+            for name in ("logo_definitive.jpg", "logo_definitive.png"):
+                path = STATIC_DIR / name
+                if path.exists():
+                    data = path.read_bytes()
+                    with Image.open(io.BytesIO(data)) as im: _logo_cache = (data, im.size)
+                    break
+    return _logo_cache or None
+
+def add_logo_picture(run, width):
+    logo = load_logo()
+    if not logo:
+        print("ERROR: Logo definitiu no trobat! No es mostrarà cap logo.")
+        return None
+    data, (w_px, h_px) = logo
+    # Amb l'alçada calculada aquí python-docx no ha de tornar a llegir la capçalera de la imatge per escalar
+    return run.add_picture(io.BytesIO(data), width=width, height=int(width * h_px / w_px))
+
+def link_header_footer(sec):
+    """La secció reutilitza la capçalera i el peu de l'anterior en lloc de definir-ne uns de nous."""
+    sec.header.is_linked_to_previous = True
+    sec.footer.is_linked_to_previous = True
+
 def add_logo_to_header(header):
     try:
         header.is_linked_to_previous = False
@@ -245,24 +1092,10 @@ def add_logo_to_header(header):
 
         run = p.add_run()
         
-        # PRIORITAT ABSOLUTA: logo_definitive.jpg (o png)
-        logo_path_jpg = STATIC_DIR / "logo_definitive.jpg"
-        logo_path_png = STATIC_DIR / "logo_definitive.png"
-        
-        target_logo = None
-        if logo_path_jpg.exists(): target_logo = str(logo_path_jpg)
-        elif logo_path_png.exists(): target_logo = str(logo_path_png)
-        
         # Mida "una mica més gran" que 3.0 -> 3.3 polzades
         # I "sense que creixi l'espai de la capçalera" -> Això es controla amb els marges de la secció, no aquí.
-        header_logo_width = Inches(3.3) 
-        
-        if target_logo:
-             # Ajustar "amunt": El marge superior de la secció controla la posició base.
-             # Aquí assegurem que no hi ha espai extra.
-            run.add_picture(target_logo, width=header_logo_width)
-        else:
-            print("ERROR: Logo definitiu no trobat! No es mostrarà cap logo.")
+        # Ajustar "amunt": El marge superior de la secció controla la posició base.
+        add_logo_picture(run, Inches(3.3))
             
     except Exception as e:
         print(f"ERROR LOGO HEADER: {e}")
@@ -274,22 +1107,9 @@ def add_logo_to_body(doc):
         p.alignment = Align.CENTER
         run = p.add_run()
         
-        # PRIORITAT ABSOLUTA: logo_definitive.jpg (o png)
-        logo_path_jpg = STATIC_DIR / "logo_definitive.jpg"
-        logo_path_png = STATIC_DIR / "logo_definitive.png"
-        
-        target_logo = None
-        if logo_path_jpg.exists(): target_logo = str(logo_path_jpg)
-        elif logo_path_png.exists(): target_logo = str(logo_path_png)
-        
         # Mida gran per portada
-        cover_logo_width = Inches(4.5) 
-        
-        if target_logo:
-            run.add_picture(target_logo, width=cover_logo_width)
-            # Versió eliminada de la portada per petició: "no hace falta poner la version"
-        else:
-            print("ERROR: Logo definitiu no trobat! No es mostrarà cap logo.")
+        # Versió eliminada de la portada per petició: "no hace falta poner la version"
+        add_logo_picture(run, Inches(4.5))
             
     except Exception as e:
         print(f"ERROR LOGO BODY: {e}")
@@ -305,23 +1125,233 @@ def resize_to_box(img, max_w, max_h, allow_upscale=False):
 def to_jpeg_path(path):
     return path.with_suffix(".jpg")
 
-def add_photo_block(doc, img_buffer, photo_num, page_w_cm, max_h_cm, description=""):
+# --- HELPERS: CACHE DE RENDICIONS (INFORME) ---
+# Les fotos ja codificades per a l'informe es guarden per hash de la font + perfil de qualitat.
+# Regenerar un informe sense canvis a les fotos no toca Pillow.
+RENDITION_CACHE_BYTES = int(os.environ.get("RENDITION_CACHE_BYTES", str(128 * 1024 * 1024)))
+RENDITION_CACHE_GCS = os.environ.get("RENDITION_CACHE_GCS", "0") == "1"
+
+_file_hash_memo = {}
+_file_hash_lock = Lock()
+
+def file_content_hash(path: Path) -> str:
+    """SHA-256 del contingut d'un fitxer (memoritzat per ruta + mida + mtime)."""
+    st = path.stat()
+    memo_key = (str(path), st.st_size, st.st_mtime_ns)
+    with _file_hash_lock:
+        if memo_key in _file_hash_memo: return _file_hash_memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''): h.update(chunk)
+    digest = h.hexdigest()
+    with _file_hash_lock:
+        _file_hash_memo[memo_key] = digest
+    return digest
+
+def link_or_copy(src: Path, dst: Path):
+    """Enllaç dur (mateix disc, sense copiar ni compartir el destí d'una expulsió); si no es pot, còpia."""
+    try: os.link(src, dst)
+    except FileExistsError:
+        Path(dst).unlink(); os.link(src, dst)
+    except OSError: shutil.copyfile(src, dst)
+
+class RenditionCache:
+    """Cache local (LRU per bytes) de JPEGs llestos per a l'informe, amb nivell GCS opcional."""
+
+    def __init__(self, root: Path, max_bytes: int, use_gcs: bool = False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.use_gcs = use_gcs
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(src_hash: str, profile: str) -> str:
+        return hashlib.sha256(f"{src_hash}:{profile}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.jpg"
+
+    def get_path(self, key: str):
+        """Camí del JPEG a la cache (marcat com a usat), o None. Pot desaparecer per expulsió: enllaçar-lo abans d'usar-lo."""
+        p = self._path(key)
+        try:
+            os.utime(p)  # marca d'ús recent per a l'LRU
+            with self.lock: self.hits += 1
+            return p
+        except FileNotFoundError:
+            pass
+        if self.use_gcs and storage_download(f"renditions/{key}.jpg", p):
+            with self.lock: self.hits += 1
+            return p
+        with self.lock: self.misses += 1
+        return None
+
+    def get(self, key: str):
+        p = self.get_path(key)
+        try: return p.read_bytes() if p else None
+        except FileNotFoundError: return None
+
+    def _admit(self, key: str, write):
+        p = self._path(key)
+        tmp = p.with_name(f".{p.name}.{uuid.uuid4().hex[:8]}.part")
+        try:
+            write(tmp)
+            os.replace(tmp, p)
+        except Exception as e:
+            print(f"ADVERTÈNCIA: RENDITION - No s'ha pogut guardar {key}: {e}")
+            tmp.unlink(missing_ok=True)
+            return
+        if self.use_gcs: BG_IO.submit(storage_save, p, f"renditions/{key}.jpg")
+        self.evict()
+
+    def put(self, key: str, data: bytes):
+        self._admit(key, lambda tmp: tmp.write_bytes(data))
+
+    def put_file(self, key: str, path: Path):
+        """Afegeix un JPEG ja escrit al disc (enllaç dur si és possible, sense copiar bytes)."""
+        self._admit(key, lambda tmp: link_or_copy(path, tmp))
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for p in self.root.glob("*.jpg"):
+                try:
+                    st = p.stat(); entries.append((st.st_mtime, st.st_size, p))
+                except FileNotFoundError: pass
+            total = sum(e[1] for e in entries)
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes: break
+                p.unlink(missing_ok=True)
+                total -= size; self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+RENDITION_CACHE = RenditionCache(RENDITIONS_DIR, RENDITION_CACHE_BYTES, use_gcs=RENDITION_CACHE_GCS)
+
+# --- HELPERS: PREPARACIÓ PARAL·LELA D'IMATGES (INFORME) ---
+# Grau de paral·lelisme i temps màxim per imatge (configurables per entorn)
+REPORT_PREP_WORKERS = int(os.environ.get("REPORT_PREP_WORKERS", "4"))
+REPORT_PREP_TIMEOUT = float(os.environ.get("REPORT_PREP_TIMEOUT", "60"))
+
+# Pool únic per procés: acota els fils de preparació encara que hi hagi diversos informes alhora
+REPORT_PREP_POOL = ThreadPoolExecutor(max_workers=max(1, REPORT_PREP_WORKERS), thread_name_prefix="report-prep")
+
+def photo_source_tiers():
+    """Ordre de preferència de les fotos: editada > master > work."""
+    return [("uploads/edited", EDITED_DIR), ("uploads/master", MASTER_DIR), ("uploads/work", WORK_DIR)]
+
+def fetch_photo_sources(names, timeout=None, pin=False):
+    """Retorna {nom: path} amb el millor fitxer font de cada foto, baixant de GCS en bloc el que calgui."""
+    return storage_fetch_many(names, photo_source_tiers(), timeout=timeout, pin=pin)
+
+def prepare_report_image(name, src_path, target_w, target_h, allow_up, jpg_quality, out_path: Path):
+    """Descodifica, redimensiona i codifica una foto per a l'informe a out_path. Retorna out_path o None."""
+    if not src_path:
+        print(f"ADVERTÈNCIA: No s'ha trobat cap arxiu font per a {name}")
+        return None
+    profile = f"{target_w}x{target_h}:q{jpg_quality}:up{int(bool(allow_up))}"
+    cache_key = RenditionCache.key(file_content_hash(src_path), profile)
+    cached = RENDITION_CACHE.get_path(cache_key)
+    if cached is not None:
+        try:
+            link_or_copy(cached, out_path)
+            return out_path
+        except FileNotFoundError:
+            pass  # expulsada entremig: es torna a generar
+    with Image.open(src_path) as img:
+        if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
+        img2 = resize_to_box(img, target_w, target_h, allow_upscale=allow_up)
+        img2.save(out_path, format='JPEG', quality=jpg_quality, optimize=True)
+    RENDITION_CACHE.put_file(cache_key, out_path)
+    return out_path
+
+def prepare_report_images(names, target_w, target_h, allow_up, jpg_quality, out_dir: Path, workers=None, timeout=None,
+                          source_hashes=None):
+    """
+    Prepara les fotos de l'informe al pool compartit i les retorna en l'ordre original.
+    Cada foto queda com a JPEG a out_dir (no en memòria); el cridador n'esborra el directori.
+    Si es passa `source_hashes` (dict), s'hi desa el hash del fitxer font de cada foto preparada.
+    `workers` limita quantes fotos d'aquest informe hi ha en curs alhora.
+    Les imatges que fallen o superen `timeout` segons (des que comencen) es descarten.
+    Retorna (noms_valids, camins, stats).
+    """
+    workers = max(1, min(workers or REPORT_PREP_WORKERS, REPORT_PREP_WORKERS))
+    if timeout is None: timeout = REPORT_PREP_TIMEOUT
+    total = len(names)
+    started, elapsed = {}, {}
+
+    def task(idx, name):
+        started[idx] = time.perf_counter()
+        print(f"DEBUG: Processant imatge {idx+1}/{total}: {name}")
+        try:
+            out_path = prepare_report_image(name, sources.get(name), target_w, target_h, allow_up, jpg_quality,
+                                            out_dir / f"{idx:04d}.jpg")
+            if out_path is not None and source_hashes is not None:
+                source_hashes[name] = file_content_hash(sources[name])  # memoritzat per prepare_report_image
+            return out_path
+        finally:
+            elapsed[idx] = time.perf_counter() - started[idx]
+
+    out_dir = Path(out_dir); out_dir.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    # Totes les fonts d'un cop (consultes i baixades GCS en paral·lel), fixades mentre l'informe les fa servir
+    sources = fetch_photo_sources(names, timeout=timeout, pin=True)
+    fetch_s = time.perf_counter() - t0
+    results = [None] * total
+    queue = list(enumerate(names))
+    futures, pending = {}, set()
+    timed_out = 0
+    try:
+        while queue or pending:
+            # Finestra lliscant: mai més de `workers` fotos d'aquest informe en curs
+            while queue and len(pending) < workers:
+                idx, name = queue.pop(0)
+                fut = REPORT_PREP_POOL.submit(task, idx, name)
+                futures[fut] = idx; pending.add(fut)
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = futures[fut]
+                try: results[idx] = fut.result()
+                except Exception as e: print(f"ERROR processant imatge {names[idx]}: {e}")
+            # Descartar les imatges que porten massa temps en curs
+            now = time.perf_counter()
+            for fut in list(pending):
+                idx = futures[fut]
+                if idx in started and now - started[idx] > timeout:
+                    print(f"ERROR processant imatge {names[idx]}: temps esgotat ({timeout:.0f}s)")
+                    elapsed.setdefault(idx, now - started[idx])
+                    pending.discard(fut); timed_out += 1
+    finally:
+        LOCAL_CACHE.unpin(sources.values())
+
+    wall = time.perf_counter() - t0
+    serial = sum(elapsed.values())
+    stats = {'images': total, 'workers': workers, 'timed_out': timed_out, 'fetch_s': round(fetch_s, 3), 'wall_s': round(wall, 3),
+             'serial_s': round(serial, 3), 'speedup': round(serial / wall, 2) if wall else 0.0}
+    print(f"DEBUG: PREP - {total} imatges en {wall:.2f}s amb {workers} fils (sèrie: {serial:.2f}s, x{stats['speedup']})")
+
+    valid_names = [n for n, path in zip(names, results) if path is not None]
+    paths = [path for path in results if path is not None]
+    return valid_names, paths, stats
+
+def caption_font_size(description):
+    """Mida de font dinàmica per encabir-ho tot: si el text és llarg, reduïm la lletra perquè no salti de pàgina."""
+    desc_len = len(description)
+    if desc_len > 900: return 7
+    if desc_len > 600: return 8
+    return 9
+
+def add_photo_block(doc, img_buffer, photo_num, page_w_cm, max_h_cm, description="", size_px=None):
     # page_w_cm: Ample TOTAL disponible a la pàgina (per al text)
     # max_h_cm: Alçada màxima de la FOTO
-    
+    # size_px: (w, h) si ja es coneix (índex de metadades): així no cal obrir la imatge per mesurar-la
+
     # 1. Preparar imatge (mida més gran per estètica, ex: 16.5cm)
-    photo_display_w = 16.5 
-    
-    img_buffer.seek(0)
-    with Image.open(img_buffer) as im:
-        w, h = im.size; aspect_ratio = w / h if h else 1
-        # Calculem dimensions finals
-        final_w = photo_display_w
-        final_h = final_w / aspect_ratio
-        if final_h > max_h_cm:
-            final_h = max_h_cm
-            final_w = final_h * aspect_ratio
-            
+    final_w, final_h = photo_display_size(img_buffer, max_h_cm, size_px=size_px)
+
     # 2. Crear Taula contenidora (100% ample pàgina)
     tbl = doc.add_table(rows=1, cols=1); tbl.alignment = Align.CENTER
     # Forçar ample taula al total disponible
@@ -354,13 +1384,8 @@ def add_photo_block(doc, img_buffer, photo_num, page_w_cm, max_h_cm, description
         # Keep lines together
         p_caption.paragraph_format.keep_together = True
         
-        # Mida de font dinàmica per encabir-ho tot
-        # Si el text és llarg, reduïm la lletra perquè no salti de pàgina
-        desc_len = len(description)
-        font_size = 9
-        if desc_len > 600: font_size = 8
-        if desc_len > 900: font_size = 7
-        
+        font_size = caption_font_size(description)
+
         # Format compacte
         r1 = p_caption.add_run(f"Fotografia núm. {photo_num}: ")
         r1.bold = True; r1.font.size = Pt(font_size); r1.font.name = 'Arial'
@@ -388,11 +1413,242 @@ def init_vertex_ai():
 
 import traceback
 
+# Motor de lots: les imatges es parteixen en blocs de AI_CHUNK_SIZE i s'envien en paral·lel
+# (com a màxim AI_CHUNK_CONCURRENCY alhora). Cada bloc recorre la cadena de models pel seu compte:
+# si un bloc falla només es reintenta aquell bloc amb el model següent.
+AI_CHUNK_SIZE = int(os.environ.get("AI_CHUNK_SIZE", "6"))
+AI_CHUNK_CONCURRENCY = int(os.environ.get("AI_CHUNK_CONCURRENCY", "3"))
+# AI_BACKEND=fake: model simulat (sense xarxa) per provar rendiment i reintents
+AI_BACKEND = os.environ.get("AI_BACKEND", "google")
+AI_FAKE_LATENCY = float(os.environ.get("AI_FAKE_LATENCY", "0.1"))  # segons per imatge del bloc
+AI_FAKE_FAIL_MODELS = [m for m in os.environ.get("AI_FAKE_FAIL_MODELS", "").split(",") if m]
+AI_CHUNK_POOL = ThreadPoolExecutor(max_workers=max(1, AI_CHUNK_CONCURRENCY), thread_name_prefix="ai-chunk")
+
+class FakeResponse:
+    def __init__(self, text): self.text = text
+
+class FakeGenerativeModel:
+    """Substitut de genai.GenerativeModel: respon amb una descripció per cada 'NOM DEL FITXER' rebut."""
+    calls = []
+    _calls_lock = Lock()
+
+    def __init__(self, model_name): self.model_name = model_name
+
+    def generate_content(self, contents, generation_config=None):
+        names = [c.split(": ", 1)[1] for c in contents if isinstance(c, str) and c.startswith("NOM DEL FITXER: ")]
+        with self._calls_lock: FakeGenerativeModel.calls.append((self.model_name, names))
+        time.sleep(AI_FAKE_LATENCY * max(1, len(names)))
+        if self.model_name in AI_FAKE_FAIL_MODELS:
+            raise RuntimeError(f"{self.model_name}: fallada simulada")
+        return FakeResponse(json.dumps({n: f"Descripció simulada de {n} ({self.model_name})." for n in names}))
+
+def get_generative_model(model_name):
+    if AI_BACKEND == "fake": return FakeGenerativeModel(model_name)
+    return genai.GenerativeModel(model_name)
+
+def match_descriptions(raw_data, image_files):
+    """Casa les claus retornades per la IA amb els fitxers reals."""
+    final_descs = {}
+    
+    # Estratègia 1: Diccionari directe o llista de dicts
+    temp_dict = {}
+    if isinstance(raw_data, list):
+        for item in raw_data:
+            if isinstance(item, dict): temp_dict.update(item)
+    elif isinstance(raw_data, dict):
+        temp_dict = raw_data
+    
+    # Estratègia 2: Matching
+    ai_keys = list(temp_dict.keys())
+    print(f"DEBUG: GEN Claus Retornades: {ai_keys}")
+    print(f"DEBUG: Imatges Esperades: {image_files}")
+    
+    for i, fname in enumerate(image_files):
+        # 2a. Coincidència exacta
+        if fname in temp_dict:
+            final_descs[fname] = temp_dict[fname]
+        # 2b. Coincidència parcial (si la IA es deixa .jpg)
+        elif fname.split('.')[0] in temp_dict:
+             final_descs[fname] = temp_dict[fname.split('.')[0]]
+        # 2c. Fallback per índex (si la IA retorna claus rares però en ordre)
+        elif i < len(ai_keys):
+            # Assumim que l'ordre es respecta
+            key_at_index = ai_keys[i]
+            final_descs[fname] = temp_dict[key_at_index]
+    return final_descs
+
+def encode_ai_image(src_path):
+    """Retorna la foto reduïda a 1024x768 en JPEG."""
+    with Image.open(src_path) as img:
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+        # Reduir una mica qualitat per anar ràpid a l'API
+        img_small = resize_to_box(img, 1024, 768) 
+        buf = io.BytesIO()
+        img_small.save(buf, format="JPEG", quality=85)
+        return buf.getvalue()
+
+# --- HELPERS: CACHE DE DESCRIPCIONS ---
+# Clau: hash del contingut de la foto + hash del prompt + model. Tornar a generar un cas amb les
+# mateixes fotos i el mateix relat respon a l'instant; només les fotos noves o editades van al model.
+# CAPTION_CACHE_BACKEND: 'local' (només disc), 'gcs' (captions/ al bucket) o 'firestore' (col·lecció caption_cache).
+CAPTION_CACHE_BACKEND = os.environ.get("CAPTION_CACHE_BACKEND", "local")
+
+class CaptionCache:
+    def __init__(self, backend="local"):
+        self.backend = backend
+        self.lock = Lock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(image_hash, prompt_hash, model_name):
+        return hashlib.sha256(f"{image_hash}:{prompt_hash}:{model_name}".encode()).hexdigest()
+
+    def _local_path(self, key):
+        return CAPTIONS_DIR / f"{key}.json"
+
+    def _read(self, key):
+        local_path = self._local_path(key)
+        if not local_path.exists():
+            if self.backend == "gcs":
+                storage_download(f"captions/{key}.json", local_path)
+            elif self.backend == "firestore" and db:
+                try:
+                    snap = db.collection('caption_cache').document(key).get()
+                    if snap.exists: self._write_local(key, snap.to_dict())
+                except Exception as e: print(f"ADVERTÈNCIA: CAPTION - Error Firestore: {e}")
+        try:
+            with open(local_path, 'r') as f: return json.load(f).get('description')
+        except (FileNotFoundError, ValueError): return None
+
+    def _write_local(self, key, entry):
+        local_path = self._local_path(key)
+        tmp_path = local_path.with_name(f".{local_path.name}.{uuid.uuid4().hex[:8]}.part")
+        with open(tmp_path, 'w') as f: json.dump(entry, f)
+        os.replace(tmp_path, local_path)
+
+    def lookup(self, image_hash, prompt_hash, models):
+        """Primer model de la cadena amb descripció guardada, o None."""
+        for model_name in models:
+            desc = self._read(self.key(image_hash, prompt_hash, model_name))
+            if desc:
+                with self.lock: self.hits += 1
+                return desc
+        with self.lock: self.misses += 1
+        return None
+
+    def store(self, image_hash, prompt_hash, model_name, description):
+        key = self.key(image_hash, prompt_hash, model_name)
+        entry = {'description': description, 'model': model_name, 'created_at': time.time()}
+        self._write_local(key, entry)
+        if self.backend == "gcs":
+            BG_IO.submit(storage_save, self._local_path(key), f"captions/{key}.json")
+        elif self.backend == "firestore" and db:
+            BG_IO.submit(db.collection('caption_cache').document(key).set, entry)
+
+    def stats(self):
+        with self.lock: return {'hits': self.hits, 'misses': self.misses}
+
+CAPTION_CACHE = CaptionCache(CAPTION_CACHE_BACKEND)
+
+def describe_chunk(prompt_text, chunk, models_to_try):
+    """Envia un bloc [(fname, jpeg_bytes)] recorrent la cadena de models. Retorna ({fname: desc}, model) o ({}, None)."""
+    contents = [prompt_text]
+    for fname, data in chunk:
+        contents.append(f"NOM DEL FITXER: {fname}")
+        contents.append({"mime_type": "image/jpeg", "data": data})
+    names = [fname for fname, _ in chunk]
+
+    for model_name in models_to_try:
+        try:
+            print(f"DEBUG: GEN - Bloc de {len(names)} amb {model_name}...")
+            model = get_generative_model(model_name)
+            response = model.generate_content(
+                contents, 
+                generation_config={
+                    "response_mime_type": "application/json",
+                    "temperature": 0.1
+                }
+            )
+            if not (response and response.text):
+                print(f"ADVERTÈNCIA: Model {model_name} resposta buida. Provant següent...")
+                continue
+            try:
+                raw_data = json.loads(response.text)
+            except:
+                print(f"DEBUG: GEN - JSON Invàlid: {response.text}")
+                continue
+            final_descs = match_descriptions(raw_data, names)
+            # Si el diccionari està buit, considerem que el model ha fallat i provem el següent.
+            if final_descs:
+                return final_descs, model_name
+            print(f"ADVERTÈNCIA: Model {model_name} ha retornat JSON vàlid però cap coincidència amb fitxers. Provant següent model...")
+        except Exception as e:
+            print(f"ADVERTÈNCIA: Model {model_name} ha fallat: {e}")
+    return {}, None
+
+# Preparació de les entrades de la IA: les fonts es resolen en bloc i després, en un pool de fils,
+# hash, consulta de cache i reducció a JPEG. El progrés s'agrega en un sol flux (com a molt una actualització per interval)
+# i una mateixa foto (mateix hash) només es codifica una vegada dins la tasca.
+AI_PREP_WORKERS = int(os.environ.get("AI_PREP_WORKERS", "4"))
+AI_PROGRESS_INTERVAL = float(os.environ.get("AI_PROGRESS_INTERVAL", "1.0"))
+AI_PREP_POOL = ThreadPoolExecutor(max_workers=max(1, AI_PREP_WORKERS), thread_name_prefix="ai-prep")
+
+def prepare_ai_inputs(image_files, prompt_hash, models_to_try, sid=None):
+    """Retorna (prepared [(fname, jpeg)], image_hashes {fname: hash}, cached_descs {fname: desc}) en l'ordre original."""
+    payloads, payloads_lock = {}, Lock()  # hash -> Future amb els bytes codificats
+
+    def encode_once(image_hash, src_path):
+        with payloads_lock:
+            fut = payloads.get(image_hash)
+            owner = fut is None
+            if owner: fut = payloads[image_hash] = Future()
+        if owner:
+            try: fut.set_result(encode_ai_image(src_path))
+            except Exception as e: fut.set_exception(e)
+        return fut.result()
+
+    sources = fetch_photo_sources(image_files, pin=True)
+
+    def task(fname):
+        src_path = sources.get(fname)
+        if not src_path: return None
+        image_hash = file_content_hash(src_path)
+        cached = CAPTION_CACHE.lookup(image_hash, prompt_hash, models_to_try)
+        if cached: return image_hash, cached, None
+        return image_hash, None, encode_once(image_hash, src_path)
+
+    total_imgs = len(image_files)
+    results = [None] * total_imgs
+    futures = {AI_PREP_POOL.submit(task, fname): idx for idx, fname in enumerate(image_files)}
+    done_count, last_report = 0, 0.0
+    try:
+        for fut in as_completed(futures):
+            idx = futures[fut]
+            try: results[idx] = fut.result()
+            except Exception as e: print(f"DEBUG: GEN Error imatge {image_files[idx]}: {e}")
+            done_count += 1
+            now = time.time()
+            if now - last_report >= AI_PROGRESS_INTERVAL or done_count == total_imgs:
+                update_status(f"Processant imatges ({done_count}/{total_imgs})...", sid)
+                last_report = now
+    finally:
+        LOCAL_CACHE.unpin(sources.values())
+
+    prepared, image_hashes, cached_descs = [], {}, {}
+    for fname, res in zip(image_files, results):
+        if not res: continue
+        image_hash, cached, data = res
+        image_hashes[fname] = image_hash
+        if cached: cached_descs[fname] = cached
+        else: prepared.append((fname, data))
+    print(f"DEBUG: GEN - {len(payloads)} codificacions per {len(prepared)} imatges a enviar.")
+    return prepared, image_hashes, cached_descs
+
 def generate_ai_descriptions(evolucio: str, image_files: List[str], sid: str = None) -> Dict[str, str]:
     if not image_files: return {}
     
     print(f"DEBUG: GEN - Iniciant generació Studio per {len(image_files)} imatges. Relat: {bool(evolucio)}")
-    init_google_ai()
+    if AI_BACKEND != "fake": init_google_ai()
     
     # Si no hi ha evolució, usem un prompt per defecte per no cancel·lar la generació
     context_evolucio = evolucio if evolucio else "Investigació d'accident de trànsit (sense relat previ)."
@@ -415,125 +1671,34 @@ def generate_ai_descriptions(evolucio: str, image_files: List[str], sid: str = N
         "FORMAT: Retorna EXCLUSIVAMENT un objecte JSON amb la clau del fitxer i el valor amb la descripció."
     )
     
-    contents = [prompt_text]
-    # ... (resta de codi igual per preparar imatges)
-    valid_images_count = 0
-    total_imgs = len(image_files)
-    
-    for idx, fname in enumerate(image_files):
-        update_status(f"Processant imatges ({idx+1}/{total_imgs})...", sid)
-        try:
-            # 1. Comprovar localment
-            src_path = None
-            for folder in [EDITED_DIR, MASTER_DIR, WORK_DIR]:
-                if (folder/fname).exists():
-                    src_path = folder/fname
-                    break
-            
-            # Baixada de seguretat de GCS
-            if not src_path and IS_PROD:
-                for folder_name in ["work", "master", "edited"]:
-                    p_target = MASTER_DIR / fname
-                    print(f"DEBUG: GEN - Intentant descarregar {fname} de {folder_name}...")
-                    if storage_download(f"uploads/{folder_name}/{fname}", p_target):
-                        src_path = p_target
-                        print(f"DEBUG: GEN - Descarregada correctament de {folder_name}")
-                        break
-            
-            if src_path:
-                with Image.open(src_path) as img:
-                    if img.mode not in ("RGB", "L"): img = img.convert("RGB")
-                    # Reduir una mica qualitat per anar ràpid a l'API
-                    img_small = resize_to_box(img, 1024, 768) 
-                    buf = io.BytesIO()
-                    img_small.save(buf, format="JPEG", quality=85)
-                    buf.seek(0)
-                    
-                    contents.append(f"NOM DEL FITXER: {fname}")
-                    contents.append({
-                        "mime_type": "image/jpeg",
-                        "data": buf.read()
-                    })
-                    valid_images_count += 1
-        except Exception as e:
-             print(f"DEBUG: GEN Error imatge {fname}: {e}")
+    prompt_hash = hashlib.sha256(prompt_text.encode()).hexdigest()
+    prepared, image_hashes, final_descs = prepare_ai_inputs(image_files, prompt_hash, models_to_try, sid)
+    print(f"DEBUG: GEN - Cache de descripcions: {len(final_descs)} encerts, {len(prepared)} per generar. {CAPTION_CACHE.stats()}")
         
-    if valid_images_count == 0:
-        return {f: "Error: No s'han pogut llegir les imatges." for f in image_files}
-
-    # Bucle de reintents
-    for model_name in models_to_try:
-        try:
-            # "No hace falta ponerlo ni el modelo que se utiliza tampoco": Canviat a "Analitzant..." pur i dur.
-            update_status(f"Analitzant imatges i generant descripcions...", sid)
-            print(f"DEBUG: GEN - Intentant amb {model_name}...")
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(
-                contents, 
-                generation_config={
-                    "response_mime_type": "application/json",
-                    "temperature": 0.1
-                }
-            )
-            if response and response.text:
-                print(f"DEBUG: GEN - Èxit amb {model_name}. Processant JSON...")
-                try:
-                    raw_data = json.loads(response.text)
-                except:
-                    print(f"DEBUG: GEN - JSON Invàlid: {response.text}")
-                    continue
-
-                final_descs = {}
-                
-                # Estratègia 1: Diccionari directe o llista de dicts
-                temp_dict = {}
-                if isinstance(raw_data, list):
-                    for item in raw_data:
-                        if isinstance(item, dict): temp_dict.update(item)
-                elif isinstance(raw_data, dict):
-                    temp_dict = raw_data
-                
-                # Estratègia 2: Matching
-                # Intentem casar les claus retornades amb els fitxers reals
-                ai_keys = list(temp_dict.keys())
-                print(f"DEBUG: GEN Claus Retornades: {ai_keys}")
-                print(f"DEBUG: Imatges Esperades: {image_files}")
-                
-                for i, fname in enumerate(image_files):
-                    # 2a. Coincidència exacta
-                    if fname in temp_dict:
-                        final_descs[fname] = temp_dict[fname]
-                    # 2b. Coincidència parcial (si la IA es deixa .jpg)
-                    elif fname.split('.')[0] in temp_dict:
-                         final_descs[fname] = temp_dict[fname.split('.')[0]]
-                    # 2c. Fallback per índex (si la IA retorna claus rares però en ordre)
-                    elif i < len(ai_keys):
-                        # Assumim que l'ordre es respecta
-                        key_at_index = ai_keys[i]
-                        final_descs[fname] = temp_dict[key_at_index]
-                
-                # VALIDACIÓ DE LA RESPOSTA
-                # Si hem aconseguit casar alguna cosa, ho donem per bo.
-                # Si el diccionari està buit, considerem que el model ha fallat i provem el següent.
-                if final_descs:
-                    print(f"DEBUG: Èxit rotund amb {model_name}. {len(final_descs)} descripcions generades.")
-                    return final_descs
-                else:
-                    print(f"ADVERTÈNCIA: Model {model_name} ha retornat JSON vàlid però cap coincidència amb fitxers. Provant següent model...")
-                    continue # Saltem al següent model
+    if not prepared:
+        return final_descs or {f: "Error: No s'han pogut llegir les imatges." for f in image_files}
 
-            else:
-                 print(f"ADVERTÈNCIA: Model {model_name} resposta buida. Provant següent...")
-                 continue
+    chunk_size = max(1, AI_CHUNK_SIZE)
+    chunks = [prepared[i:i + chunk_size] for i in range(0, len(prepared), chunk_size)]
+    update_status(f"Analitzant imatges i generant descripcions (0/{len(chunks)} blocs)...", sid)
 
-        except Exception as e:
-            msg = f"ADVERTÈNCIA: Model {model_name} ha fallat: {e}"
-            print(msg)
-            # traceback.print_exc() # Opcional per no embrutar logs
-            continue 
-            
-    # Si arribem aquí, MALA SORT: Cap model ha funcionat.
-    return {f: "Error crític: Tots els models de generació han fallat. Intenta-ho de nou." for f in image_files}
+    done_chunks = 0
+    futures = [AI_CHUNK_POOL.submit(describe_chunk, prompt_text, chunk, models_to_try) for chunk in chunks]
+    for fut in as_completed(futures):
+        try:
+            chunk_descs, model_name = fut.result()
+            final_descs.update(chunk_descs)
+            for fname, desc in chunk_descs.items():
+                if desc and fname in image_hashes: CAPTION_CACHE.store(image_hashes[fname], prompt_hash, model_name, desc)
+        except Exception as e: print(f"ADVERTÈNCIA: GEN - Bloc fallat: {e}")
+        done_chunks += 1
+        update_status(f"Analitzant imatges i generant descripcions ({done_chunks}/{len(chunks)} blocs)...", sid)
+
+    if not final_descs:
+        # Si arribem aquí, MALA SORT: Cap model ha funcionat.
+        return {f: "Error crític: Tots els models de generació han fallat. Intenta-ho de nou." for f in image_files}
+    print(f"DEBUG: GEN - {len(final_descs)}/{len(image_files)} descripcions generades en {len(chunks)} blocs.")
+    return final_descs
 
 # --- ROUTES ---
 
@@ -567,7 +1732,7 @@ def index():
         
     session.clear()
     session['authenticated'] = True
-    resp = make_response(render_template("index.html", app_version=APP_VERSION))
+    resp = make_response(render_template("index.html", app_version=APP_VERSION, upload_concurrency=UPLOAD_CLIENT_CONCURRENCY))
     resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     resp.headers['Pragma'] = 'no-cache'
     resp.headers['Expires'] = '0'
@@ -608,6 +1773,10 @@ def start_session():
         print(f"ERROR: start_session failed: {e}")
         return jsonify(ok=False, error=str(e)), 500
 
+def upload_manifest_patch(files):
+    """Afegeix files (en l'ordre del client) a latest_uploads i image_order sense duplicar."""
+    return SessionPatch().append_unique('latest_uploads', files).append_unique('image_order', files)
+
 @app.post("/finalize_upload")
 def finalize_upload():
     # Forçar sessió si ve per URL
@@ -616,59 +1785,230 @@ def finalize_upload():
     
     req_data = request.get_json()
     new_files = req_data.get('files', [])
-    sdata = load_gcs_session()
-    current_uploads = sdata.get('latest_uploads', [])
-    current_order = sdata.get('image_order', [])
-    
-    updated_uploads = current_uploads + [f for f in new_files if f not in current_uploads]
-    if not current_order:
-        updated_order = updated_uploads
-    else:
-        updated_order = current_order + [f for f in new_files if f not in current_order]
-        
-    update_gcs_session({'latest_uploads': updated_uploads, 'image_order': updated_order})
-    return jsonify(ok=True)
+    sid = get_sid()
+    patch_gcs_session(upload_manifest_patch(new_files), sid)
+    return jsonify(ok=True, count=len(load_gcs_session(sid).get('image_order', [])))
 
 import threading
 
+# --- HELPERS: INGESTA D'IMATGES ---
+# La pujada es descodifica directament del flux multipart: Werkzeug el guarda en un buffer en
+# memòria (fins a UPLOAD_SPOOL_BYTES, després disc) i Pillow el llegeix sense cap fitxer _tmp.
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(32 * 1024 * 1024)))
+UPLOAD_METRICS = {'count': 0, 'last_peak_bytes': 0, 'max_peak_bytes': 0, 'rss_high_water_kb': 0}
+_upload_metrics_lock = Lock()
+
+class SpooledUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode="rb+")
+
+app.request_class = SpooledUploadRequest
+
+def stream_size(stream):
+    pos = stream.tell(); stream.seek(0, os.SEEK_END)
+    size = stream.tell(); stream.seek(pos)
+    return size
+
+def record_upload_metrics(peak_bytes):
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with _upload_metrics_lock:
+        UPLOAD_METRICS['count'] += 1
+        UPLOAD_METRICS['last_peak_bytes'] = peak_bytes
+        UPLOAD_METRICS['max_peak_bytes'] = max(UPLOAD_METRICS['max_peak_bytes'], peak_bytes)
+        UPLOAD_METRICS['rss_high_water_kb'] = rss_kb
+
+# Totes les derivades d'una pujada, de la més gran a la més petita: (tipus, ample, alt, qualitat JPEG).
+# Es descodifica una sola vegada (amb draft JPEG a la mida mínima necessària) i cada derivada
+# es calcula a partir de l'anterior, no de la imatge original.
+UPLOAD_RENDITIONS = [
+    ('master', 1920, 1080, 90),  # Report quality
+    ('work', 1360, 768, 90),     # Editor quality & AI
+    ('thumb', 320, 240, 80),     # Graella de la pàgina d'ordenació
+]
+
+def rendition_dir(kind):
+    return {'master': MASTER_DIR, 'work': WORK_DIR, 'thumb': THUMBS_DIR}[kind]
+
+def fit_size(w, h, max_w, max_h):
+    ratio = min(max_w / w, max_h / h, 1)
+    return max(1, int(w * ratio)), max(1, int(h * ratio))
+
+# --- HELPERS: NORMALITZACIÓ EN PUJAR ---
+# Les fotos de mòbil porten l'orientació a l'EXIF i sovint un perfil de color propi (Display P3...).
+# En pujar-les es redrecen, es passen a sRGB i es treuen les metadades un sol cop: totes les derivades
+# (i l'informe) ja surten dretes i no cal girar-les a l'editor.
+# UPLOAD_EXIF: "strip" (per defecte, fitxers més petits) o "keep" (la master conserva l'EXIF original
+# -data, GPS, càmera- amb l'orientació a 1 i sense la miniatura EXIF).
+UPLOAD_EXIF = os.environ.get("UPLOAD_EXIF", "strip")
+EXIF_TRANSPOSE = {2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+                  4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+                  6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE, 8: Image.Transpose.ROTATE_90}
+EXIF_SWAPS_AXES = (5, 6, 7, 8)
+_srgb_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")) if ImageCms else None
+
+def to_srgb(img, icc):
+    """Converteix a sRGB si la foto porta un altre perfil. Retorna (img, perfil a incrustar o None)."""
+    if not icc or img.mode != "RGB": return img, icc if img.mode == "L" else None
+    if _srgb_profile is None: return img, icc
+    try:
+        src = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+        if "srgb" in ImageCms.getProfileDescription(src).lower(): return img, None
+        return ImageCms.profileToProfile(img, src, _srgb_profile, outputMode="RGB"), None
+    except Exception as e:
+        print(f"ADVERTÈNCIA: Perfil de color no convertible, es conserva: {e}")
+        return img, icc
+
+def normalize_upload(img, exif_rotation, icc, max_w, max_h):
+    """Primera derivada dreta i en sRGB: es redimensiona a l'espai de l'original (caixa girada si cal)
+    i es gira i converteix ja petita. Retorna (img, perfil ICC a incrustar o None)."""
+    if exif_rotation in EXIF_SWAPS_AXES: max_w, max_h = max_h, max_w
+    img = resize_to_box(img, max_w, max_h, allow_upscale=False)
+    if exif_rotation in EXIF_TRANSPOSE: img = img.transpose(EXIF_TRANSPOSE[exif_rotation])
+    return to_srgb(img, icc)
+
+def master_exif_bytes(exif):
+    """EXIF per a la master amb UPLOAD_EXIF=keep: orientació a 1 (ja està dreta), sense miniatura."""
+    if UPLOAD_EXIF != "keep" or not exif: return None
+    exif[EXIF_ORIENTATION_TAG] = 1
+    return exif.tobytes()
+
+# --- HELPERS: ÍNDEX DE METADADES D'IMATGE ---
+# Cada foto té una entrada a la sessió ('image_meta', per nom) omplerta en pujar-la o editar-la:
+# mides de la font de l'informe (master o editada), orientació, rotació EXIF de l'original, bytes i hash.
+# L'informe en treu les mides sense obrir cap imatge; el hash diu si l'entrada encara descriu la font.
+EXIF_ORIENTATION_TAG = 0x0112
+
+def read_image_size(path):
+    """(ample, alt) en píxels. Image.open només llegeix la capçalera: no es descodifica la imatge."""
+    with Image.open(path) as im:
+        return im.size
+
+def image_meta(path: Path, size=None, exif_rotation=None, source='master'):
+    """Entrada de l'índex per a un fitxer ja escrit. Sense size/exif_rotation es llegeixen de la capçalera."""
+    if size is None or exif_rotation is None:
+        with Image.open(path) as im:
+            size = size or im.size
+            if exif_rotation is None: exif_rotation = im.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    w, h = size
+    orientation = 'portrait' if h > w else ('landscape' if w > h else 'square')
+    return {'w': w, 'h': h, 'orientation': orientation, 'exif_rotation': exif_rotation,
+            'bytes': path.stat().st_size, 'hash': file_content_hash(path), 'source': source}
+
+def report_photo_sizes(names, paths, meta, source_hashes):
+    """Mides en píxels per a la maquetació: de l'índex si el hash coincideix amb la font feta servir,
+    si no (sessions antigues, edició sense indexar) de la capçalera del JPEG preparat."""
+    sizes, probed = [], 0
+    for name, path in zip(names, paths):
+        entry = meta.get(name)
+        if entry and entry.get('hash') and entry['hash'] == source_hashes.get(name):
+            sizes.append((entry['w'], entry['h']))
+        else:
+            sizes.append(read_image_size(path)); probed += 1
+    if probed: print(f"DEBUG: LAYOUT - {probed}/{len(names)} fotos sense metadades vàlides (capçalera llegida)")
+    return sizes
+
+def ingest_upload(stream, base_name):
+    """
+    Descodifica una foto pujada des del seu flux i en desa totes les derivades de UPLOAD_RENDITIONS.
+    Retorna ({tipus: path}, peak_bytes, meta), on peak_bytes estima la memòria de treball de la pujada
+    i meta és l'entrada de l'índex de metadades (de la derivada 'master').
+    """
+    stream.seek(0)
+    peak_bytes = stream_size(stream)
+    paths, sizes = {}, {}
+    with Image.open(stream) as img:
+        exif = img.getexif()
+        exif_rotation = exif.get(EXIF_ORIENTATION_TAG, 1)
+        icc = img.info.get('icc_profile')
+        # Draft JPEG: el descodificador salta la resolució que cap derivada farà servir
+        _, max_w, max_h, _ = UPLOAD_RENDITIONS[0]
+        if exif_rotation in EXIF_SWAPS_AXES: draft = fit_size(img.size[1], img.size[0], max_w, max_h)[::-1]
+        else: draft = fit_size(img.size[0], img.size[1], max_w, max_h)
+        img.draft('RGB', draft)
+        current = img if img.mode in ("RGB", "L") else img.convert("RGB")
+        decoded_bytes = current.size[0] * current.size[1] * len(current.getbands())
+        for i, (kind, max_w, max_h, quality) in enumerate(UPLOAD_RENDITIONS):
+            if i == 0: current, icc = normalize_upload(current, exif_rotation, icc, max_w, max_h)
+            else: current = resize_to_box(current, max_w, max_h, allow_upscale=False)
+            out_path = to_jpeg_path(rendition_dir(kind) / base_name)
+            extra = {'icc_profile': icc} if icc else {}
+            exif_bytes = master_exif_bytes(exif) if kind == 'master' else None
+            if exif_bytes: extra['exif'] = exif_bytes
+            current.save(out_path, format="JPEG", quality=quality, optimize=True, **extra)
+            paths[kind], sizes[kind] = out_path, current.size
+    peak_bytes += decoded_bytes * 2  # frame descodificat + primera derivada
+    meta = image_meta(paths['master'], size=sizes['master'], exif_rotation=exif_rotation)
+    return paths, peak_bytes, meta
+
+# Protocol de pujada: el client envia diverses fotos alhora, cadascuna amb una clau d'idempotència
+# (camp 'key'). El nom final es deriva de la clau, de manera que un reintent reescriu el mateix fitxer,
+# i la clau es registra a la sessió: un reintent d'una foto ja rebuda no es torna a processar.
+UPLOAD_CLIENT_CONCURRENCY = int(os.environ.get("UPLOAD_CLIENT_CONCURRENCY", "3"))
+UPLOADS_INFLIGHT = {}  # (sid, key) -> threading.Event
+UPLOADS_INFLIGHT_LOCK = Lock()
+
+def upload_base_name(filename, key=None):
+    clean_name = secure_filename(Path(filename).stem)
+    if key: return f"{clean_name}_{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+    unique_id = int(time.time() * 1000) % 1000000
+    return f"{clean_name}_{unique_id}"
+
 @app.post("/upload")
 def upload():
     # Forçar sessió si ve per URL
     sid_param = request.args.get('sid')
     if sid_param: session['sid'] = sid_param
+    sid = get_sid()
+    key = (request.form.get("key") or request.headers.get("Idempotency-Key") or "").strip()[:200] or None
 
     files = request.files.getlist("photos")
     work_filename = None
     for f in files:
         if not (f and f.filename): continue
-        clean_name = secure_filename(Path(f.filename).stem)
-        unique_id = int(time.time() * 1000) % 1000000
-        base_name = f"{clean_name}_{unique_id}"
-        
-        tmp_path = WORK_DIR / (base_name + "_tmp"); f.save(tmp_path)
+        base_name = upload_base_name(f.filename, key)
+
+        if key:
+            done = load_gcs_session(sid).get('upload_keys', {}).get(key)
+            if done:
+                f.close()
+                return jsonify(ok=True, filename=done, duplicate=True)
+            with UPLOADS_INFLIGHT_LOCK:
+                running = UPLOADS_INFLIGHT.get((sid, key))
+                if not running: UPLOADS_INFLIGHT[(sid, key)] = threading.Event()
+            if running:
+                # Reintent mentre l'original encara es processa: esperem el seu resultat
+                f.close()
+                running.wait(timeout=120)
+                done = load_gcs_session(sid).get('upload_keys', {}).get(key)
+                if done: return jsonify(ok=True, filename=done, duplicate=True)
+                return jsonify(ok=False, error="Pujada en curs, torna-ho a provar."), 409
+
         try:
-            with Image.open(tmp_path) as img:
-                if img.mode not in ("RGB", "L"): img = img.convert("RGB")
-                
-                # Editor quality & AI (Sincronitzat)
-                work_img = resize_to_box(img, 1360, 768, allow_upscale=False)
-                work_path = to_jpeg_path(WORK_DIR / base_name); work_img.save(work_path, format="JPEG", quality=90, optimize=True)
-                if IS_PROD:
-                    storage_save(work_path, f"uploads/work/{work_path.name}")
-                
-                # Report quality (Background)
-                master_img = resize_to_box(img, 1920, 1080, allow_upscale=False)
-                master_path = to_jpeg_path(MASTER_DIR / base_name); master_img.save(master_path, format="JPEG", quality=90, optimize=True)
-                if IS_PROD:
-                    run_in_bg(storage_save, master_path, f"uploads/master/{master_path.name}")
-                
-                work_filename = work_path.name
+            paths, peak_bytes, meta = ingest_upload(f.stream, base_name)
+            record_upload_metrics(peak_bytes)
+            print(f"DEBUG: UPLOAD - {f.filename}: memòria de treball ~{peak_bytes / 1048576:.1f} MiB")
+
+            if IS_PROD:
+                storage_save_or_pin(paths['work'], f"uploads/work/{paths['work'].name}")
+                # Fixades fins que la pujada de fons acabi: no es poden expulsar abans d'arribar a GCS
+                LOCAL_CACHE.pin([paths['master'], paths['thumb']])
+                BG_IO.submit(storage_save_pinned, paths['master'], f"uploads/master/{paths['master'].name}")
+                BG_IO.submit(storage_save_pinned, paths['thumb'], f"uploads/thumbs/{paths['thumb'].name}")
+            for p in paths.values(): LOCAL_CACHE.admit(p, miss=False)
+
+            work_filename = paths['work'].name
+            patch = SessionPatch().set_item('image_meta', work_filename, meta)
+            if key: patch.set_item('upload_keys', key, work_filename)
+            patch_gcs_session(patch, sid)
         except Exception as e:
             print(f"[UPLOAD] Error processant {f.filename}: {e}")
             return jsonify(ok=False, error=str(e)), 500
         finally:
-            try: tmp_path.unlink(missing_ok=True)
-            except Exception: pass
+            f.close()
+            if key:
+                with UPLOADS_INFLIGHT_LOCK:
+                    event = UPLOADS_INFLIGHT.pop((sid, key), None)
+                if event: event.set()
             
     return jsonify(ok=True, filename=work_filename)
 
@@ -706,24 +2046,96 @@ def update_order():
 
 @app.post("/delete/<path:filename>")
 def delete_image(filename):
-    for folder in (EDITED_DIR, WORK_DIR, MASTER_DIR):
+    for folder in (EDITED_DIR, WORK_DIR, MASTER_DIR, THUMBS_DIR):
         (folder / Path(filename).name).unlink(missing_ok=True)
+        LOCAL_CACHE.forget(folder / Path(filename).name)
+    THUMB_VERSIONS.pop(Path(filename).name, None)
     
-    sdata = load_gcs_session()
-    current_order = sdata.get('image_order', [])
-    updates = {}
-    if current_order:
-        updates['image_order'] = [img for img in current_order if img != filename]
-        
-    current_uploads = sdata.get('latest_uploads', [])
-    if current_uploads:
-         updates['latest_uploads'] = [img for img in current_uploads if img != filename]
-    
-    if updates: update_gcs_session(updates)
+    patch_gcs_session(SessionPatch().remove('image_order', filename).remove('latest_uploads', filename)
+                      .delete_item('image_meta', filename))
     return jsonify(ok=True)
 
+# --- HELPERS: SERVEI D'IMATGES AMB VALIDACIÓ ---
+# Les imatges es serveixen amb ETag (hash del contingut) i Last-Modified: el navegador les guarda
+# i només les torna a baixar si han canviat (p. ex. després d'una edició).
+def make_thumb(src_path: Path, thumb_path: Path):
+    _, max_w, max_h, quality = UPLOAD_RENDITIONS[-1]
+    with Image.open(src_path) as img:
+        img.draft('RGB', fit_size(img.size[0], img.size[1], max_w, max_h))
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+        thumb = resize_to_box(img, max_w, max_h, allow_upscale=False)
+        tmp_path = thumb_path.with_name(f".{thumb_path.name}.{uuid.uuid4().hex[:8]}.part")
+        thumb.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, thumb_path)
+
+# Frescor de les miniatures sense preguntar a GCS a cada petició: l'índex de metadades de la sessió diu
+# quina és la font vigent (master o editada, amb el seu hash). Una miniatura de la master no caduca mai;
+# la d'una edició és vigent si es va fer (o baixar) per al mateix hash. /save_edit puja la miniatura nova
+# abans d'actualitzar l'índex, així qui vegi el hash nou ja la troba a GCS.
+THUMB_VERSIONS = {}  # nom -> hash de la font de la miniatura local
+# Sessions sense índex: un 404 de uploads/edited es recorda un temps en lloc de tornar-lo a provar
+EDIT_MISS_TTL = float(os.environ.get("EDIT_MISS_TTL", "300"))
+_edit_misses = {}  # nom -> instant del 404
+
+def thumb_is_current(name, meta):
+    if not (THUMBS_DIR / name).exists(): return False
+    return meta.get('source') != 'edited' or THUMB_VERSIONS.get(name) == meta.get('hash')
+
+def ensure_thumb(filename, meta=None):
+    """Retorna la miniatura de `filename`, generant-la (o baixant-la) si cal. meta: entrada de 'image_meta'."""
+    name = Path(filename).name
+    p_thumb, p_edit, p_work = THUMBS_DIR / name, EDITED_DIR / name, WORK_DIR / name
+    if meta:
+        if thumb_is_current(name, meta): return p_thumb
+        if IS_PROD and storage_download(f"uploads/thumbs/{name}", p_thumb):
+            THUMB_VERSIONS[name] = meta.get('hash')
+            return p_thumb
+        src_path = p_edit if meta.get('source') == 'edited' and p_edit.exists() else p_work
+        if not src_path.exists() and IS_PROD:
+            storage_download(f"uploads/{'edited' if src_path == p_edit else 'work'}/{name}", src_path)
+        if not src_path.exists(): return None
+        make_thumb(src_path, p_thumb)
+        THUMB_VERSIONS[name] = meta.get('hash')
+        if IS_PROD:
+            storage_save(p_thumb, f"uploads/thumbs/{name}")
+            LOCAL_CACHE.admit(p_thumb, miss=False)
+        return p_thumb
+
+    if IS_PROD and not p_edit.exists() and time.time() - _edit_misses.get(name, 0) > EDIT_MISS_TTL:
+        if not storage_download(f"uploads/edited/{name}", p_edit): _edit_misses[name] = time.time()
+    if p_thumb.exists() and (not p_edit.exists() or p_thumb.stat().st_mtime >= p_edit.stat().st_mtime):
+        return p_thumb
+    if IS_PROD and not p_edit.exists() and storage_download(f"uploads/thumbs/{name}", p_thumb):
+        return p_thumb
+    if not p_edit.exists() and not p_work.exists() and IS_PROD:
+        storage_download(f"uploads/work/{name}", p_work)
+    src_path = p_edit if p_edit.exists() else (p_work if p_work.exists() else None)
+    if not src_path: return None
+    make_thumb(src_path, p_thumb)
+    if IS_PROD:
+        storage_save(p_thumb, f"uploads/thumbs/{name}")
+        LOCAL_CACHE.admit(p_thumb, miss=False)
+    return p_thumb
+
+def send_validated_image(path: Path):
+    st = path.stat()
+    response = send_file(path, mimetype="image/jpeg", etag=file_content_hash(path),
+                         last_modified=st.st_mtime, conditional=True)
+    # Es pot guardar, però sempre es revalida amb l'ETag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.get("/thumb/<path:filename>")
+def thumb_file(filename):
+    sid = request.args.get('sid') or session.get('sid')
+    meta = load_gcs_session(sid).get('image_meta', {}).get(Path(filename).name) if sid else None
+    p_thumb = ensure_thumb(filename, meta)
+    if not p_thumb: return "Not found", 404
+    return send_validated_image(p_thumb)
+
 @app.get("/uploads/<path:filename>")
 def uploaded_file(filename):
+    filename = Path(filename).name
     p_edit = EDITED_DIR / filename
     p_work = WORK_DIR / filename
     
@@ -731,11 +2143,10 @@ def uploaded_file(filename):
         if not p_edit.exists(): storage_download(f"uploads/edited/{filename}", p_edit)
         if not p_work.exists() and not p_edit.exists(): storage_download(f"uploads/work/{filename}", p_work)
 
-    directory_to_check = EDITED_DIR if p_edit.exists() else WORK_DIR
-    response = make_response(send_from_directory(directory_to_check, filename))
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'; response.headers['Expires'] = '0'
-    return response
+    path = p_edit if p_edit.exists() else p_work
+    if not path.exists(): return "Not found", 404
+    LOCAL_CACHE.hit(path)
+    return send_validated_image(path)
 
 @app.get("/edit/<path:filename>")
 def edit(filename): return render_template("edit.html", filename=filename, ts=int(time.time()))
@@ -747,7 +2158,21 @@ def save_edit(filename):
     EDITED_DIR.mkdir(parents=True, exist_ok=True)
     out_path = EDITED_DIR / Path(secure_filename(filename)).name
     f.save(out_path)
-    storage_save(out_path, f"uploads/edited/{out_path.name}")
+    storage_save_or_pin(out_path, f"uploads/edited/{out_path.name}")
+    LOCAL_CACHE.admit(out_path, miss=False)
+    _edit_misses.pop(out_path.name, None)
+    # La miniatura ha de reflectir l'edició (nou contingut = nou ETag); es puja abans d'indexar l'edició
+    try:
+        make_thumb(out_path, THUMBS_DIR / out_path.name)
+        storage_save(THUMBS_DIR / out_path.name, f"uploads/thumbs/{out_path.name}")
+        LOCAL_CACHE.admit(THUMBS_DIR / out_path.name, miss=False)
+    except Exception as e: print(f"ADVERTÈNCIA: Error regenerant miniatura {out_path.name}: {e}")
+    # L'edició (retall, rotació) canvia les mides que farà servir l'informe
+    try:
+        meta = image_meta(out_path, source='edited')
+        THUMB_VERSIONS[out_path.name] = meta['hash']
+        patch_gcs_session(SessionPatch().set_item('image_meta', out_path.name, meta))
+    except Exception as e: print(f"ADVERTÈNCIA: Error indexant l'edició {out_path.name}: {e}")
     return jsonify(ok=True, path=str(out_path))
 
 @app.post("/generate_api")
@@ -767,33 +2192,31 @@ def generate_api():
         if key.startswith("desc_"): manual_descriptions[key[5:]] = request.form[key]
     
     # Guardar estat inicial
-    sdata.update({'evolucio': evolucio, 'image_order': images_ordered, 'status_message': "Iniciant tasca de fons..."})
-    save_gcs_session(sdata)
+    run = uuid.uuid4().hex
+    set_status("Iniciant tasca de fons...", get_sid(),
+               SessionPatch().set('evolucio', evolucio).set('image_order', images_ordered), run=run)
 
-    def bg_task(sid, evol, imgs, manuals):
+    def bg_task(sid, run, evol, imgs, manuals):
         try:
             print(f"DEBUG: BG_TASK Iniciada per {sid}")
             ai_descs = generate_ai_descriptions(evol, imgs, sid=sid)
             
-            # Recarregar sdata per evitar sobreescriure si ha canviat
-            current_sdata = load_gcs_session(sid)
+            # Només es toquen els camps propis: la resta de la sessió pot haver canviat mentrestant
             final_descs = manuals.copy()
             for fname, desc in ai_descs.items():
                 if not final_descs.get(fname):
                     final_descs[fname] = desc
             
-            current_sdata['image_descriptions'] = final_descs
-            current_sdata['status_message'] = "[READY]"
-            save_gcs_session(current_sdata, sid)
+            set_status("[READY]", sid, SessionPatch().set('image_descriptions', final_descs), run=run)
             print(f"DEBUG: BG_TASK Finalitzada per {sid}")
         except Exception as e:
             print(f"ERROR BG_TASK: {e}")
-            cs = load_gcs_session(sid)
-            cs['status_message'] = f"[ERROR] {str(e)}"
-            save_gcs_session(cs, sid)
+            set_status(f"[ERROR] {str(e)}", sid, run=run)
 
-    run_in_bg(bg_task, session.get('sid'), evolucio, images_ordered, manual_descriptions)
-    return jsonify(ok=True)
+    if not BG_AI.try_submit(bg_task, session.get('sid'), run, evolucio, images_ordered, manual_descriptions):
+        set_status("[ERROR] Servidor ocupat, torna-ho a provar d'aquí a una estona.", get_sid(), run=run)
+        return jsonify(ok=False, error="Servidor ocupat."), 503, {'Retry-After': str(BG_RETRY_AFTER)}
+    return jsonify(ok=True, run=run)
 
 @app.get("/review")
 def review_report():
@@ -817,18 +2240,485 @@ def review_report():
 def save_descriptions():
     form_sid = request.form.get('sid')
     if form_sid: session['sid'] = form_sid
-    sdata = load_gcs_session()
-    
     final_descriptions = {}
     for key, value in request.form.items():
         if key.startswith("desc_"):
             fname = key[5:]
             final_descriptions[fname] = value.strip()
             
-    sdata['image_descriptions'] = final_descriptions
-    save_gcs_session(sdata)
+    update_gcs_session({'image_descriptions': final_descriptions})
     return jsonify(ok=True)
 
+# --- REPORT TEMPLATE ---
+# L'informe es munta sobre una plantilla DOCX preparada un sol cop per procés: configuració de pàgina,
+# peu amb camps PAGE/NUMPAGES, capçalera amb el logo, portada i un fragment de "pàgina de fotos"
+# (taula de foto + separador + salt de secció) que es clona per cada pàgina de la maquetació.
+# Per defecte la plantilla es genera en memòria amb els mateixos helpers; REPORT_TEMPLATE_PATH
+# permet fer servir un .docx editat a mà que mantingui els mateixos marcadors.
+REPORT_TEMPLATE_PATH = os.environ.get("REPORT_TEMPLATE_PATH", "")
+REPORT_PAGE_W_CM, REPORT_PAGE_H_CM = 21.0, 29.7
+# Marges "Estirats" (més estrets per aprofitar espai)
+REPORT_MARGIN_CM = 1.0
+# Alçada pàgina (29.7) - Marges (2) - Header/Footer (3.5) = ~24.2cm
+# Per 2 fotos+text en una pàgina: 9.0cm és el mínim exigit per l'usuari.
+REPORT_PHOTO_MAX_H_CM = 9.0
+MARK_COVER, MARK_CLOSING, MARK_DESC = "{{PORTADA}}", "{{DILIGENCIA}}", "{{DESCRIPCIO}}"
+
+_report_template = None
+_report_template_lock = Lock()
+
+def setup_report_page(sec, v_align=None):
+    sec.different_first_page_header_footer = False
+    sec.page_height = Cm(REPORT_PAGE_H_CM); sec.page_width = Cm(REPORT_PAGE_W_CM)
+    sec.top_margin = Cm(REPORT_MARGIN_CM); sec.bottom_margin = Cm(REPORT_MARGIN_CM)
+    sec.left_margin = Cm(REPORT_MARGIN_CM); sec.right_margin = Cm(REPORT_MARGIN_CM)
+    if v_align: set_vertical_alignment(sec, v_align)
+
+def build_report_template() -> bytes:
+    """Genera la plantilla: portada, una pàgina de fotos d'exemple i la secció de diligència."""
+    doc = Document()
+    sec_titol = doc.sections[0]
+    setup_report_page(sec_titol)
+    # La portada NO té logo a la capçalera (ja en té un de gran al cos); el text del peu es posa per informe
+    create_footer(sec_titol, "", "")
+    add_logo_to_body(doc)
+    doc.add_paragraph(MARK_COVER)
+
+    sec = doc.add_section(WD_SECTION_START.NEW_PAGE)
+    setup_report_page(sec, 'top')
+    add_logo_to_header(sec.header)
+    sec.footer.is_linked_to_previous = True
+    placeholder = io.BytesIO()
+    Image.new("RGB", (4, 3), (255, 255, 255)).save(placeholder, format="JPEG")
+    add_photo_block(doc, placeholder, 0, REPORT_PAGE_W_CM - 2 * REPORT_MARGIN_CM, REPORT_PHOTO_MAX_H_CM, MARK_DESC,
+                    size_px=(4, 3))
+    # Espaiador entre fotos (només si n'hi ha una altra després en la mateixa pàgina)
+    p_sep = doc.add_paragraph()
+    # Reduïm espai entre fotos per guanyar marge
+    p_sep.paragraph_format.space_before = Pt(2)
+    p_sep.paragraph_format.space_after = Pt(2)
+
+    # Diligència final: capçalera i peu enllaçats a l'anterior
+    sec = doc.add_section(WD_SECTION_START.NEW_PAGE)
+    setup_report_page(sec, 'top')
+    link_header_footer(sec)
+    doc.add_paragraph(MARK_CLOSING)
+
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def get_report_template():
+    global _report_template
+    if _report_template is None:
+        with _report_template_lock:
+            if _report_template is None:
+                if REPORT_TEMPLATE_PATH and Path(REPORT_TEMPLATE_PATH).exists():
+                    _report_template = Path(REPORT_TEMPLATE_PATH).read_bytes()
+                else:
+                    _report_template = build_report_template()
+    return _report_template
+
+def photo_display_size(img_src, max_h_cm, display_w_cm=16.5, size_px=None):
+    """Mida final (cm) d'una foto a l'informe: 16.5 cm d'ample, limitada a max_h_cm d'alçada."""
+    if size_px is None:
+        if hasattr(img_src, 'seek'): img_src.seek(0)
+        size_px = read_image_size(img_src)
+    w, h = size_px; aspect_ratio = w / h if h else 1
+    final_w = display_w_cm
+    final_h = final_w / aspect_ratio
+    if final_h > max_h_cm:
+        final_h = max_h_cm
+        final_w = final_h * aspect_ratio
+    return final_w, final_h
+
+# --- REPORT LAYOUT ---
+# La maquetació de les pàgines de fotos es calcula abans de muntar el DOCX, només amb les mides en
+# píxels (llegides de la capçalera del JPEG) i la llargada dels peus de foto. Cada pàgina té 1 o 2 files;
+# una fila és una foto horitzontal a tot l'ample o fins a 2 verticals una al costat de l'altra (fins a 4
+# fotos per pàgina). L'ordre de les fotos no canvia mai: és un "next-fit" seqüencial.
+REPORT_BODY_W_CM = REPORT_PAGE_W_CM - 2 * REPORT_MARGIN_CM
+REPORT_BODY_H_CM = 24.2  # Alçada pàgina - marges - capçalera amb logo i peu
+REPORT_PHOTO_W_CM = 16.5
+REPORT_ROW_SEP_CM = 0.5  # Separador entre files + marge de seguretat
+REPORT_CELL_PAD_CM = 0.4  # Marges interiors de la cel·la quan n'hi ha dues per fila
+REPORT_PAGE_MAX_PHOTOS = 4
+REPORT_PAIR_CAPTION_MAX_CM = 2.5  # Peus més llargs no caben bé a mitja pàgina: la vertical va sola a la fila
+
+def caption_height_cm(description, width_cm):
+    """Alçada aproximada del peu de foto (Arial, ~0.5 em per caràcter, interlineat 1.2) + espai sota la foto."""
+    size_pt = caption_font_size(description)
+    text_len = len("Fotografia núm. 000: ") + len(description)
+    chars_per_line = max(1, int(width_cm / (size_pt * 0.5 * 0.0353)))
+    lines = -(-text_len // chars_per_line)
+    return lines * size_pt * 1.2 * 0.0353 + 0.15
+
+def fit_photo(size_px, max_w_cm, max_h_cm):
+    w, h = size_px
+    aspect = w / h if h else 1
+    final_w, final_h = max_w_cm, max_w_cm / aspect
+    if final_h > max_h_cm:
+        final_h = max_h_cm
+        final_w = final_h * aspect
+    return round(final_w, 3), round(final_h, 3)
+
+def plan_report_layout(sizes, descriptions):
+    """Reparteix les fotos en pàgines. sizes: [(w, h)] en píxels; descriptions: [str] en el mateix ordre.
+    Retorna [[fila, ...], ...] per pàgina, on cada fila és [(índex, (w_cm, h_cm)), ...]."""
+    half_w = (REPORT_BODY_W_CM - 2 * REPORT_CELL_PAD_CM) / 2
+    is_portrait = [h > w for w, h in sizes]
+
+    def row_width(row): return REPORT_PHOTO_W_CM if len(row) == 1 else half_w
+    def row_caption(row): return max(caption_height_cm(descriptions[i], row_width(row)) for i in row)
+    def row_height(row, max_h):
+        return max(fit_photo(sizes[i], row_width(row), max_h)[1] for i in row) + row_caption(row)
+
+    rows, i = [], 0
+    while i < len(sizes):
+        pair = [i, i + 1]
+        if (i + 1 < len(sizes) and is_portrait[i] and is_portrait[i + 1]
+                and row_caption(pair) <= REPORT_PAIR_CAPTION_MAX_CM):
+            rows.append(pair); i += 2
+        else:
+            rows.append([i]); i += 1
+
+    # Dues files per pàgina si caben amb el mínim de 9 cm per foto; si no, la fila va sola
+    pages = []
+    for row in rows:
+        page = pages[-1] if pages else None
+        if (page and len(page) == 1 and len(page[0]) + len(row) <= REPORT_PAGE_MAX_PHOTOS
+                and row_height(page[0], REPORT_PHOTO_MAX_H_CM) + row_height(row, REPORT_PHOTO_MAX_H_CM)
+                + REPORT_ROW_SEP_CM <= REPORT_BODY_H_CM):
+            page.append(row)
+        else:
+            pages.append([row])
+
+    layout = []
+    for page in pages:
+        # Una fila sola ocupa la pàgina (com les verticals soles de l'app antiga); dues, 9 cm cadascuna
+        out = []
+        for row in page:
+            max_h = REPORT_PHOTO_MAX_H_CM if len(page) > 1 else REPORT_BODY_H_CM - row_caption(row) - REPORT_ROW_SEP_CM
+            out.append([(i, fit_photo(sizes[i], row_width(row), max_h)) for i in row])
+        layout.append(out)
+    return layout
+
+class FileImagePart(Part):
+    """Foto de l'informe que es queda al disc: l'escriptor en streaming la copia al zip per blocs."""
+
+    def __init__(self, partname, path, package):
+        super().__init__(partname, CT.JPEG, package=package)
+        self.path = Path(path)
+
+    @property
+    def blob(self):
+        return self.path.read_bytes()  # només si algú desa amb doc.save(); save_docx_streaming no hi passa
+
+def save_docx_streaming(doc, out, chunk_size=1 << 20):
+    """Escriu el paquet DOCX a out (camí o fitxer, també no posicionable) part a part.
+    Les FileImagePart es copien del disc en blocs i sense recomprimir (ZIP_STORED): la memòria
+    no creix amb el nombre de fotos."""
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    for part in parts: part.before_marshal()
+    with ZipFile(out, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob)
+        zf.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        for part in parts:
+            if isinstance(part, FileImagePart):
+                info = ZipInfo(part.partname.membername, date_time=time.localtime()[:6])
+                info.compress_type = ZIP_STORED
+                with open(part.path, "rb") as src, zf.open(info, "w") as dst:
+                    shutil.copyfileobj(src, dst, chunk_size)
+            else:
+                zf.writestr(part.partname.membername, part.blob)
+            if len(part.rels):
+                zf.writestr(part.partname.rels_uri.membername, part.rels.xml)
+
+class ReportDocument:
+    """Un informe obert a partir de la plantilla, amb els fragments de la pàgina de fotos a punt per clonar."""
+
+    def __init__(self, template_bytes):
+        from copy import deepcopy
+        from docx.text.paragraph import Paragraph
+        self._deepcopy, self._Paragraph = deepcopy, Paragraph
+        self.doc = Document(io.BytesIO(template_bytes))
+        body = self.doc.element.body
+        marks = {p.text: p for p in self.doc.paragraphs if p.text in (MARK_COVER, MARK_CLOSING)}
+        self.cover_mark, self.closing_mark = marks[MARK_COVER], marks[MARK_CLOSING]
+
+        # Fragments: taula de foto, separador i paràgraf amb el salt de secció de la pàgina de fotos
+        self.photo_tbl = body.find(qn('w:tbl'))
+        self.sep_p = self.photo_tbl.getnext()
+        self.page_break_p = self.sep_p.getnext()
+        for el in (self.photo_tbl, self.sep_p, self.page_break_p): body.remove(el)
+        # La primera pàgina de fotos defineix la capçalera; les següents hi queden enllaçades
+        self.linked_break_p = deepcopy(self.page_break_p)
+        for ref in self.linked_break_p.xpath('.//w:headerReference | .//w:footerReference'):
+            ref.getparent().remove(ref)
+        placeholder_rid = self.photo_tbl.find('.//' + qn('a:blip')).get(qn('r:embed'))
+        self.doc.part.drop_rel(placeholder_rid)
+        self.next_shape_id = self.doc.part.next_id
+        self.pages = 0
+        self.media = {}  # camí -> rId
+
+    def set_footer(self, nat_code, dil_code):
+        footer = self.doc.sections[0].footer
+        footer.paragraphs[0].runs[0].text = footer_text(nat_code, dil_code)
+
+    def add_cover_paragraph(self, text="", size=None):
+        p = self.cover_mark.insert_paragraph_before(text)
+        if size:
+            p.alignment = Align.CENTER
+            p.runs[0].font.size = Pt(size); p.runs[0].font.name = 'Arial'
+        return p
+
+    def _add_media(self, path):
+        """Relaciona el JPEG del disc amb el document sense carregar-lo (una part per camí)."""
+        key = str(path)
+        if key not in self.media:
+            partname = PackURI(f"/word/media/foto{len(self.media) + 1}.jpg")
+            self.media[key] = self.doc.part.relate_to(FileImagePart(partname, path, self.doc.part.package), RT.IMAGE)
+        return self.media[key]
+
+    def _fill_photo(self, tbl, img_path, photo_num, description, size_cm):
+        final_w, final_h = size_cm
+        cx, cy = int(Cm(final_w)), int(Cm(final_h))
+        rid = self._add_media(img_path)
+        tbl.find('.//' + qn('a:blip')).set(qn('r:embed'), rid)
+        for ext in tbl.xpath('.//wp:extent | .//a:ext'):
+            ext.set('cx', str(cx)); ext.set('cy', str(cy))
+        doc_pr = tbl.find('.//' + qn('wp:docPr'))
+        doc_pr.set('id', str(self.next_shape_id)); doc_pr.set('name', f"Picture {self.next_shape_id}")
+        self.next_shape_id += 1
+
+        caption = self._Paragraph(tbl.findall('.//' + qn('w:p'))[-1], self.doc._body)
+        r1, r2 = caption.runs[:2]
+        if description:
+            font_size = caption_font_size(description)
+            r1.text = f"Fotografia núm. {photo_num}: "; r2.text = description
+            r1.font.size = r2.font.size = Pt(font_size)
+        else:
+            caption.alignment = Align.CENTER
+            r1.text = f"Fotografia núm. {photo_num}"
+            r2._r.getparent().remove(r2._r)
+
+    def _photo_row(self, photos):
+        """Taula d'una fila amb una cel·la per foto: les cel·les de més es treuen de clons del fragment."""
+        tbl = self._deepcopy(self.photo_tbl)
+        self._fill_photo(tbl, *photos[0])
+        if len(photos) > 1:
+            tr, grid = tbl.find(qn('w:tr')), tbl.find(qn('w:tblGrid'))
+            for photo in photos[1:]:
+                extra = self._deepcopy(self.photo_tbl)
+                self._fill_photo(extra, *photo)
+                tr.append(extra.find('.//' + qn('w:tc')))
+                grid.append(self._deepcopy(grid[0]))
+            cell_w = str(int(Cm(REPORT_BODY_W_CM).twips) // len(photos))
+            for el in grid: el.set(qn('w:w'), cell_w)
+            for tc_w in tr.iter(qn('w:tcW')): tc_w.set(qn('w:w'), cell_w)
+        return tbl
+
+    def add_photo_page(self, rows):
+        """rows: 1 o 2 files, cadascuna amb 1 o 2 (img_path, photo_num, description, (w_cm, h_cm))."""
+        for j, photos in enumerate(rows):
+            if j: self.closing_mark._p.addprevious(self._deepcopy(self.sep_p))
+            self.closing_mark._p.addprevious(self._photo_row(photos))
+        self.closing_mark._p.addprevious(self.page_break_p if self.pages == 0 else self._deepcopy(self.linked_break_p))
+        self.pages += 1
+
+    def finish(self):
+        for mark in (self.cover_mark, self.closing_mark):
+            mark._p.getparent().remove(mark._p)
+        return self.doc
+
+# --- REPORT BUILDER ---
+def build_report(sid, sdata, final_descriptions, out_path: Path):
+    """Construeix el DOCX d'una sessió directament a out_path. Retorna (safe_nat, prep_stats).
+
+    Les fotos preparades viuen en un directori de treball al disc i s'escriuen al zip en streaming,
+    de manera que el pic de memòria és d'una foto per fil i no de l'informe sencer."""
+    images_ordered = sdata.get('image_order', [])
+    if not images_ordered:
+        raise ValueError("No s'han trobat imatges per generar l'informe.")
+
+    qualitat = sdata.get('qualitat', 'atenea')
+
+    # Configuració de qualitat
+    target_w, target_h, allow_up, jpg_quality = (2560, 2560, False, 95) if qualitat == 'vector' else (1920, 1080, True, 80)
+
+    print(f"DEBUG: Iniciant processament de {len(images_ordered)} imatges.")
+
+    work_dir = Path(tempfile.mkdtemp(prefix=".work-", dir=out_path.parent))
+    tmp_path = out_path.with_name(f".{out_path.name}.part")
+    try:
+        # Fase de preparació en paral·lel (baixada + descodificació + redimensionat + JPEG)
+        source_hashes = {}
+        valid_images_ordered, processed_images, prep_stats = prepare_report_images(
+            images_ordered, target_w, target_h, allow_up, jpg_quality, work_dir, source_hashes=source_hashes)
+        print(f"REPORT_PREP: sid={sid} {json.dumps(prep_stats)} cache={json.dumps(RENDITION_CACHE.stats())}")
+
+        images_ordered = valid_images_ordered
+        if not images_ordered:
+             raise ValueError("Totes les imatges han fallat al processar-se.")
+
+        print("DEBUG: Generant document DOCX...")
+        sizes = report_photo_sizes(images_ordered, processed_images, sdata.get('image_meta', {}), source_hashes)
+        doc = assemble_report(sdata, images_ordered, processed_images, final_descriptions, sizes=sizes)
+        save_docx_streaming(doc, tmp_path)
+        os.replace(tmp_path, out_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    nat_code = sdata.get('nat', 'SENSE DADES')
+    safe_nat = nat_code.replace('/', '_') if nat_code else "SENSE_NAT"
+    return safe_nat, prep_stats
+
+def assemble_report(sdata, images_ordered, processed_images, final_descriptions, sizes=None):
+    """Munta el DOCX sobre la plantilla amb els JPEG ja preparats al disc (mateix ordre que images_ordered).
+    sizes: mides en píxels de cada foto (índex de metadades); sense, es llegeixen les capçaleres."""
+    nat_code = sdata.get('nat', 'SENSE DADES')
+    dil_code = sdata.get('dil', 'SENSE DADES')
+    tip1 = sdata.get('tip1', '')
+    tip2 = sdata.get('tip2', '')
+    jutjat = sdata.get('jutjat', 'Jutjat desconegut')
+    localitat = sdata.get('localitat', 'Localitat desconeguda')
+    qualitat = sdata.get('qualitat', 'atenea')
+
+    report = ReportDocument(get_report_template())
+    doc = report.doc
+    report.set_footer(nat_code, dil_code)
+
+    report.add_cover_paragraph("\n"); report.add_cover_paragraph("Informe Fotogràfic", 33)
+    report.add_cover_paragraph() # Espai doble
+
+    unit_name = "Unitat d'Investigació d'Accidents de Trànsit" if qualitat == 'atenea' else "Unitat d'Atestats de Trànsit"
+
+    lines = []
+    if nat_code or dil_code:
+        parts = []
+        if qualitat == 'vector':
+            if dil_code: parts.append(f"Dil. {dil_code}")
+            if nat_code: parts.append(f"NAT {nat_code}")
+        else:
+            if nat_code: parts.append(f"NAT {nat_code}")
+            if dil_code: parts.append(f"Dil. {dil_code}")
+        lines.append(" - ".join(parts))
+
+    lines.extend(["Àrea Regional de Trànsit Metropolitana Nord", unit_name, f"Data d’emissió de l’informe: {datetime.date.today().strftime('%d/%m/%Y')}"])
+    if tip1 or tip2:
+        label = "Núm. de TIP:" if (tip1 and not tip2) or (tip2 and not tip1) else "Núms. de TIP:"
+        lines.append(f"{label} {' - '.join([x for x in [tip1, tip2] if x])}")
+    for txt in lines:
+        report.add_cover_paragraph(txt, 21)
+        report.add_cover_paragraph() # Espai doble
+
+    # Destinació al final de la portada (Protocol oficial)
+    report.add_cover_paragraph("\n")
+    # "La ultima linea la del juzgado un poco más perqueña (2 puntos)" -> 21 - 2 = 19
+    report.add_cover_paragraph(f"S'adreça al {jutjat} de la localitat de {localitat}", 19)
+    report.add_cover_paragraph()
+
+    # Maquetació abans de muntar: només mides (índex o capçaleres JPEG) i llargada dels peus
+    t0 = time.perf_counter()
+    descriptions = [final_descriptions.get(f_name, "") for f_name in images_ordered]
+    if sizes is None: sizes = [read_image_size(p) for p in processed_images]
+    layout = plan_report_layout(sizes, descriptions)
+    print(f"DEBUG: LAYOUT - {len(images_ordered)} fotos en {len(layout)} pàgines ({(time.perf_counter() - t0) * 1000:.1f} ms)")
+
+    # Una pàgina (secció) per entrada de la maquetació, clonada del fragment de la plantilla
+    for page in layout:
+        report.add_photo_page([[(processed_images[i], i + 1, descriptions[i], size_cm) for i, size_cm in row]
+                               for row in page])
+    report.finish()
+
+    # Diligència final
+    doc.add_paragraph(); doc.add_paragraph()
+    hora = datetime.datetime.now().strftime('%H:%M'); dia = datetime.date.today().strftime('%d/%m/%Y')
+    p = doc.add_paragraph(); p.alignment = Align.JUSTIFY
+    titol = "Diligència de Tramesa d'Informe Fotogràfic:"
+    r = p.add_run(titol); r.bold = True; r.font.name = 'Arial'; r.font.size = Pt(12)
+
+    # Total de pàgines reals (Portada + Pàgines de fotos de la maquetació + Pàgina de tancament)
+    total_pages = 1 + len(layout) + 1
+
+    p_txt = f" Que a les {hora} del dia {dia}, es finalitza aquest Informe fotogràfic, el qual consta de {len(images_ordered)} fotografies i un total de {total_pages} pàgines. S'adreça al {jutjat} de la localitat de {localitat}."
+    r_txt = p.add_run(p_txt); r_txt.font.name = 'Arial'; r_txt.font.size = Pt(12)
+    p_c = doc.add_paragraph(); r_c = p_c.add_run("Perque Consti ho Certifico"); r_c.bold=True; r_c.font.size=Pt(12); r_c.font.name = 'Arial'
+    return doc
+
+# --- REPORT JOBS ---
+# La generació de l'informe és una tasca de fons: /create_report retorna un job_id a l'instant,
+# el pool de CPU de fons (BG_CPU) construeix el DOCX i el resultat es desa a REPORTS_DIR (i a GCS reports/).
+# L'estat de cada tasca es desa com a JSON (local + GCS) perquè sobrevisqui a la desconnexió del client.
+REPORT_JOBS_DIR = REPORTS_DIR / "jobs"
+REPORT_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Tasques que executa aquest procés: per a aquestes el JSON local és la font de veritat.
+# Les de la resta d'instàncies es tornen a llegir de GCS mentre no hagin acabat.
+REPORT_JOBS_OWNED = set()
+
+def report_job_settled(job):
+    return job.get('status') in ('done', 'error') and job.get('backup') != 'pending'
+
+def read_report_job_file(local_path):
+    if local_path.exists():
+        try:
+            with open(local_path, 'r') as f: return json.load(f)
+        except: pass
+    return None
+
+def load_report_job(job_id):
+    local_path = REPORT_JOBS_DIR / f"{job_id}.json"
+    job = read_report_job_file(local_path)
+    if IS_PROD and job_id not in REPORT_JOBS_OWNED and (job is None or not report_job_settled(job)):
+        if storage_download(f"reports/jobs/{job_id}.json", local_path):
+            job = read_report_job_file(local_path)
+    return job
+
+def save_report_job(job):
+    local_path = REPORT_JOBS_DIR / f"{job['id']}.json"
+    tmp_path = local_path.with_name(f".{local_path.name}.part")
+    with open(tmp_path, 'w') as f: json.dump(job, f)
+    os.replace(tmp_path, local_path)
+    storage_save(local_path, f"reports/jobs/{job['id']}.json")
+
+def run_report_job(job, sdata, final_descriptions):
+    job.update(status='running', started_at=time.time())
+    save_report_job(job)
+    try:
+        out_path = REPORTS_DIR / f"{job['id']}.docx"
+        safe_nat, prep_stats = build_report(job['sid'], sdata, final_descriptions, out_path)
+        gcs_path = f"reports/Informe_{safe_nat}_{job['id']}.docx"
+        # El fitxer ja es pot descarregar: la còpia a GCS es fa en segon pla des del mateix fitxer.
+        # Es fixa abans de comptar-lo a la cache: si l'informe sol ja passa del límit, admit l'esborraria
+        if IS_PROD: LOCAL_CACHE.pin([out_path])
+        LOCAL_CACHE.admit(out_path, miss=False)
+        job.update(status='done', finished_at=time.time(), download_name=f"Informe_{safe_nat}.docx",
+                   gcs_path=gcs_path, prep=prep_stats, backup='pending' if IS_PROD else 'local')
+    except Exception as e:
+        traceback.print_exc()
+        print(f"ERROR_CRITIC_DOWNLOAD: {e}")
+        job.update(status='error', finished_at=time.time(), error=str(e))
+    save_report_job(job)
+    if job.get('backup') == 'pending':
+        BG_IO.submit(backup_report, job, out_path)
+
+def backup_report(job, out_path: Path):
+    """Còpia de seguretat de l'informe a reports/ amb pujada resumable.
+
+    El fitxer local queda fixat fins que és a GCS: si la pujada falla, és l'única còpia."""
+    ok = False
+    try:
+        ok = storage_save(out_path, job['gcs_path'], chunk_size=REPORT_UPLOAD_CHUNK_BYTES)
+    finally:
+        if ok: LOCAL_CACHE.unpin([out_path])
+    job['backup'] = 'done' if ok else 'error'
+    save_report_job(job)
+    if ok: print(f"BACKUP_OK: {job['gcs_path']}")
+    else: print(f"ERROR: còpia de l'informe {job['id']} a GCS fallida; es manté fixada a la cache local")
+
 @app.post("/create_report")
 def create_report():
     try:
@@ -837,21 +2727,12 @@ def create_report():
         if form_sid:
             print(f"DEBUG: Forçant sessió amb SID del formulari: {form_sid}")
             session['sid'] = form_sid
+        sid = get_sid()
             
-        sdata = load_gcs_session()
-        
-        images_ordered = sdata.get('image_order', [])
-        if not images_ordered:
+        sdata = load_gcs_session(sid)
+        if not sdata.get('image_order', []):
             return "Error: No s'han trobat imatges per generar l'informe.", 400
 
-        nat_code = sdata.get('nat', 'SENSE DADES')
-        dil_code = sdata.get('dil', 'SENSE DADES')
-        tip1 = sdata.get('tip1', '')
-        tip2 = sdata.get('tip2', '')
-        jutjat = sdata.get('jutjat', 'Jutjat desconegut')
-        localitat = sdata.get('localitat', 'Localitat desconeguda')
-        qualitat = sdata.get('qualitat', 'atenea')
-        
         # Recollir descripcions
         final_descriptions = {}
         for key, value in request.form.items():
@@ -861,216 +2742,19 @@ def create_report():
             
         # Actualitzar sessió (optimitzat: evitem reload)
         sdata['image_descriptions'] = final_descriptions
-        save_gcs_session(sdata)
-
-        # Configuració de qualitat
-        target_w, target_h, allow_up, jpg_quality = (2560, 2560, False, 95) if qualitat == 'vector' else (1920, 1080, True, 80)
-        
-        processed_images = []; valid_images_ordered = []
-        
-        print(f"DEBUG: Iniciant processament de {len(images_ordered)} imatges.")
-        
-        for idx, name in enumerate(images_ordered):
-            print(f"DEBUG: Processant imatge {idx+1}/{len(images_ordered)}: {name}")
-            try:
-                p_edit, p_master, p_work = EDITED_DIR/name, MASTER_DIR/name, WORK_DIR/name
-                
-                # Descarregar si és necessari (amb retry implícit per lògica visual)
-                if IS_PROD:
-                    # Optimització: Només baixar el que necessitem si ja existeix
-                    found = False
-                    if p_edit.exists(): found = True
-                    elif storage_download(f"uploads/edited/{name}", p_edit): found = True
-                    
-                    if not found:
-                         if p_master.exists(): found = True
-                         elif storage_download(f"uploads/master/{name}", p_master): found = True
-                    
-                    if not found:
-                         if not p_work.exists(): storage_download(f"uploads/work/{name}", p_work)
-    
-                src_path = p_edit if p_edit.exists() else (p_master if p_master.exists() else (p_work if p_work.exists() else None))
-                
-                if src_path:
-                    with Image.open(src_path) as img:
-                        if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
-                        img2 = resize_to_box(img, target_w, target_h, allow_upscale=allow_up)
-                        buffer = io.BytesIO()
-                        img2.save(buffer, format='JPEG', quality=jpg_quality, optimize=True)
-                        buffer.seek(0)
-                        processed_images.append(buffer)
-                        valid_images_ordered.append(name)
-                else:
-                    print(f"ADVERTÈNCIA: No s'ha trobat cap arxiu font per a {name}")
-            except Exception as e:
-                print(f"ERROR processant imatge {name}: {e}")
-                
-        images_ordered = valid_images_ordered
-        if not images_ordered:
-             return "Error: Totes les imatges han fallat al processar-se.", 500
-        
-        print("DEBUG: Generant document DOCX...")
-        doc = Document()
-        # ... (rest of document generation logic stays similar but ensured inside try) ...
-        # [REPEATING DOX GENERATION LOGIC TO ENSURE SCOPE IS CORRECT]
-        # Marges "Estirats" (més estrets per aprofitar espai)
-        margin_cm = 1.0 
-        page_h_cm, page_w_cm = 29.7, 21.0
-        
-        sec_titol = doc.sections[0]
-        sec_titol.different_first_page_header_footer = False
-        sec_titol.page_height = Cm(page_h_cm); sec_titol.page_width = Cm(page_w_cm)
-        sec_titol.top_margin = Cm(margin_cm); sec_titol.bottom_margin = Cm(margin_cm)
-        sec_titol.left_margin = Cm(margin_cm); sec_titol.right_margin = Cm(margin_cm)
-        
-        # 1. Logo Capçalera (Petit) - NOMÉS definim aquí la capçalera principal (pàgines següents)
-        # La portada NO tindrà logo a la capçalera (perquè ja en té un de gran)
-        # Per fer-ho, NO cridem add_logo_to_header aquí, sinó que confiem en el loop principal per a les seccions noves.
-        # Però la primera secció (sec_titol) és la portada. 
-        # Simplement NO fem add_logo_to_header(sec_titol.header)
-        
-        create_footer(sec_titol, nat_code, dil_code, qualitat)
-        
-        # 2. Logo Portada (Gran)
-        add_logo_to_body(doc)
-        
-        doc.add_paragraph("\n"); p = doc.add_paragraph("Informe Fotogràfic"); p.alignment = Align.CENTER
-        p.runs[0].font.size = Pt(33); p.runs[0].font.name = 'Arial'
-        doc.add_paragraph() # Espai doble
-        
-        unit_name = "Unitat d'Investigació d'Accidents de Trànsit" if qualitat == 'atenea' else "Unitat d'Atestats de Trànsit"
-        
-        lines = []
-        if nat_code or dil_code:
-            parts = []
-            if qualitat == 'vector':
-                if dil_code: parts.append(f"Dil. {dil_code}")
-                if nat_code: parts.append(f"NAT {nat_code}")
-            else:
-                if nat_code: parts.append(f"NAT {nat_code}")
-                if dil_code: parts.append(f"Dil. {dil_code}")
-            lines.append(" - ".join(parts))
-            
-        lines.extend(["Àrea Regional de Trànsit Metropolitana Nord", unit_name, f"Data d’emissió de l’informe: {datetime.date.today().strftime('%d/%m/%Y')}"])
-        if tip1 or tip2:
-            label = "Núm. de TIP:" if (tip1 and not tip2) or (tip2 and not tip1) else "Núms. de TIP:"
-            lines.append(f"{label} {' - '.join([x for x in [tip1, tip2] if x])}")
-        for txt in lines:
-            p = doc.add_paragraph(txt); p.alignment = Align.CENTER
-            p.runs[0].font.size = Pt(21); p.runs[0].font.name = 'Arial'
-            doc.add_paragraph() # Espai doble
-
-        # Destinació al final de la portada (Protocol oficial)
-        doc.add_paragraph("\n")
-        p_dest = doc.add_paragraph(f"S'adreça al {jutjat} de la localitat de {localitat}"); p_dest.alignment = Align.CENTER
-        # "La ultima linea la del juzgado un poco más perqueña (2 puntos)" -> 21 - 2 = 19
-        p_dest.runs[0].font.size = Pt(19); p_dest.runs[0].font.name = 'Arial'
-        doc.add_paragraph()
-        
-        # Càlcul d'espai útil
-        usable_w_cm = page_w_cm - (margin_cm * 2)
-        # Alçada pàgina (29.7) - Marges (2) - Header/Footer (3.5) = ~24.2cm
-        # Per 2 fotos+text en una pàgina: 9.0cm és el mínim exigit per l'usuari.
-        photo_max_h = 9.0 
-        
-        photo_counter = 1
-        
-        # Iterar de 2 en 2
-        import math
-        total_photos = len(processed_images)
-        chunks = [processed_images[i:i + 2] for i in range(0, len(processed_images), 2)]
-        images_names_chunks = [images_ordered[i:i + 2] for i in range(0, len(images_ordered), 2)]
-        
-        for i, chunk in enumerate(chunks):
-            # Nova pàgina per a cada parell de fotos
-            sec = doc.add_section(WD_SECTION_START.NEW_PAGE)
-            sec.different_first_page_header_footer = False
-            sec.page_height=Cm(page_h_cm); sec.page_width=Cm(page_w_cm)
-            sec.top_margin=Cm(margin_cm); sec.bottom_margin=Cm(margin_cm)
-            sec.left_margin=Cm(margin_cm); sec.right_margin=Cm(margin_cm)
-            
-            # Header i Footer a cada pagina
-            add_logo_to_header(sec.header)
-            create_footer(sec, nat_code, dil_code, qualitat)
-            set_vertical_alignment(sec, 'top') # Alineació superior
-            
-            # Processar les 1 o 2 fotos d'aquest chunk
-            current_names = images_names_chunks[i]
-            
-            for j, img_data in enumerate(chunk):
-                f_name = current_names[j]
-                desc = final_descriptions.get(f_name, "")
-                
-                # Afegir bloc de foto
-                add_photo_block(doc, img_data, photo_counter, usable_w_cm, photo_max_h, desc)
-                photo_counter += 1
-                
-                # Espaiador entre fotos (només si n'hi ha una altra després en la mateixa pàgina)
-                if j == 0 and len(chunk) > 1:
-                    p_sep = doc.add_paragraph()
-                    # Reduïm espai entre fotos per guanyar marge
-                    p_sep.paragraph_format.space_before = Pt(2)
-                    p_sep.paragraph_format.space_after = Pt(2)
-                
-        # Diligència final
-        sec = doc.add_section(WD_SECTION_START.NEW_PAGE)
-        sec.different_first_page_header_footer = False
-        sec.page_height=Cm(page_h_cm); sec.page_width=Cm(page_w_cm)
-        add_logo_to_header(sec.header); sec.footer.is_linked_to_previous=True
-        sec.top_margin=Cm(margin_cm); sec.bottom_margin=Cm(margin_cm)
-        sec.left_margin=Cm(margin_cm); sec.right_margin=Cm(margin_cm)
-        # Alineació vertical superior per a la diligència final
-        set_vertical_alignment(sec, 'top')
-            
-        doc.add_paragraph(); doc.add_paragraph()
-        hora = datetime.datetime.now().strftime('%H:%M'); dia = datetime.date.today().strftime('%d/%m/%Y')
-        p = doc.add_paragraph(); p.alignment = Align.JUSTIFY
-        titol = "Diligència de Tramesa d'Informe Fotogràfic:"
-        r = p.add_run(titol); r.bold = True; r.font.name = 'Arial'; r.font.size = Pt(12)
-        
-        # Calcular total de pàgines reals (Portada + Pàgines de fotos + Pàgina de tancament)
-        photo_pages = (len(processed_images) + 1) // 2
-        total_pages = 1 + photo_pages + 1
-        
-        p_txt = f" Que a les {hora} del dia {dia}, es finalitza aquest Informe fotogràfic, el qual consta de {len(images_ordered)} fotografies i un total de {total_pages} pàgines. S'adreça al {jutjat} de la localitat de {localitat}."
-        r_txt = p.add_run(p_txt); r_txt.font.name = 'Arial'; r_txt.font.size = Pt(12)
-        p_c = doc.add_paragraph(); r_c = p_c.add_run("Perque Consti ho Certifico"); r_c.bold=True; r_c.font.size=Pt(12); r_c.font.name = 'Arial'
-    
-        # Generació Directa en Memòria (Motor Pro)
-        file_stream = io.BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        
-        safe_nat = nat_code.replace('/', '_') if nat_code else "SENSE_NAT"
-        rname_download = f'Informe_{safe_nat}.docx'
-        
-        # Backup a GCS si som a PROD
-        if IS_PROD:
-            try:
-                bucket = get_bucket()
-                if bucket:
-                    unique_id = int(time.time())
-                    blob = bucket.blob(f"reports/Informe_{safe_nat}_{unique_id}.docx")
-                    blob.upload_from_string(file_stream.getvalue(), content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-                    print(f"BACKUP_OK: {safe_nat}_{unique_id}")
-            except Exception as e:
-                print(f"ADVERTÈNCIA: Error backup GCS: {e}")
-    
-        # Retornar el fitxer amb les millors capçaleres de streaming possibles
-        response = make_response(send_file(
-            file_stream,
-            as_attachment=True,
-            download_name=rname_download,
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        ))
-        
-        # Forçar capçaleres per evitar bloquejos de descàrrega
-        response.headers["Content-Disposition"] = f"attachment; filename=\"{rname_download}\""
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        
-        return response
+        update_gcs_session({'image_descriptions': final_descriptions}, sid)
+
+        job = {'id': uuid.uuid4().hex, 'sid': sid, 'status': 'queued', 'created_at': time.time()}
+        REPORT_JOBS_OWNED.add(job['id'])
+        save_report_job(job)
+        if not BG_CPU.try_submit(run_report_job, job, sdata, final_descriptions):
+            # Pool ple: millor que el client ho torni a provar que no pas construir el DOCX dins la petició
+            job.update(status='error', error="Servidor ocupat.")
+            save_report_job(job)
+            REPORT_JOBS_OWNED.discard(job['id'])
+            return jsonify(ok=False, error="Servidor ocupat."), 503, {'Retry-After': str(BG_RETRY_AFTER)}
+        print(f"DEBUG: REPORT_JOB {job['id']} encuat per {sid}")
+        return jsonify(ok=True, job_id=job['id'])
 
     except Exception as e:
         import traceback
@@ -1078,16 +2762,93 @@ def create_report():
         print(f"ERROR_CRITIC_DOWNLOAD: {e}")
         return f"Error en la generació del document: {str(e)}", 500
 
+@app.get("/report_status/<job_id>")
+def report_status(job_id):
+    job = load_report_job(secure_filename(job_id))
+    if not job: return jsonify(ok=False, error="Tasca no trobada."), 404
+    return jsonify(ok=True, status=job['status'], error=job.get('error'), prep=job.get('prep'))
+
+@app.get("/report_download/<job_id>")
+def report_download(job_id):
+    job = load_report_job(secure_filename(job_id))
+    if not job or job.get('status') != 'done':
+        return "Error: L'informe encara no està disponible.", 404
+    out_path = REPORTS_DIR / f"{job['id']}.docx"
+    if not out_path.exists() and not storage_download(job['gcs_path'], out_path):
+        if job.get('backup') == 'pending':
+            # Generat en una altra instància que encara l'està copiant a GCS
+            response = make_response("L'informe s'està desant. Torna-ho a provar en uns segons.", 503)
+            response.headers["Retry-After"] = "2"
+            return response
+        return "Error: No s'ha trobat el fitxer de l'informe.", 404
+
+    rname_download = job['download_name']
+    # send_file des del camí: wsgi.file_wrapper (sendfile) quan el servidor el té, i Range/If-Range (206)
+    response = make_response(send_file(out_path, as_attachment=True, download_name=rname_download,
+                                       mimetype=DOCX_MIMETYPE, conditional=True))
+    # Forçar capçaleres per evitar bloquejos de descàrrega
+    response.headers["Content-Disposition"] = f"attachment; filename=\"{rname_download}\""
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+    prep = job.get('prep') or {}
+    if prep:
+        # Temps de preparació de fotos (paral·lel vs sèrie) per a diagnòstic
+        response.headers["X-Report-Prep"] = f"wall={prep['wall_s']}s; serial={prep['serial_s']}s; workers={prep['workers']}; timed_out={prep['timed_out']}"
+    return response
+
+@app.get("/metrics")
+def metrics():
+    return jsonify(sessions=SESSION_STORE.stats(), renditions=RENDITION_CACHE.stats(), uploads=dict(UPLOAD_METRICS),
+                   captions=CAPTION_CACHE.stats(), storage=storage_stats(),
+                   local_cache=LOCAL_CACHE.stats(), background={ex.name: ex.stats() for ex in BG_EXECUTORS},
+                   status=STATUS_BUS.stats())
+
 @app.get("/status")
 def get_status():
-    sdata = load_gcs_session()
-    return jsonify(status=sdata.get('status_message', 'Processant...'))
+    event, fallback = status_for_run(get_sid(), request.args.get('run'))
+    return jsonify(status=event['status'] if event else fallback)
+
+@app.get("/status_stream")
+def status_stream():
+    sid = get_sid()
+    # Si aquesta instància no porta l'execució, estat actual de la sessió i el client torna al polling
+    first, fallback = status_for_run(sid, request.args.get('run'))
+
+    def stream():
+        if fallback is not None:
+            yield sse_event({'status': fallback, 'seq': 0})
+            if not is_final_status(fallback): yield sse_event({'reason': 'instance'}, event='fallback')
+            return
+        with STATUS_BUS.subscription():
+            yield sse_event(first)
+            if is_final_status(first['status']): return
+            seq, deadline = first['seq'], time.monotonic() + STATUS_STREAM_MAX_S
+            while time.monotonic() < deadline:
+                event = STATUS_BUS.wait(sid, seq, min(STATUS_STREAM_KEEPALIVE, max(0.0, deadline - time.monotonic())))
+                if not event:
+                    yield ": keepalive\n\n"
+                    continue
+                seq = event['seq']
+                if event.get('run') != first.get('run'):
+                    # Ha començat una altra execució per al sid: que el client consulti l'estat
+                    yield sse_event({'reason': 'run'}, event='fallback')
+                    return
+                yield sse_event(event)
+                if is_final_status(event['status']): return
+
+    resp = Response(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 def update_status(message, sid=None):
     print(f"STATUS UPDATE: {message}")
     # Si no passem sid, cridarà get_sid() que fallarà sense context
     # És responsabilitat del caller passar el sid si està en background
+    sid = sid or get_sid()
     update_gcs_session({'status_message': message}, sid=sid)
+    STATUS_BUS.publish(sid, message)
 
 
 
@@ -0,0 +1,329 @@
+# bench.py — Benchmarks locals de les fases pesades de l'app
+# Ús: python bench.py ingest [--photos N]
+#     python bench.py captions [--photos N] [--latency S]
+#     python bench.py sessions [--photos N] [--rtt S]
+#     python bench.py docx [--photos N]
+#     python bench.py docx-mem [--photos N] [--width PX] [--quality Q]
+#     python bench.py orientation [--photos N]
+import argparse, contextlib, io, json, os, resource, sys, time, tempfile
+from multiprocessing import Pool
+from pathlib import Path
+
+from PIL import Image
+
+os.environ.pop("K_SERVICE", None)  # sempre mode local
+
+
+def phone_photo(w=4000, h=3000):
+    """JPEG sintètic de 12 MP amb soroll (comprimeix com una foto real, no com un color pla)."""
+    noise = Image.effect_noise((w // 4, h // 4), 60).convert("RGB").resize((w, h))
+    gradient = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+    buf = io.BytesIO()
+    Image.blend(noise, gradient, 0.5).save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def legacy_ingest(data, out_dir):
+    """Camí anterior de /upload: descodificació completa + dos LANCZOS des de la mida original."""
+    import app
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+        app.resize_to_box(img, 1360, 768).save(out_dir / "work.jpg", format="JPEG", quality=90, optimize=True)
+        app.resize_to_box(img, 1920, 1080).save(out_dir / "master.jpg", format="JPEG", quality=90, optimize=True)
+
+
+def pipeline_ingest(data, out_dir):
+    import app
+    for d in ("MASTER_DIR", "WORK_DIR", "THUMBS_DIR"): setattr(app, d, out_dir)
+    app.ingest_upload(io.BytesIO(data), "bench")
+
+
+def _measure(args):
+    """S'executa en un procés nou perquè el pic de RSS sigui només d'aquest camí."""
+    variant, data, photos = args
+    import app  # noqa: F401  (import fora de la mesura)
+    fn = {"legacy": legacy_ingest, "pipeline": pipeline_ingest}[variant]
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu0 = time.process_time()
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(photos): fn(data, Path(tmp))
+    cpu = (time.process_time() - cpu0) / photos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return variant, cpu, rss0, rss
+
+
+def bench_ingest(photos):
+    data = phone_photo()
+    print(f"Foto sintètica 12 MP: {len(data) / 1048576:.1f} MiB, {photos} repeticions per variant")
+    print(f"{'variant':<10} {'CPU/foto':>10} {'RSS base':>10} {'RSS pic':>10}")
+    for variant in ("legacy", "pipeline"):
+        with Pool(1) as pool:
+            _, cpu, rss0, rss = pool.map(_measure, [(variant, data, photos)])[0]
+        print(f"{variant:<10} {cpu * 1000:>8.0f}ms {rss0 / 1024:>8.0f}MB {rss / 1024:>8.0f}MB")
+
+
+def bench_captions(photos, latency):
+    """Throughput de generate_ai_descriptions amb el model simulat (AI_BACKEND=fake).
+    Cada configuració comença amb la memòria cau de descripcions buida i en un directori temporal."""
+    from concurrent.futures import ThreadPoolExecutor
+    import app
+    app.AI_BACKEND, app.AI_FAKE_LATENCY = "fake", latency
+    app.update_status = lambda msg, sid=None: None
+    with tempfile.TemporaryDirectory() as tmp:
+        app.WORK_DIR = Path(tmp)
+        names = [f"foto_{i}.jpg" for i in range(photos)]
+        # Fotos diferents: si fossin iguals compartirien una sola entrada de la memòria cau
+        for i, n in enumerate(names): Image.new("RGB", (1360, 768), (i % 256, i // 256, 120)).save(app.WORK_DIR / n, format="JPEG")
+        print(f"{photos} fotos, latència simulada {latency}s per imatge")
+        print(f"{'bloc':>5} {'concurrència':>13} {'crides':>7} {'temps':>8}")
+        for chunk, conc in ((photos, 1), (6, 1), (6, 3), (4, 4)):
+            app.CAPTIONS_DIR = Path(tempfile.mkdtemp(dir=tmp))
+            app.CAPTION_CACHE = app.CaptionCache()
+            app.AI_CHUNK_SIZE = chunk
+            app.AI_CHUNK_POOL = ThreadPoolExecutor(max_workers=conc)
+            app.FakeGenerativeModel.calls = []
+            t0 = time.perf_counter()
+            app.generate_ai_descriptions("", names, sid="bench")
+            print(f"{chunk:>5} {conc:>13} {len(app.FakeGenerativeModel.calls):>7} {time.perf_counter() - t0:>7.2f}s")
+
+
+def session_backends(rtt, tmp):
+    """Backends de sessió a comparar: emuladors si hi són (FIRESTORE_EMULATOR_HOST / STORAGE_EMULATOR_HOST),
+    si no, els dobles de prova de tests/ amb una latència fixa per crida."""
+    import app
+    sys.path.insert(0, str(Path(__file__).resolve().parent / "tests"))
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        from google.cloud import storage as gcs
+        bucket = gcs.Client(project="bench").bucket("bench")
+    else:
+        from fake_gcs import FakeBucket
+        bucket = FakeBucket(Path(tmp) / "gcs", latency=rtt)
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        from google.cloud import firestore as gfs
+        client = gfs.Client(project="bench")
+    else:
+        from fake_firestore import FakeFirestore
+        client = FakeFirestore(latency=rtt)
+    app.get_bucket = lambda: bucket
+    return {"gcs": app.GCSSessionBackend(), "firestore": app.FirestoreSessionBackend(client, "bench_sessions")}
+
+
+def bench_sessions(photos, rtt):
+    """Latència per operació de sessió (lectura, revalidació, escriptura, conflicte) per backend."""
+    import uuid
+    import app
+    app.IS_PROD, app.SESSION_CACHE_TTL = True, 0
+    names = [f"foto_{i}.jpg" for i in range(photos)]
+    scene = {"nat": "1/2026", "image_order": names, "latest_uploads": names, "status_message": "inici",
+             "upload_keys": {f"k{i}": n for i, n in enumerate(names)},
+             "image_descriptions": {n: "Vista general del vehicle amb danys a la part frontal. " * 3 for n in names}}
+
+    def timed(fn, reps=5):
+        with contextlib.redirect_stdout(io.StringIO()):  # sense els DEBUG de l'app dins la taula
+            t0 = time.perf_counter()
+            for _ in range(reps): fn()
+            return (time.perf_counter() - t0) / reps * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.SESSIONS_DIR = Path(tmp)
+        print(f"Sessió de {photos} fotos ({len(json.dumps(scene)) / 1024:.1f} KiB), RTT simulat {rtt * 1000:.0f} ms")
+        print(f"{'backend':<10} {'lectura':>9} {'revalidar':>10} {'estat':>9} {'desc.':>9} {'conflicte':>10}")
+        for name, backend in session_backends(rtt, tmp).items():
+            sid = str(uuid.uuid4())
+            writer = app.SessionStore(backend); writer.put(sid, scene); writer.flush()
+            read = timed(lambda: app.SessionStore(backend).get(sid))
+            warm = app.SessionStore(backend); warm.get(sid)
+            revalidate = timed(lambda: warm.get(sid))
+            status = timed(lambda: (writer.patch(sid, app.SessionPatch().set("status_message", "Processant...")),
+                                    writer.flush()))
+            desc = timed(lambda: (writer.patch(sid, app.SessionPatch().set_item("image_descriptions", names[0], "Nova")),
+                                  writer.flush()))
+            other = app.SessionStore(backend); other.get(sid)
+
+            def conflict():
+                writer.patch(sid, app.SessionPatch().append_unique("image_order", [f"{uuid.uuid4().hex}.jpg"]))
+                other.patch(sid, app.SessionPatch().set("status_message", "altra instància"))
+                other.flush(); writer.flush()
+            race = timed(conflict)
+            print(f"{name:<10} {read:>7.1f}ms {revalidate:>8.1f}ms {status:>7.1f}ms {desc:>7.1f}ms {race:>8.1f}ms")
+
+
+def scratch_report(app, sdata, buffers, descs):
+    """Muntatge sense plantilla (com abans): totes les seccions, peus i blocs de foto des de Document()."""
+    doc = app.Document()
+    app.setup_report_page(doc.sections[0])
+    app.create_footer(doc.sections[0], sdata["nat"], sdata["dil"])
+    app.add_logo_to_body(doc)
+    for i in range(0, len(buffers), 2):
+        sec = doc.add_section(app.WD_SECTION_START.NEW_PAGE)
+        app.setup_report_page(sec, 'top')
+        if i == 0: app.add_logo_to_header(sec.header)
+        for j, buf in enumerate(buffers[i:i + 2]):
+            app.add_photo_block(doc, buf, i + j + 1, 19.0, app.REPORT_PHOTO_MAX_H_CM, descs[i + j])
+            if j == 0: doc.add_paragraph()
+    return doc
+
+
+def bench_docx(photos):
+    """Temps de muntatge del DOCX (sense preparar imatges): plantilla vs des de zero, i part d'incrustació."""
+    import app
+    with tempfile.TemporaryDirectory() as tmp:
+        paths, names = write_photos(Path(tmp), photos, 1920, 80), [f"foto_{i}.jpg" for i in range(photos)]
+        buffers = [io.BytesIO(p.read_bytes()) for p in paths]
+        descs = ["Vista general del vehicle amb danys a la part frontal. " * 3] * photos
+        sdata = {"nat": "1/2026", "dil": "9", "image_order": names}
+        app.get_report_template()  # es prepara un cop per procés, fora de la mesura
+
+        embed = [0.0]
+        def timed(owner, attr):
+            real = getattr(owner, attr)
+            def wrapper(*a, **k):
+                t0 = time.perf_counter()
+                try: return real(*a, **k)
+                finally: embed[0] += time.perf_counter() - t0
+            setattr(owner, attr, wrapper)
+        from docx.parts.story import StoryPart
+        timed(StoryPart, "get_or_add_image"); timed(app.ReportDocument, "_add_media")
+
+        print(f"{photos} fotos 1920x1080 ({sum(p.stat().st_size for p in paths) / 1048576:.1f} MiB de JPEG)")
+        print(f"{'muntatge':<10} {'total':>8} {'incrustar':>10} {'XML':>8}")
+        for name, build in (("des de zero", lambda: scratch_report(app, sdata, buffers, descs)),
+                            ("plantilla", lambda: app.assemble_report(sdata, names, paths, dict(zip(names, descs))))):
+            runs = []
+            for _ in range(3):
+                embed[0] = 0.0
+                with contextlib.redirect_stdout(io.StringIO()):
+                    t0 = time.perf_counter(); build(); total = time.perf_counter() - t0
+                runs.append((total, embed[0]))
+            total, emb = min(runs)
+            print(f"{name:<10} {total * 1000:>6.0f}ms {emb * 1000:>8.0f}ms {(total - emb) * 1000:>6.0f}ms")
+
+
+def write_photos(out_dir, photos, width, quality):
+    """Fotos ja preparades per a l'informe (JPEG amb soroll, 16:9) escrites a out_dir."""
+    paths = []
+    for i in range(photos):
+        p = out_dir / f"{i:04d}.jpg"
+        Image.effect_noise((width, width * 9 // 16), 40 + i % 20).convert("RGB").save(p, format="JPEG", quality=quality)
+        paths.append(p)
+    return paths
+
+
+def _measure_docx(args):
+    """Pic de RSS de desar un informe: buffers en memòria + doc.save() vs camins al disc + streaming."""
+    variant, photo_dir = args
+    import app
+    paths = sorted(Path(photo_dir).glob("*.jpg"))
+    names = [p.name for p in paths]
+    sdata = {"nat": "1/2026", "dil": "9", "image_order": names}
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.get_report_template()
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        out = Path(tmp) / "informe.docx"
+        if variant == "memòria":
+            buffers = [io.BytesIO(p.read_bytes()) for p in paths]
+            scratch_report(app, sdata, buffers, [""] * len(paths)).save(str(out))
+        else:
+            app.save_docx_streaming(app.assemble_report(sdata, names, paths, {}), out)
+        size = out.stat().st_size
+    return variant, time.perf_counter() - t0, rss0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, size
+
+
+def bench_docx_memory(photos, width, quality):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_photos(Path(tmp), photos, width, quality)
+        print(f"{photos} fotos {width}px q{quality} ({sum(p.stat().st_size for p in paths) / 1048576:.0f} MiB de JPEG)")
+        print(f"{'variant':<10} {'temps':>8} {'RSS base':>10} {'RSS pic':>10} {'DOCX':>8}")
+        for variant in ("memòria", "streaming"):
+            with Pool(1) as pool:
+                _, secs, rss0, rss, size = pool.map(_measure_docx, [(variant, tmp)])[0]
+            print(f"{variant:<10} {secs:>7.2f}s {rss0 / 1024:>8.0f}MB {rss / 1024:>8.0f}MB {size / 1048576:>6.0f}MB")
+
+
+def oriented_phone_photo(orientation):
+    """Foto de 12 MP dreta (quadrant superior esquerre vermell) desada com la guarda el mòbil: píxels
+    girats + etiqueta Orientation, amb data, càmera i GPS a l'EXIF."""
+    upright = Image.open(io.BytesIO(phone_photo()))
+    upright.paste((255, 0, 0), (0, 0, upright.width // 2, upright.height // 2))
+    undo = {6: Image.Transpose.ROTATE_90, 8: Image.Transpose.ROTATE_270, 3: Image.Transpose.ROTATE_180}.get(orientation)
+    raw = upright.transpose(undo) if undo is not None else upright
+    exif = Image.Exif()
+    exif[0x0112], exif[0x010F], exif[0x0110], exif[0x0132] = orientation, "Phone", "Model X", "2026:03:14 09:26:53"
+    exif.get_ifd(0x8769)[0x9003] = "2026:03:14 09:26:53"
+    exif.get_ifd(0x8825).update({1: "N", 2: (41.0, 32.0, 10.5), 3: "E", 4: (2.0, 26.0, 41.2)})
+    buf = io.BytesIO()
+    raw.save(buf, format="JPEG", quality=92, exif=exif)
+    return buf.getvalue()
+
+
+def bench_orientation(photos):
+    """Per cas d'orientació EXIF: si la foto queda dreta, quantes edicions (/save_edit) calen per redreçar-la,
+    bytes que puja cada edició (JPEG 0.92 del canvas) i bytes de les derivades (EXIF fora o conservat)."""
+    import app
+
+    def upright(path):
+        with Image.open(path) as im:
+            return im.width > im.height and im.getpixel((im.width // 8, im.height // 8))[0] > 200
+
+    def edit_bytes(path):
+        with Image.open(path) as im:  # el que puja edit.html després de girar-la: JPEG 0.92 a mida de work
+            fixed = im.transpose(Image.Transpose.ROTATE_90) if im.height > im.width else im.transpose(Image.Transpose.ROTATE_180)
+            buf = io.BytesIO(); fixed.save(buf, format="JPEG", quality=92)
+            return len(buf.getvalue())
+
+    variants = {"sense EXIF": dict(EXIF_TRANSPOSE={}, EXIF_SWAPS_AXES=(), UPLOAD_EXIF="strip"),
+                "strip": dict(UPLOAD_EXIF="strip"), "keep": dict(UPLOAD_EXIF="keep")}
+    print(f"{photos} fotos de 12 MP per cas; 'sense EXIF' és la ingesta anterior (edicions = pujades /save_edit per redreçar-les)")
+    print(f"{'cas':>4} {'variant':<11} {'dreta':>6} {'edicions':>9} {'KiB edició':>11} "
+          f"{'master':>8} {'work':>7} {'thumb':>6} {'ingesta':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for d in ("MASTER_DIR", "WORK_DIR", "THUMBS_DIR"):
+            (Path(tmp) / d).mkdir(); setattr(app, d, Path(tmp) / d)
+        for orientation in (1, 3, 6, 8):
+            data = oriented_phone_photo(orientation)
+            for name, overrides in variants.items():
+                saved = {k: getattr(app, k) for k in overrides}
+                for k, v in overrides.items(): setattr(app, k, v)
+                try:
+                    t0 = time.perf_counter()
+                    for _ in range(photos): paths, _, _ = app.ingest_upload(io.BytesIO(data), "bench")
+                    ms = (time.perf_counter() - t0) / photos * 1000
+                finally:
+                    for k, v in saved.items(): setattr(app, k, v)
+                ok = upright(paths["master"])
+                edits = 0 if ok else photos
+                kib = {k: p.stat().st_size / 1024 for k, p in paths.items()}
+                print(f"{orientation:>4} {name:<11} {'sí' if ok else 'no':>6} {edits:>9} "
+                      f"{(edit_bytes(paths['work']) / 1024 * edits if edits else 0):>11.0f} "
+                      f"{kib['master']:>8.0f} {kib['work']:>7.0f} {kib['thumb']:>6.0f} {ms:>6.0f}ms")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_ingest = sub.add_parser("ingest", help="CPU i pic de RSS per foto de 12 MP a /upload")
+    p_ingest.add_argument("--photos", type=int, default=3)
+    p_captions = sub.add_parser("captions", help="Throughput de la generació de descripcions (model simulat)")
+    p_captions.add_argument("--photos", type=int, default=24)
+    p_captions.add_argument("--latency", type=float, default=0.1, help="segons simulats per imatge")
+    p_sessions = sub.add_parser("sessions", help="Latència per operació dels backends de sessió (GCS vs Firestore)")
+    p_sessions.add_argument("--photos", type=int, default=40)
+    p_sessions.add_argument("--rtt", type=float, default=0.02, help="segons simulats per crida remota")
+    p_docx = sub.add_parser("docx", help="Temps de muntatge del DOCX: plantilla vs des de zero")
+    p_docx.add_argument("--photos", type=int, default=60)
+    p_docx_mem = sub.add_parser("docx-mem", help="Pic de RSS en desar l'informe: en memòria vs streaming")
+    p_docx_mem.add_argument("--photos", type=int, default=80)
+    p_docx_mem.add_argument("--width", type=int, default=2560)
+    p_docx_mem.add_argument("--quality", type=int, default=95)
+    p_orient = sub.add_parser("orientation", help="Fotos girades per EXIF: edicions evitades i bytes per cas")
+    p_orient.add_argument("--photos", type=int, default=3)
+    args = parser.parse_args()
+    if args.cmd == "ingest": bench_ingest(args.photos)
+    elif args.cmd == "captions": bench_captions(args.photos, args.latency)
+    elif args.cmd == "sessions": bench_sessions(args.photos, args.rtt)
+    elif args.cmd == "docx": bench_docx(args.photos)
+    elif args.cmd == "docx-mem": bench_docx_memory(args.photos, args.width, args.quality)
+    elif args.cmd == "orientation": bench_orientation(args.photos)
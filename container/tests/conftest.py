@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import app  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    root = tmp_path / "renditions"; root.mkdir()
+    monkeypatch.setattr(app, "RENDITION_CACHE", app.RenditionCache(root, 10 * 1024 * 1024))
+    monkeypatch.setattr(app, "CAPTION_CACHE", app.CaptionCache())
+    return app.RENDITION_CACHE
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for name in ("MASTER_DIR", "WORK_DIR", "EDITED_DIR", "THUMBS_DIR", "CAPTIONS_DIR", "SESSIONS_DIR", "REPORTS_DIR", "REPORT_JOBS_DIR"):
+        d = tmp_path / name.lower(); d.mkdir()
+        monkeypatch.setattr(app, name, d)
+    app.app.config["TESTING"] = True
+    with app.app.test_client() as c:
+        with c.session_transaction() as s: s["authenticated"] = True
+        yield c
@@ -0,0 +1,104 @@
+"""Firestore fals en memòria: documents, update_time, precondicions i transformacions d'ArrayUnion/ArrayRemove/DELETE_FIELD."""
+import copy
+import datetime
+import threading
+import time
+
+from google.cloud.firestore import ArrayRemove, ArrayUnion, DELETE_FIELD
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import Conflict, FailedPrecondition, NotFound
+
+
+class LastUpdateOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class Snapshot:
+    def __init__(self, data, update_time):
+        self._data, self.update_time = data, update_time
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocRef:
+    def __init__(self, db, path):
+        self.db, self.path = db, path
+
+    def get(self):
+        self.db._rpc("get", self.path)
+        with self.db.lock:
+            data, ts = self.db.docs.get(self.path, (None, None))
+            return Snapshot(copy.deepcopy(data), ts)
+
+    def set(self, data):
+        self.db._rpc("set", self.path, data)
+        with self.db.lock:
+            self.db.docs[self.path] = (copy.deepcopy(data), self.db._tick())
+            return WriteResult(self.db.docs[self.path][1])
+
+    def create(self, data):
+        self.db._rpc("create", self.path, data)
+        with self.db.lock:
+            if self.path in self.db.docs: raise Conflict(f"{self.path} ja existeix")
+            self.db.docs[self.path] = (copy.deepcopy(data), self.db._tick())
+            return WriteResult(self.db.docs[self.path][1])
+
+    def update(self, updates, option=None):
+        self.db._rpc("update", self.path, {k: getattr(v, "values", v) for k, v in updates.items() if v is not DELETE_FIELD})
+        with self.db.lock:
+            if self.path not in self.db.docs: raise NotFound(self.path)
+            if option is not None and self.db.docs[self.path][1] != option.last_update_time:
+                raise FailedPrecondition(f"{self.path} ha canviat")
+            data = copy.deepcopy(self.db.docs[self.path][0])
+            for key, value in updates.items():
+                *parents, leaf = FieldPath.from_string(key).parts
+                target = data
+                for part in parents: target = target.setdefault(part, {})
+                if value is DELETE_FIELD: target.pop(leaf, None)
+                elif isinstance(value, ArrayUnion):
+                    current = target.setdefault(leaf, [])
+                    current.extend(v for v in value.values if v not in current)
+                elif isinstance(value, ArrayRemove):
+                    target[leaf] = [v for v in target.get(leaf, []) if v not in value.values]
+                else: target[leaf] = copy.deepcopy(value)
+            self.db.docs[self.path] = (data, self.db._tick())
+            return WriteResult(self.db.docs[self.path][1])
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db, self.name = db, name
+
+    def document(self, doc_id):
+        return FakeDocRef(self.db, f"{self.name}/{doc_id}")
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.docs, self.calls, self.lock, self.latency = {}, [], threading.Lock(), latency
+        self._clock = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def _tick(self):
+        self._clock += datetime.timedelta(microseconds=1)
+        return self._clock
+
+    def _rpc(self, op, path, payload=None):
+        with self.lock: self.calls.append((op, path, payload))
+        if self.latency: time.sleep(self.latency)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def write_option(self, last_update_time):
+        return LastUpdateOption(last_update_time)
+
+    def ops(self, op):
+        return [(p, payload) for o, p, payload in self.calls if o == op]
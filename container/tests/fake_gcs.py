@@ -0,0 +1,82 @@
+"""Bucket GCS fals sobre un directori local, amb generacions i comptadors de crides."""
+import shutil
+import time
+from pathlib import Path
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket, self.name = bucket, name
+        self.generation = bucket.generations.get(name)
+
+    @property
+    def _path(self):
+        return self.bucket.root / self.name
+
+    def _count(self, op):
+        with self.bucket.lock: self.bucket.calls.append((op, self.name))
+        if self.bucket.latency: time.sleep(self.bucket.latency)
+
+    def exists(self, **kwargs):
+        self._count("exists")
+        return self._path.exists()
+
+    def _bump(self, if_generation_match=None):
+        with self.bucket.lock:
+            current = self.bucket.generations.get(self.name, 0)
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"{self.name}: generation {current} != {if_generation_match}")
+            self.generation = self.bucket.generations[self.name] = current + 1
+
+    def _check(self, if_generation_match):
+        if if_generation_match is not None and self.bucket.generations.get(self.name, 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+
+    def upload_from_filename(self, filename, if_generation_match=None, **kwargs):
+        self._count("upload")
+        self._check(if_generation_match)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(filename, self._path); self._bump()
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        self._count("upload")
+        self._check(if_generation_match)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.write_bytes(data.encode() if isinstance(data, str) else data); self._bump(if_generation_match)
+
+    def download_to_filename(self, filename, **kwargs):
+        self._count("download")
+        if not self._path.exists(): raise NotFound(self.name)
+        shutil.copyfile(self._path, filename)
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs):
+        self._count("download")
+        self._check(if_generation_match)
+        if not self._path.exists(): raise NotFound(self.name)
+        return self._path.read_bytes()
+
+
+class FakeBucket:
+    def __init__(self, root: Path, latency=0.0):
+        import threading
+        self.root, self.generations, self.calls, self.lock = Path(root), {}, [], threading.Lock()
+        self.latency = latency
+        self.chunk_sizes = {}  # nom -> chunk_size de l'últim bucket.blob() (pujada resumable si n'hi ha)
+
+    def blob(self, name, chunk_size=None):
+        with self.lock: self.chunk_sizes[name] = chunk_size
+        return FakeBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        with self.lock: self.calls.append(("stat", name))
+        if self.latency: time.sleep(self.latency)
+        return FakeBlob(self, name) if (self.root / name).exists() else None
+
+    def put(self, name, data: bytes):
+        self.blob(name).upload_from_string(data)
+        with self.lock: self.calls.clear()
+
+    def ops(self, op):
+        return [n for o, n in self.calls if o == op]
@@ -0,0 +1,82 @@
+import io
+
+from PIL import Image
+
+import app
+
+
+def make_work_images(n):
+    names = []
+    for i in range(n):
+        name = f"foto_{i}.jpg"
+        Image.new("RGB", (640, 480), (i * 20, 0, 0)).save(app.WORK_DIR / name, format="JPEG")
+        names.append(name)
+    return names
+
+
+def fake_backend(monkeypatch, fail_models=(), chunk_size=2, latency=0.01):
+    monkeypatch.setattr(app, "AI_BACKEND", "fake")
+    monkeypatch.setattr(app, "AI_FAKE_LATENCY", latency)
+    monkeypatch.setattr(app, "AI_FAKE_FAIL_MODELS", list(fail_models))
+    monkeypatch.setattr(app, "AI_CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr(app.FakeGenerativeModel, "calls", [])
+    statuses = []
+    monkeypatch.setattr(app, "update_status", lambda msg, sid=None: statuses.append(msg))
+    return statuses
+
+
+def test_chunks_merge_and_report_progress(client, monkeypatch):
+    statuses = fake_backend(monkeypatch)
+    names = make_work_images(5)
+
+    descs = app.generate_ai_descriptions("Col·lisió frontal", names, sid="x")
+
+    assert sorted(descs) == names
+    assert sorted(len(n) for _, n in app.FakeGenerativeModel.calls) == [1, 2, 2]
+    assert statuses[-1].endswith("(3/3 blocs)...")
+
+
+def test_failed_chunks_fall_back_down_the_model_chain(client, monkeypatch):
+    fake_backend(monkeypatch, fail_models=["gemini-3-flash-preview"])
+    names = make_work_images(4)
+
+    descs = app.generate_ai_descriptions("", names, sid="x")
+
+    assert all("gemini-2.0-flash" in descs[n] for n in names)
+    models = [m for m, _ in app.FakeGenerativeModel.calls]
+    assert models.count("gemini-3-flash-preview") == 2 and models.count("gemini-2.0-flash") == 2
+    assert "gemini-1.5-flash" not in models
+
+
+def test_caption_cache_only_sends_new_or_edited_photos(client, monkeypatch):
+    fake_backend(monkeypatch)
+    names = make_work_images(4)
+    first = app.generate_ai_descriptions("Relat", names, sid="x")
+
+    app.FakeGenerativeModel.calls = []
+    Image.new("RGB", (640, 480), (0, 0, 255)).save(app.EDITED_DIR / names[2], format="JPEG")
+    second = app.generate_ai_descriptions("Relat", list(reversed(names)), sid="x")
+
+    assert [n for _, batch in app.FakeGenerativeModel.calls for n in batch] == [names[2]]
+    assert second == first
+    assert app.CAPTION_CACHE.stats() == {"hits": 3, "misses": 5}
+
+    app.FakeGenerativeModel.calls = []
+    app.generate_ai_descriptions("Un altre relat", names, sid="x")  # prompt diferent
+    assert sum(len(b) for _, b in app.FakeGenerativeModel.calls) == 4
+
+
+def test_input_prep_encodes_duplicates_once_and_aggregates_progress(client, monkeypatch):
+    statuses = fake_backend(monkeypatch)
+    monkeypatch.setattr(app, "AI_PROGRESS_INTERVAL", 60)
+    names = make_work_images(3)
+    (app.WORK_DIR / "copia.jpg").write_bytes((app.WORK_DIR / names[0]).read_bytes())
+    encoded = []
+    real_encode = app.encode_ai_image
+    monkeypatch.setattr(app, "encode_ai_image", lambda p: encoded.append(p.name) or real_encode(p))
+
+    prepared, hashes, cached = app.prepare_ai_inputs(names + ["copia.jpg"], "prompt", ["m"], sid="x")
+
+    assert [f for f, _ in prepared] == names + ["copia.jpg"]
+    assert prepared[0][1] == prepared[3][1] and len(encoded) == 3
+    assert [m for m in statuses if m.startswith("Processant")] == ["Processant imatges (1/4)...", "Processant imatges (4/4)..."]
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import app
+
+
+def test_full_pool_applies_backpressure_then_runs_inline():
+    ex = app.BoundedExecutor("t", workers=1, max_queue=1, submit_timeout=0.2)
+    gate = threading.Event()
+    ran_in = []
+
+    ex.submit(gate.wait)
+    ex.submit(gate.wait)
+    t0 = time.perf_counter()
+    fut = ex.submit(lambda: ran_in.append(threading.current_thread().name))
+
+    assert time.perf_counter() - t0 >= 0.2  # ha esperat un lloc abans de fer-ho ell mateix
+    assert fut.done() and ran_in == [threading.current_thread().name]
+    stats = ex.stats()
+    assert (stats["pending"], stats["running"], stats["queued"], stats["ran_inline"]) == (2, 1, 1, 1)
+    gate.set(); ex.drain(1)
+
+
+def test_drain_waits_for_pending_uploads_and_closes():
+    ex = app.BoundedExecutor("t", workers=2, max_queue=8, submit_timeout=1)
+    done = []
+    for i in range(5): ex.submit(lambda i=i: (time.sleep(0.05), done.append(i)))
+
+    assert ex.drain(2) == 0
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    late = ex.submit(done.append, 99)  # ja tancat: s'executa al fil de qui envia
+    assert late.done() and done[-1] == 99
+    assert ex.stats()["completed"] == 6 and ex.stats()["closed"]
+
+
+def test_failures_are_counted_and_release_slot():
+    ex = app.BoundedExecutor("t", workers=1, max_queue=0, submit_timeout=1)
+    fut = ex.submit(lambda: 1 / 0)
+    assert isinstance(fut.exception(timeout=1), ZeroDivisionError)
+    assert ex.submit(lambda: "ok").result(timeout=1) == "ok"
+    assert ex.stats()["failed"] == 1 and ex.stats()["ran_inline"] == 0
+    ex.drain(1)
+
+
+def test_try_submit_rejects_instead_of_running_inline():
+    ex = app.BoundedExecutor("t", workers=1, max_queue=0, submit_timeout=5)
+    gate = threading.Event()
+    ex.submit(gate.wait)
+
+    t0 = time.perf_counter()
+    assert ex.try_submit(lambda: None) is None
+    assert time.perf_counter() - t0 < 0.5  # no espera el submit_timeout
+    assert ex.stats()["rejected"] == 1 and ex.stats()["ran_inline"] == 0
+    gate.set(); ex.drain(1)
+    assert ex.try_submit(lambda: None) is None  # tancat
+
+
+def test_create_report_returns_503_when_cpu_pool_full(client, monkeypatch):
+    from test_report_jobs import start_case
+    sid, names = start_case(client, n=1)
+    monkeypatch.setattr(app.BG_CPU, "try_submit", lambda *a: None)
+
+    r = client.post("/create_report", data={"sid": sid})
+    assert r.status_code == 503 and r.headers["Retry-After"] == str(app.BG_RETRY_AFTER)
+    assert not app.REPORT_JOBS_OWNED & {p.stem for p in app.REPORT_JOBS_DIR.glob("*.json")}
+
+
+def test_caption_runs_use_ai_pool_not_cpu_pool(client, monkeypatch):
+    from test_report_jobs import start_case
+    sid, names = start_case(client, n=1)
+    used = []
+    monkeypatch.setattr(app.BG_CPU, "try_submit", lambda *a: used.append("cpu"))
+    monkeypatch.setattr(app.BG_CPU, "submit", lambda *a: used.append("cpu"))
+    monkeypatch.setattr(app.BG_AI, "try_submit", lambda task, *a: used.append("ai") or object())
+
+    r = client.post("/generate_api", data={"sid": sid, "evolucio": "x", "order": ",".join(names)})
+    assert r.status_code == 200 and used == ["ai"]
+
+    monkeypatch.setattr(app.BG_AI, "try_submit", lambda *a: None)
+    r = client.post("/generate_api", data={"sid": sid, "evolucio": "x", "order": ",".join(names)})
+    assert r.status_code == 503
@@ -0,0 +1,136 @@
+import io
+
+import pytest
+from PIL import Image, ImageCms
+
+import app
+
+
+def big_jpeg(w=4000, h=3000):
+    buf = io.BytesIO()
+    Image.new("RGB", (w, h), (10, 200, 30)).save(buf, format="JPEG")
+    buf.seek(0)
+    return buf
+
+
+def test_ingest_writes_every_rendition_from_one_decode(client, monkeypatch):
+    decoded = []
+    real_resize = app.resize_to_box
+    monkeypatch.setattr(app, "resize_to_box", lambda img, *a, **k: decoded.append(img.size) or real_resize(img, *a, **k))
+
+    paths, _, meta = app.ingest_upload(big_jpeg(), "foto_1")
+
+    assert {k: Image.open(p).size for k, p in paths.items()} == {
+        "master": (1440, 1080), "work": (1024, 768), "thumb": (320, 240)}
+    # Draft: el descodificador ja entrega 2000x1500 (escala 1/2), no 4000x3000
+    assert decoded == [(2000, 1500), (1440, 1080), (1024, 768)]
+    assert meta == {"w": 1440, "h": 1080, "orientation": "landscape", "exif_rotation": 1, "source": "master",
+                    "bytes": paths["master"].stat().st_size, "hash": app.file_content_hash(paths["master"])}
+
+
+def test_thumb_revalidates_and_changes_after_edit(client):
+    r = client.post("/upload", data={"photos": (big_jpeg(800, 600), "a.jpg")}, content_type="multipart/form-data")
+    name = r.get_json()["filename"]
+
+    first = client.get(f"/thumb/{name}")
+    assert first.status_code == 200 and first.headers["Cache-Control"] == "private, no-cache"
+    etag = first.headers["ETag"]
+    assert client.get(f"/thumb/{name}", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post(f"/save_edit/{name}", data={"file": (big_jpeg(600, 600), name)}, content_type="multipart/form-data")
+    edited = client.get(f"/thumb/{name}", headers={"If-None-Match": etag})
+    assert edited.status_code == 200 and Image.open(io.BytesIO(edited.data)).size == (240, 240)
+
+
+def test_upload_and_edit_keep_the_metadata_index_current(client):
+    exif = Image.Exif(); exif[app.EXIF_ORIENTATION_TAG] = 6
+    buf = io.BytesIO(); Image.new("RGB", (800, 600)).save(buf, format="JPEG", exif=exif); buf.seek(0)
+    sid = client.post("/start_session", data={"nat": "1/2026"}).get_json()["sid"]
+    name = client.post(f"/upload?sid={sid}", data={"photos": (buf, "a.jpg")},
+                       content_type="multipart/form-data").get_json()["filename"]
+
+    meta = app.load_gcs_session(sid)["image_meta"][name]
+    assert (meta["w"], meta["h"], meta["orientation"], meta["exif_rotation"]) == (600, 800, "portrait", 6)  # ja dreta
+
+    client.post(f"/save_edit/{name}", data={"file": (big_jpeg(600, 900), name)}, content_type="multipart/form-data")
+    meta = app.load_gcs_session(sid)["image_meta"][name]
+    assert (meta["w"], meta["h"], meta["orientation"], meta["source"]) == (600, 900, "portrait", "edited")
+    assert meta["hash"] == app.file_content_hash(app.EDITED_DIR / name)
+
+    client.post(f"/delete/{name}")
+    assert name not in app.load_gcs_session(sid)["image_meta"]
+
+
+# Operació que desfà la de EXIF_TRANSPOSE: la resta són involutives
+UNDO = {6: Image.Transpose.ROTATE_90, 8: Image.Transpose.ROTATE_270}
+
+
+def oriented_jpeg(orientation, icc=None, w=1600, h=1200):
+    """Foto 'dreta' amb el quadrant superior esquerre vermell, desada girada com la deixaria el mòbil."""
+    upright = Image.new("RGB", (w, h), (0, 0, 255))
+    upright.paste((255, 0, 0), (0, 0, w // 2, h // 2))
+    undo = UNDO.get(orientation, app.EXIF_TRANSPOSE.get(orientation))
+    raw = upright.transpose(undo) if undo is not None else upright
+    exif = Image.Exif(); exif[app.EXIF_ORIENTATION_TAG] = orientation
+    exif[0x010F] = "Phone"; exif.get_ifd(0x8825)[1] = "N"
+    buf = io.BytesIO()
+    raw.save(buf, format="JPEG", quality=95, exif=exif, **({"icc_profile": icc} if icc else {}))
+    buf.seek(0)
+    return buf
+
+
+@pytest.mark.parametrize("orientation", [1, 2, 3, 4, 5, 6, 7, 8])
+def test_ingest_rights_every_exif_orientation(client, orientation):
+    paths, _, meta = app.ingest_upload(oriented_jpeg(orientation), f"o{orientation}")
+
+    for kind, p in paths.items():
+        with Image.open(p) as im:
+            assert im.width > im.height, kind
+            assert im.getpixel((im.width // 8, im.height // 8))[0] > 200, kind  # vermell a dalt a l'esquerra
+            assert app.EXIF_ORIENTATION_TAG not in im.getexif() and "icc_profile" not in im.info
+    assert meta["exif_rotation"] == orientation and meta["orientation"] == "landscape"
+
+
+def test_ingest_converts_wide_gamut_to_srgb_and_can_keep_exif(client, monkeypatch):
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    monkeypatch.setattr(ImageCms, "getProfileDescription", lambda profile: "Display P3")  # perfil ample de mòbil
+    monkeypatch.setattr(app, "UPLOAD_EXIF", "keep")
+    converted = []
+    real = ImageCms.profileToProfile
+    monkeypatch.setattr(ImageCms, "profileToProfile", lambda im, *a, **k: converted.append(im.size) or real(im, *a, **k))
+
+    paths, _, _ = app.ingest_upload(oriented_jpeg(6, icc=icc), "p3")
+
+    assert converted == [(1440, 1080)]  # un sol cop, ja dreta i a mida de master
+    with Image.open(paths["master"]) as im:
+        assert "icc_profile" not in im.info
+        exif = im.getexif()
+        assert exif[app.EXIF_ORIENTATION_TAG] == 1 and exif[0x010F] == "Phone" and exif.get_ifd(0x8825)[1] == "N"
+    with Image.open(paths["work"]) as im:
+        assert not im.getexif()  # l'EXIF només es conserva a la master
+
+
+def test_thumb_freshness_comes_from_the_index_not_gcs(client, monkeypatch, tmp_path):
+    from fake_gcs import FakeBucket
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    sid = client.post("/start_session", data={"nat": "1/2026"}).get_json()["sid"]
+    name = client.post(f"/upload?sid={sid}", data={"photos": (big_jpeg(800, 600), "a.jpg")},
+                       content_type="multipart/form-data").get_json()["filename"]
+    app.BG_IO.submit(lambda: None).result(timeout=5)
+    bucket.calls.clear()
+
+    for _ in range(20): assert client.get(f"/thumb/{name}").status_code == 200
+    assert not [c for c in bucket.calls if c[0] == "download"]  # cap sondeig de uploads/edited
+
+    # Una altra instància edita la foto: puja la miniatura nova i després indexa l'edició
+    other = tmp_path / "other.jpg"
+    Image.new("RGB", (120, 240)).save(other, format="JPEG")
+    bucket.blob(f"uploads/thumbs/{name}").upload_from_filename(str(other))
+    app.patch_gcs_session(app.SessionPatch().set_item("image_meta", name, {"w": 300, "h": 600, "source": "edited", "hash": "nou"}), sid)
+    bucket.calls.clear()
+
+    for _ in range(5): r = client.get(f"/thumb/{name}")
+    assert Image.open(io.BytesIO(r.data)).size == (120, 240)
+    assert [c for c in bucket.calls if c[0] == "download"] == [("download", f"uploads/thumbs/{name}")]
@@ -0,0 +1,209 @@
+import io
+import time
+import zipfile
+
+from docx import Document
+from PIL import Image
+
+import app
+
+
+def jpeg_bytes(w=800, h=600):
+    buf = io.BytesIO()
+    Image.new("RGB", (w, h), (90, 120, 150)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def start_case(client, n=3):
+    sid = client.post("/start_session", data={"nat": "123/2026", "dil": "9"}).get_json()["sid"]
+    names = []
+    for i in range(n):
+        r = client.post(f"/upload?sid={sid}", data={"photos": (io.BytesIO(jpeg_bytes()), f"foto{i}.jpg")},
+                        content_type="multipart/form-data")
+        names.append(r.get_json()["filename"])
+        time.sleep(0.002)  # noms únics (mil·lisegons)
+    client.post(f"/finalize_upload?sid={sid}", json={"files": names})
+    return sid, names
+
+
+def wait_job(client, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/report_status/{job_id}").get_json()
+        if job["status"] not in ("queued", "running"): return job
+        time.sleep(0.05)
+    raise AssertionError("report job did not finish")
+
+
+def test_report_job_roundtrip(client):
+    sid, names = start_case(client)
+    r = client.post("/create_report", data={"sid": sid, **{f"desc_{n}": "desc" for n in names}})
+    job_id = r.get_json()["job_id"]
+
+    assert wait_job(client, job_id)["status"] == "done"
+    dl = client.get(f"/report_download/{job_id}")
+    assert dl.status_code == 200
+    assert dl.headers["Content-Disposition"] == 'attachment; filename="Informe_123_2026.docx"'
+    assert dl.data[:2] == b"PK"
+
+
+def test_report_job_unknown_id(client):
+    assert client.get("/report_status/nope").status_code == 404
+    assert client.get("/report_download/nope").status_code == 404
+
+
+def test_upload_decodes_from_stream_without_tmp_file(client, monkeypatch):
+    saved = []
+    monkeypatch.setattr(app.Path, "unlink", lambda self, **k: saved.append(self))
+    sid, names = start_case(client, n=1)
+
+    assert not [p for p in app.WORK_DIR.iterdir() if p.name.endswith("_tmp")] and not saved
+    assert (app.WORK_DIR / names[0]).exists() and (app.MASTER_DIR / names[0]).exists()
+    assert client.get("/metrics").get_json()["uploads"]["last_peak_bytes"] > 800 * 600 * 3
+
+
+def test_report_shares_one_header_and_reads_logo_once(client, monkeypatch, tmp_path):
+    sid, names = start_case(client, n=5)
+    monkeypatch.setattr(app, "_logo_cache", None)
+    monkeypatch.setattr(app, "_report_template", None)
+    reads = []
+    real_read = app.Path.read_bytes
+    monkeypatch.setattr(app.Path, "read_bytes", lambda self: reads.append(self.name) or real_read(self))
+
+    app.build_report(sid, app.load_gcs_session(sid), {}, tmp_path / "a.docx")
+    app.build_report(sid, app.load_gcs_session(sid), {}, tmp_path / "b.docx")
+    parts = zipfile.ZipFile(tmp_path / "a.docx").namelist()
+    doc = Document(tmp_path / "a.docx")
+
+    assert reads.count("logo_definitive.jpg") == 1
+    assert sum(n.startswith("word/header") for n in parts) == 1
+    assert sum(n.startswith("word/footer") for n in parts) == 1
+    assert len(doc.sections) == 1 + 3 + 1  # portada, 3 pàgines de fotos, diligència
+    assert all(s.header.is_linked_to_previous for s in doc.sections[2:])
+    assert sum(n.startswith("word/media") for n in parts) == 1 + 5  # logo + fotos, sense la imatge de mostra
+
+
+def test_template_report_fills_photo_pages(client, tmp_path):
+    sid, names = start_case(client, n=3)
+    descs = {names[0]: "Vista frontal", names[2]: "x" * 700}
+
+    app.build_report(sid, app.load_gcs_session(sid), descs, tmp_path / "informe.docx")
+    doc = Document(tmp_path / "informe.docx")
+
+    texts = [p.text for t in doc.tables for p in t.cell(0, 0).paragraphs if p.text]
+    assert texts == ["Fotografia núm. 1: Vista frontal", "Fotografia núm. 2", "Fotografia núm. 3: " + "x" * 700]
+    assert doc.tables[2].cell(0, 0).paragraphs[-1].runs[1].font.size == app.Pt(8)
+    assert doc.sections[0].footer.paragraphs[0].runs[0].text == "NAT 123/2026 - ART MNORD - Dil. 9"
+    all_text = "\n".join(p.text for p in doc.paragraphs)
+    assert app.MARK_COVER not in all_text and app.MARK_CLOSING not in all_text and "Informe Fotogràfic" in all_text
+    ids = [d.get("id") for d in doc.element.body.iter(app.qn("wp:docPr"))]
+    assert len(ids) == len(set(ids)) == 4  # logo de portada + 3 fotos
+
+
+def test_report_photos_stream_from_disk_into_the_zip(client, monkeypatch, tmp_path):
+    sid, names = start_case(client, n=4)
+    def no_blob(self): raise AssertionError("photo loaded in memory")
+    monkeypatch.setattr(app.FileImagePart, "blob", property(no_blob))
+    out = tmp_path / "informes"; out.mkdir()
+
+    app.build_report(sid, app.load_gcs_session(sid), {}, out / "informe.docx")
+
+    zf = zipfile.ZipFile(out / "informe.docx")
+    photos = [i for i in zf.infolist() if i.filename.startswith("word/media/foto")]
+    assert len(photos) == 4 and all(i.compress_type == zipfile.ZIP_STORED for i in photos)
+    assert zf.testzip() is None
+    assert len(Document(out / "informe.docx").inline_shapes) == 1 + 4
+    assert [p.name for p in out.iterdir()] == ["informe.docx"]  # ni .part ni directori de treball
+
+
+def test_report_download_supports_range(client):
+    sid, names = start_case(client, n=1)
+    job_id = client.post("/create_report", data={"sid": sid}).get_json()["job_id"]
+    assert wait_job(client, job_id)["status"] == "done"
+    full = client.get(f"/report_download/{job_id}").data
+
+    part = client.get(f"/report_download/{job_id}", headers={"Range": "bytes=100-199"})
+
+    assert part.status_code == 206 and part.data == full[100:200]
+    assert part.headers["Content-Range"] == f"bytes 100-199/{len(full)}"
+
+
+def test_report_is_downloadable_before_the_gcs_backup_finishes(client, monkeypatch, tmp_path):
+    import threading
+    from fake_gcs import FakeBucket
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    release, uploaded = threading.Event(), threading.Event()
+    real_save = app.storage_save
+
+    def gated_save(local_path, rel, chunk_size=None):
+        if rel.startswith("reports/Informe_"): release.wait(5)
+        ok = real_save(local_path, rel, chunk_size=chunk_size)
+        if rel.startswith("reports/Informe_"): uploaded.set()
+        return ok
+    monkeypatch.setattr(app, "storage_save", gated_save)
+    monkeypatch.setattr(app, "build_report", lambda sid, sdata, descs, out: (out.write_bytes(b"PK" + b"x" * 4096), ("1_2026", {}))[1])
+    job = {"id": "abc", "sid": "s", "status": "queued", "created_at": time.time()}
+
+    app.run_report_job(job, {}, {})
+
+    assert job["status"] == "done" and job["backup"] == "pending"
+    assert client.get("/report_download/abc").data[:2] == b"PK"  # servit abans que acabi la còpia
+    release.set(); assert uploaded.wait(5)
+    deadline = time.time() + 5
+    while app.load_report_job("abc")["backup"] == "pending" and time.time() < deadline: time.sleep(0.02)
+    assert app.load_report_job("abc")["backup"] == "done"
+    assert bucket.chunk_sizes["reports/Informe_1_2026_abc.docx"] == app.REPORT_UPLOAD_CHUNK_BYTES
+    assert (tmp_path / "gcs" / "reports" / "Informe_1_2026_abc.docx").read_bytes()[:2] == b"PK"
+
+
+def test_job_status_from_another_instance_is_refreshed_until_settled(client, monkeypatch, tmp_path):
+    import json
+    from fake_gcs import FakeBucket
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    remote = tmp_path / "gcs" / "reports" / "jobs" / "j1.json"; remote.parent.mkdir(parents=True)
+
+    remote.write_text(json.dumps({"id": "j1", "status": "queued"}))
+    assert client.get("/report_status/j1").get_json()["status"] == "queued"  # primera consulta: en cua
+    remote.write_text(json.dumps({"id": "j1", "status": "done", "backup": "done"}))
+    assert client.get("/report_status/j1").get_json()["status"] == "done"
+
+    downloads = len([c for c in bucket.calls if c[0] == "download"])
+    assert client.get("/report_status/j1").get_json()["status"] == "done"
+    assert len([c for c in bucket.calls if c[0] == "download"]) == downloads  # acabada: ja no es rellegeix
+
+
+def test_own_job_is_not_overwritten_from_gcs(client, monkeypatch, tmp_path):
+    from fake_gcs import FakeBucket
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    monkeypatch.setattr(app, "REPORT_JOBS_OWNED", {"j2"})
+    app.save_report_job({"id": "j2", "status": "running"})
+    bucket.calls.clear()
+
+    assert app.load_report_job("j2")["status"] == "running" and not bucket.calls
+
+
+def test_report_larger_than_cache_budget_survives_and_stays_pinned_if_backup_fails(client, monkeypatch, tmp_path):
+    from fake_gcs import FakeBucket
+    cache = app.LocalObjectCache(max_bytes=1024)
+    monkeypatch.setattr(app, "LOCAL_CACHE", cache)
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: FakeBucket(tmp_path / "gcs"))
+    monkeypatch.setattr(app, "storage_save", lambda *a, **k: False)  # GCS caigut
+    monkeypatch.setattr(app, "build_report", lambda sid, sdata, descs, out: (out.write_bytes(b"PK" + b"x" * 4096), ("1_2026", {}))[1])
+    job = {"id": "big", "sid": "s", "status": "queued", "created_at": time.time()}
+
+    app.run_report_job(job, {}, {})
+    app.BG_IO.submit(lambda: None).result(timeout=5)
+    deadline = time.time() + 5
+    while app.load_report_job("big")["backup"] == "pending" and time.time() < deadline: time.sleep(0.02)
+
+    assert app.load_report_job("big")["backup"] == "error"
+    cache.evict()
+    assert (app.REPORTS_DIR / "big.docx").exists() and cache.stats()["pinned"] == 1
+    assert client.get("/report_download/big").data[:2] == b"PK"
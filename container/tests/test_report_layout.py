@@ -0,0 +1,106 @@
+import time
+import zipfile
+
+import pytest
+from docx import Document
+from PIL import Image
+
+import app
+
+LAND, PORT = (1920, 1080), (1080, 1440)
+
+
+def counts(layout):
+    return [[len(row) for row in page] for page in layout]
+
+
+def test_landscapes_stack_two_per_page_at_the_minimum_height():
+    layout = app.plan_report_layout([LAND] * 5, [""] * 5)
+
+    assert counts(layout) == [[1, 1], [1, 1], [1]]
+    assert [i for page in layout for row in page for i, _ in row] == [0, 1, 2, 3, 4]
+    assert all(size[1] <= app.REPORT_PHOTO_MAX_H_CM for row in layout[0] for _, size in row)
+    assert layout[2][0][0][1][0] == app.REPORT_PHOTO_W_CM  # sola a la pàgina: tot l'ample
+
+
+def test_portraits_pair_side_by_side_up_to_four_per_page():
+    layout = app.plan_report_layout([PORT] * 5 + [LAND], [""] * 6)
+
+    assert counts(layout) == [[2, 2], [1, 1]]
+    w, h = layout[0][0][0][1]
+    assert h <= app.REPORT_PHOTO_MAX_H_CM and w < app.REPORT_BODY_W_CM / 2
+
+
+def test_long_captions_keep_portraits_alone_and_shrink_the_page():
+    long = "x" * 1500
+    layout = app.plan_report_layout([PORT, PORT, LAND], [long, "", ""])
+
+    assert counts(layout)[0][0] == 1  # el peu no cap a mitja pàgina
+    for page in layout:
+        height = sum(max(s[1] for _, s in row) + max(app.caption_height_cm([long, "", ""][i], 16.5) for i, _ in row)
+                     for row in page)
+        assert height <= app.REPORT_BODY_H_CM
+
+
+def test_lone_portrait_gets_a_full_page():
+    (page,) = app.plan_report_layout([PORT], [""])
+    (_, (w, h)), = page[0]
+    assert h > 2 * app.REPORT_PHOTO_MAX_H_CM and w <= app.REPORT_PHOTO_W_CM
+
+
+def test_layout_reads_headers_only(tmp_path, monkeypatch):
+    paths = []
+    for i, size in enumerate([LAND, PORT, PORT]):
+        p = tmp_path / f"{i}.jpg"; Image.new("RGB", size).save(p, format="JPEG"); paths.append(p)
+    monkeypatch.setattr(Image.Image, "load", lambda self: pytest.fail("image decoded during layout"))
+
+    t0 = time.perf_counter()
+    sizes = [app.read_image_size(p) for p in paths]
+    layout = app.plan_report_layout(sizes, [""] * 3)
+
+    assert sizes == [LAND, PORT, PORT] and counts(layout) == [[1, 2]]
+    assert time.perf_counter() - t0 < 0.5
+
+
+def test_report_places_portrait_pairs_in_one_row_and_counts_pages(tmp_path):
+    paths = []
+    for i, size in enumerate([PORT, PORT, LAND, LAND, PORT]):
+        p = tmp_path / f"{i}.jpg"; Image.new("RGB", size, (i * 40, 0, 0)).save(p, format="JPEG"); paths.append(p)
+    names = [f"foto{i}.jpg" for i in range(5)]
+    sdata = {"nat": "1/2026", "dil": "9", "image_order": names, "jutjat": "Jutjat 1", "localitat": "Mataró"}
+
+    doc = app.assemble_report(sdata, names, paths, {})
+    out = tmp_path / "informe.docx"; app.save_docx_streaming(doc, out)
+    doc = Document(out)
+
+    assert [len(t.rows[0].cells) for t in doc.tables] == [2, 1, 1, 1]
+    assert len(doc.sections) == 1 + 2 + 1  # portada, [P P | L], [L | P] i la diligència
+    assert "un total de 4 pàgines" in "\n".join(p.text for p in doc.paragraphs)
+    assert [p.text for t in doc.tables for c in t.rows[0].cells for p in c.paragraphs if p.text] == \
+        [f"Fotografia núm. {i}" for i in range(1, 6)]
+    assert zipfile.ZipFile(out).testzip() is None
+
+
+def test_photo_sizes_come_from_the_index_when_the_hash_matches(tmp_path, monkeypatch):
+    paths = []
+    for i in range(2):
+        p = tmp_path / f"{i}.jpg"; Image.new("RGB", PORT).save(p, format="JPEG"); paths.append(p)
+    meta = {"a": {"w": 900, "h": 1200, "hash": "h-a"}, "b": {"w": 900, "h": 1200, "hash": "old"}}
+    probed = []
+    real_read = app.read_image_size
+    monkeypatch.setattr(app, "read_image_size", lambda p: probed.append(p.name) or real_read(p))
+
+    sizes = app.report_photo_sizes(["a", "b"], paths, meta, {"a": "h-a", "b": "h-b"})
+
+    assert sizes == [(900, 1200), PORT] and probed == ["1.jpg"]  # "b" s'ha editat des de la indexació
+
+
+def test_report_build_measures_no_photo_when_indexed(client, monkeypatch, tmp_path):
+    from test_report_jobs import start_case
+    sid, names = start_case(client, n=3)
+    assert set(app.load_gcs_session(sid)["image_meta"]) == set(names)
+    monkeypatch.setattr(app, "read_image_size", lambda p: pytest.fail(f"{p} measured during the report"))
+
+    app.build_report(sid, app.load_gcs_session(sid), {}, tmp_path / "informe.docx")
+
+    assert len(Document(tmp_path / "informe.docx").inline_shapes) == 1 + 3
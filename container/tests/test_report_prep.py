@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from PIL import Image
+
+import app
+
+
+def make_sources(tmp_path, names):
+    paths = {}
+    for i, name in enumerate(names):
+        p = tmp_path / name
+        Image.new("RGB", (400 + i * 10, 300), (i * 40, 0, 0)).save(p, format="JPEG")
+        paths[name] = p
+    return paths
+
+
+def test_order_preserved_and_missing_dropped(tmp_path, monkeypatch):
+    names = ["a.jpg", "b.jpg", "missing.jpg", "c.jpg"]
+    paths = make_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    monkeypatch.setattr(app, "fetch_photo_sources", lambda names, timeout=None, pin=False: paths)
+
+    valid, outs, stats = app.prepare_report_images(names, 200, 200, False, 80, tmp_path / "out", workers=3, timeout=10)
+
+    assert valid == ["a.jpg", "b.jpg", "c.jpg"]
+    widths = [Image.open(b).size[0] for b in outs]
+    assert widths == sorted(widths)  # cada font és més ampla que l'anterior
+    assert stats["images"] == 4 and stats["timed_out"] == 0
+
+
+def test_hung_image_dropped_after_timeout(tmp_path, monkeypatch):
+    paths = make_sources(tmp_path, ["a.jpg", "b.jpg"])
+
+    paths["hang.jpg"] = tmp_path / "hang.jpg"
+    real_hash = app.file_content_hash
+
+    def slow_hash(path):
+        if path.name == "hang.jpg": time.sleep(2); raise FileNotFoundError(path)  # no ha de tocar res real
+        return real_hash(path)
+    monkeypatch.setattr(app, "fetch_photo_sources", lambda names, timeout=None, pin=False: paths)
+    monkeypatch.setattr(app, "file_content_hash", slow_hash)
+
+    t0 = time.perf_counter()
+    valid, outs, stats = app.prepare_report_images(["a.jpg", "hang.jpg", "b.jpg"], 200, 200, False, 80, tmp_path / "out", workers=2, timeout=0.3)
+
+    assert time.perf_counter() - t0 < 1.5
+    assert valid == ["a.jpg", "b.jpg"] and len(outs) == 2
+    assert stats["timed_out"] == 1 and stats["serial_s"] >= 0.3
+
+
+def test_regenerate_hits_rendition_cache(tmp_path, monkeypatch, isolated_cache):
+    paths = make_sources(tmp_path, ["a.jpg", "b.jpg"])
+    monkeypatch.setattr(app, "fetch_photo_sources", lambda names, timeout=None, pin=False: paths)
+
+    app.prepare_report_images(["a.jpg", "b.jpg"], 200, 200, False, 80, tmp_path / "out1")
+    monkeypatch.setattr(app, "resize_to_box", lambda *a, **k: pytest.fail("Pillow work on a cache hit"))
+    valid, paths2, _ = app.prepare_report_images(["a.jpg", "b.jpg"], 200, 200, False, 80, tmp_path / "out2")
+
+    assert valid == ["a.jpg", "b.jpg"]
+    assert isolated_cache.stats() == {'hits': 2, 'misses': 2, 'evictions': 0}
+    assert all(p.stat().st_nlink == 3 for p in paths2)  # out1, memòria cau i out2: el mateix inode
+
+
+def test_rendition_cache_evicts_least_recent(tmp_path):
+    cache = app.RenditionCache(tmp_path, max_bytes=250)
+    cache.put("old", b"x" * 100); time.sleep(0.01)
+    cache.put("mid", b"x" * 100); time.sleep(0.01)
+    cache.get("old"); time.sleep(0.01)
+    cache.put("new", b"x" * 100)
+
+    assert cache.get("mid") is None
+    assert cache.get("old") and cache.get("new")
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,178 @@
+import json
+import uuid
+
+import app
+from fake_gcs import FakeBucket
+
+
+def test_writes_coalesce_and_reads_stay_in_memory(client, monkeypatch, tmp_path):
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    store = app.SessionStore()
+    sid = str(uuid.uuid4())
+
+    for i in range(5):
+        store.put(sid, {"status_message": f"pas {i}"})
+        assert store.get(sid)["status_message"] == f"pas {i}"
+    store.flush()
+
+    assert len(bucket.ops("upload")) == 1 and not bucket.ops("download")
+    assert json.loads((bucket.root / f"sessions/{sid}.json").read_text()) == {"status_message": "pas 4"}
+    assert store.stats()["dirty"] == 0
+
+
+def test_stale_entry_revalidates_by_generation(client, monkeypatch, tmp_path):
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    monkeypatch.setattr(app, "SESSION_CACHE_TTL", 0)
+    store = app.SessionStore()
+    sid = str(uuid.uuid4())
+    store.put(sid, {"n": 1}); store.flush()
+
+    assert store.get(sid) == {"n": 1} and not bucket.ops("download")  # generació igual: sense baixada
+    bucket.blob(f"sessions/{sid}.json").upload_from_string(json.dumps({"n": 2}))  # una altra instància
+    assert store.get(sid) == {"n": 2} and len(bucket.ops("download")) == 1
+
+
+def test_returned_sessions_are_copies(client):
+    sid = str(uuid.uuid4())
+    app.save_gcs_session({"image_order": ["a.jpg"]}, sid)
+    app.load_gcs_session(sid)["image_order"].append("b.jpg")
+    assert app.load_gcs_session(sid) == {"image_order": ["a.jpg"]}
+
+
+def test_concurrent_instances_merge_patches_on_generation_conflict(client, monkeypatch, tmp_path):
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    a, b = app.SessionStore(), app.SessionStore()  # dues instàncies de Cloud Run
+    sid = str(uuid.uuid4())
+    a.put(sid, {"image_order": ["x.jpg"], "status_message": "inici"}); a.flush()
+    b.get(sid)
+
+    a.patch(sid, app.SessionPatch().append_unique("image_order", ["a.jpg"]))
+    b.patch(sid, app.SessionPatch().append_unique("image_order", ["b.jpg"]).set("status_message", "[READY]"))
+    b.flush()
+    a.flush()  # la generació ha canviat: es reaplica el pedaç sobre la versió de b
+
+    remote = json.loads((bucket.root / f"sessions/{sid}.json").read_text())
+    assert remote == {"image_order": ["x.jpg", "b.jpg", "a.jpg"], "status_message": "[READY]"}
+    assert a.stats()["conflicts"] == 1 and a.stats()["dirty"] == 0
+    assert a.get(sid) == remote
+
+
+def test_parallel_patches_in_one_process_are_not_lost(client):
+    import threading
+    sid = str(uuid.uuid4())
+    app.save_gcs_session({"upload_keys": {}}, sid)
+    threads = [threading.Thread(target=app.patch_gcs_session,
+                                args=(app.SessionPatch().set_item("upload_keys", f"k{i}", f"f{i}.jpg"), sid))
+               for i in range(20)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(app.load_gcs_session(sid)["upload_keys"]) == 20
+
+
+def test_firestore_backend_sends_field_level_updates(client, monkeypatch):
+    from fake_firestore import FakeFirestore
+    fs = FakeFirestore()
+    monkeypatch.setattr(app, "IS_PROD", True)
+    a = app.SessionStore(app.FirestoreSessionBackend(fs))
+    b = app.SessionStore(app.FirestoreSessionBackend(fs))
+    sid = str(uuid.uuid4())
+    a.put(sid, {"image_order": ["x.jpg"], "image_descriptions": {}, "status_message": "inici"}); a.flush()
+    b.get(sid)
+
+    a.patch(sid, app.SessionPatch().append_unique("image_order", ["a.jpg"]).set_item("image_descriptions", "a.jpg", "Vista"))
+    b.patch(sid, app.SessionPatch().append_unique("image_order", ["b.jpg"]).set("status_message", "[READY]"))
+    a.flush(); b.flush()
+
+    doc = fs.docs[f"sessions/{sid}"][0]
+    assert doc == {"image_order": ["x.jpg", "a.jpg", "b.jpg"], "image_descriptions": {"a.jpg": "Vista"},
+                   "status_message": "[READY]"}
+    assert fs.ops("update")[-1][1] == {"image_order": ["b.jpg"], "status_message": "[READY]"}
+    assert a.stats()["backend"] == "firestore" and a.stats()["conflicts"] == b.stats()["conflicts"] == 0
+
+
+def test_firestore_store_sees_fields_merged_by_other_writer(client, monkeypatch):
+    from fake_firestore import FakeFirestore
+    fs = FakeFirestore()
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "SESSION_CACHE_TTL", 0)
+    a = app.SessionStore(app.FirestoreSessionBackend(fs))
+    b = app.SessionStore(app.FirestoreSessionBackend(fs))
+    sid = str(uuid.uuid4())
+    a.put(sid, {"image_order": ["x.jpg"]}); a.flush()
+    b.get(sid)
+
+    a.patch(sid, app.SessionPatch().append_unique("image_order", ["a.jpg"]))
+    b.patch(sid, app.SessionPatch().append_unique("image_order", ["b.jpg"])); b.flush()
+    a.flush()
+
+    # La versió que guarda a és la del document fusionat, no la de les seves dades d'abans
+    assert a.get(sid)["image_order"] == b.get(sid)["image_order"] == ["x.jpg", "b.jpg", "a.jpg"]
+
+
+def test_firestore_full_replacement_is_conditional(client, monkeypatch):
+    from fake_firestore import FakeFirestore
+    fs = FakeFirestore()
+    monkeypatch.setattr(app, "IS_PROD", True)
+    a = app.SessionStore(app.FirestoreSessionBackend(fs))
+    b = app.SessionStore(app.FirestoreSessionBackend(fs))
+    sid = str(uuid.uuid4())
+    a.put(sid, {"image_order": ["x.jpg"], "old": 1}); a.flush()
+    b.get(sid)
+
+    b.patch(sid, app.SessionPatch().append_unique("image_order", ["b.jpg"])); b.flush()
+    # Mutació arbitrària (no SessionPatch) sobre una versió ja superada: conflicte i es reaplica
+    a.mutate(sid, lambda d: (d.pop("old", None), d.setdefault("image_order", []).append("a.jpg")))
+    a.flush()
+
+    assert fs.docs[f"sessions/{sid}"][0] == {"image_order": ["x.jpg", "b.jpg", "a.jpg"]}
+    assert a.stats()["conflicts"] == 1 and a.stats()["dirty"] == 0
+
+
+def test_unavailable_firestore_falls_back_to_gcs(monkeypatch):
+    monkeypatch.setattr(app, "db", None)
+    assert app.make_session_backend("firestore").name == "gcs"
+
+
+def test_failed_flush_is_retried_without_new_writes(client, monkeypatch, tmp_path):
+    import time
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    monkeypatch.setattr(app, "SESSION_FLUSH_INTERVAL", 0.01)
+    store = app.SessionStore()
+    sid = str(uuid.uuid4())
+    real_upload = app.GCSSessionBackend.write
+    failures = [1]
+
+    def flaky(self, *a, **k):
+        if failures: failures.pop(); raise OSError("GCS no disponible")
+        return real_upload(self, *a, **k)
+    monkeypatch.setattr(app.GCSSessionBackend, "write", flaky)
+
+    store.put(sid, {"n": 1})  # cap altra escriptura després de la fallada
+    deadline = time.time() + 3
+    while store.stats()["dirty"] and time.time() < deadline: time.sleep(0.02)
+
+    assert store.stats()["dirty"] == 0 and not failures
+    assert json.loads((bucket.root / f"sessions/{sid}.json").read_text()) == {"n": 1}
+
+
+def test_sigterm_drain_flushes_sessions(client, monkeypatch, tmp_path):
+    bucket = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "get_bucket", lambda: bucket)
+    monkeypatch.setattr(app, "SESSION_FLUSH_INTERVAL", 60)
+    monkeypatch.setattr(app, "SESSION_STORE", app.SessionStore())
+    monkeypatch.setattr(app, "BG_EXECUTORS", ())
+    sid = str(uuid.uuid4())
+    app.SESSION_STORE.put(sid, {"n": 7})
+
+    app.drain_background(1)
+
+    assert json.loads((bucket.root / f"sessions/{sid}.json").read_text()) == {"n": 7}
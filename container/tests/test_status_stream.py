@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    fresh = app.StatusBus()
+    monkeypatch.setattr(app, "STATUS_BUS", fresh)
+    return fresh
+
+
+def events(body):
+    out = []
+    for block in body.decode().split("\n\n"):
+        lines = block.strip().splitlines()
+        if not lines or lines[0].startswith(":"): continue
+        kind = lines[0][7:] if lines[0].startswith("event: ") else "message"
+        data = json.loads("".join(l[6:] for l in lines if l.startswith("data: ")))
+        out.append((kind, data.get("status", data.get("reason"))))
+    return out
+
+
+def test_stream_pushes_progress_until_ready(client, bus, monkeypatch):
+    monkeypatch.setattr(app, "STATUS_STREAM_KEEPALIVE", 0.05)
+    sid = "s1"
+    app.update_status("Processant imatges (1/2)...", sid)
+
+    def worker():
+        time.sleep(0.1); app.update_status("Processant imatges (2/2)...", sid)
+        time.sleep(0.1); app.set_status("[READY]", sid)
+    threading.Thread(target=worker).start()
+
+    resp = client.get(f"/status_stream?sid={sid}")
+    assert resp.mimetype == "text/event-stream"
+    assert events(resp.get_data()) == [("message", "Processant imatges (1/2)..."),
+                                       ("message", "Processant imatges (2/2)..."), ("message", "[READY]")]
+    assert client.get(f"/status?sid={sid}").get_json() == {"status": "[READY]"}
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_unknown_sid_falls_back_to_polling(client, bus):
+    app.save_gcs_session({"status_message": "Iniciant tasca de fons..."}, "other")
+
+    resp = client.get("/status_stream?sid=other")
+
+    assert events(resp.get_data()) == [("message", "Iniciant tasca de fons..."), ("fallback", "instance")]
+
+
+def test_stale_ready_from_previous_run_is_ignored(client, bus):
+    sid = "s2"
+    app.set_status("[READY]", sid, run="old")
+    # La nova execució s'ha iniciat en una altra instància: aquí només n'arriba el run id
+    app.save_gcs_session({"status_message": "Processant imatges (1/3)...", "status_run": "new"}, sid)
+
+    assert client.get(f"/status?sid={sid}&run=new").get_json() == {"status": "Processant imatges (1/3)..."}
+    assert client.get(f"/status?sid={sid}").get_json() == {"status": "Processant imatges (1/3)..."}
+    assert events(client.get(f"/status_stream?sid={sid}&run=new").get_data()) == [
+        ("message", "Processant imatges (1/3)..."), ("fallback", "instance")]
+
+
+def test_progress_inherits_run_and_generate_api_returns_it(client, bus, monkeypatch):
+    from test_report_jobs import start_case
+    sid, names = start_case(client, n=1)
+    monkeypatch.setattr(app.BG_AI, "try_submit", lambda *a: object())
+
+    run = client.post("/generate_api", data={"sid": sid, "order": names[0]}).get_json()["run"]
+    app.update_status("Processant imatges (1/1)...", sid)
+
+    assert bus.latest(sid)["run"] == run and app.load_gcs_session(sid)["status_run"] == run
+    assert client.get(f"/status?sid={sid}&run={run}").get_json() == {"status": "Processant imatges (1/1)..."}
+    assert client.get(f"/status?sid={sid}&run=other").get_json() == {"status": "Processant..."}
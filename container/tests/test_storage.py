@@ -0,0 +1,104 @@
+import pytest
+
+import app
+from fake_gcs import FakeBucket
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    fake = FakeBucket(tmp_path / "gcs")
+    monkeypatch.setattr(app, "IS_PROD", True)
+    monkeypatch.setattr(app, "_bucket", fake)
+    monkeypatch.setattr(app, "STORAGE_METRICS", dict.fromkeys(app.STORAGE_METRICS, 0))
+    return fake
+
+
+def test_download_goes_direct_and_counts_misses(tmp_path, bucket):
+    src = tmp_path / "a.jpg"; src.write_bytes(b"12345")
+
+    app.storage_save(src, "uploads/work/a.jpg")
+    assert app.storage_download("uploads/work/a.jpg", tmp_path / "b.jpg")
+    assert not app.storage_download("uploads/work/missing.jpg", tmp_path / "c.jpg")
+
+    assert not bucket.ops("exists")
+    stats = app.storage_stats()
+    assert (stats["requests"], stats["misses"], stats["errors"]) == (3, 1, 0)
+    assert stats["bytes_up"] == stats["bytes_down"] == 5
+    assert sorted(p.name for p in tmp_path.glob("*.jpg*")) == ["a.jpg", "b.jpg"]  # cap .part ni fitxer buit
+    assert app.get_bucket() is bucket
+
+
+def test_fetch_many_picks_best_variant_and_downloads_only_winners(client, bucket):
+    bucket.put("uploads/edited/a.jpg", b"edited-a")
+    bucket.put("uploads/master/a.jpg", b"master-a")
+    bucket.put("uploads/work/b.jpg", b"work-b")
+    (app.MASTER_DIR / "c.jpg").write_bytes(b"local-master-c")
+    bucket.put("uploads/edited/c.jpg", b"edited-c")
+    (app.EDITED_DIR / "d.jpg").write_bytes(b"local-edited-d")
+
+    found = app.fetch_photo_sources(["a.jpg", "b.jpg", "c.jpg", "d.jpg", "zz.jpg"])
+
+    assert {n: p.read_bytes() for n, p in found.items()} == {
+        "a.jpg": b"edited-a", "b.jpg": b"work-b", "c.jpg": b"edited-c", "d.jpg": b"local-edited-d"}
+    assert sorted(bucket.ops("download")) == ["uploads/edited/a.jpg", "uploads/edited/c.jpg", "uploads/work/b.jpg"]
+    # d.jpg ja és editada en local: cap consulta; c.jpg no mira més enllà de la master local
+    assert not [n for n in bucket.ops("stat") if "d.jpg" in n]
+    assert "uploads/work/c.jpg" not in bucket.ops("stat")
+
+
+def test_local_cache_evicts_lru_but_keeps_pinned(client, bucket, monkeypatch):
+    cache = app.LocalObjectCache(max_bytes=250)
+    monkeypatch.setattr(app, "LOCAL_CACHE", cache)
+    for name in ("old.jpg", "pinned.jpg", "mid.jpg", "new.jpg"):
+        bucket.put(f"uploads/work/{name}", b"x" * 100)
+    found = app.fetch_photo_sources(["pinned.jpg"], pin=True)
+    app.storage_download("uploads/work/old.jpg", app.WORK_DIR / "old.jpg")
+    app.storage_download("uploads/work/mid.jpg", app.WORK_DIR / "mid.jpg")
+
+    assert sorted(p.name for p in app.WORK_DIR.iterdir()) == ["mid.jpg", "pinned.jpg"]
+    cache.unpin(found.values())
+    app.storage_download("uploads/work/new.jpg", app.WORK_DIR / "new.jpg")  # ara pinned és la més antiga i ja es pot expulsar
+    assert sorted(p.name for p in app.WORK_DIR.iterdir()) == ["mid.jpg", "new.jpg"]
+    assert cache.stats()["evictions"] == 2
+
+
+def test_local_cache_never_evicts_in_local_mode(client, monkeypatch):
+    cache = app.LocalObjectCache(max_bytes=10)
+    monkeypatch.setattr(app, "LOCAL_CACHE", cache)
+    for name in ("a.jpg", "b.jpg"):
+        (app.WORK_DIR / name).write_bytes(b"x" * 100)
+        cache.admit(app.WORK_DIR / name, miss=False)
+
+    assert sorted(p.name for p in app.WORK_DIR.iterdir()) == ["a.jpg", "b.jpg"]
+    assert cache.stats()["evictions"] == 0
+
+
+def test_files_that_failed_to_upload_are_never_evicted(client, bucket, monkeypatch):
+    import io
+    from PIL import Image
+    cache = app.LocalObjectCache(max_bytes=1)
+    monkeypatch.setattr(app, "LOCAL_CACHE", cache)
+    monkeypatch.setattr(app, "storage_save", lambda *a, **k: False)  # GCS caigut
+    buf = io.BytesIO(); Image.new("RGB", (400, 300)).save(buf, format="JPEG"); buf.seek(0)
+
+    name = client.post("/upload", data={"photos": (buf, "a.jpg")}, content_type="multipart/form-data").get_json()["filename"]
+    app.BG_IO.submit(lambda: None).result(timeout=5)
+    edit = io.BytesIO(); Image.new("RGB", (300, 300)).save(edit, format="JPEG"); edit.seek(0)
+    client.post(f"/save_edit/{name}", data={"file": (edit, name)}, content_type="multipart/form-data")
+    cache.evict()
+
+    for d in (app.WORK_DIR, app.MASTER_DIR, app.THUMBS_DIR, app.EDITED_DIR):
+        assert (d / name).exists(), d  # única còpia: fixada malgrat el pressupost
+    assert cache.stats()["pinned"] == 4
+
+
+def test_deleted_photos_stop_counting(client, bucket, monkeypatch):
+    cache = app.LocalObjectCache(max_bytes=10 ** 6)
+    monkeypatch.setattr(app, "LOCAL_CACHE", cache)
+    for d in (app.WORK_DIR, app.MASTER_DIR):
+        (d / "a.jpg").write_bytes(b"x" * 100); cache.admit(d / "a.jpg", miss=False)
+    cache.pin([app.MASTER_DIR / "a.jpg"])
+
+    client.post("/delete/a.jpg")
+
+    assert cache.stats()["bytes"] == 0 and cache.stats()["pinned"] == 0
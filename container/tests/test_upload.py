@@ -0,0 +1,50 @@
+import io
+import threading
+
+from PIL import Image
+
+import app
+
+
+def jpeg_bytes(color=(10, 120, 200)):
+    buf = io.BytesIO()
+    Image.new("RGB", (800, 600), color).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def post_photo(client, sid, name, key):
+    return client.post(f"/upload?sid={sid}", data={"key": key, "photos": (io.BytesIO(jpeg_bytes()), name)},
+                       content_type="multipart/form-data")
+
+
+def test_retry_with_same_key_is_not_processed_twice(client, monkeypatch):
+    sid = client.post("/start_session", data={"nat": "1/2026"}).get_json()["sid"]
+    calls = []
+    real_ingest = app.ingest_upload
+    monkeypatch.setattr(app, "ingest_upload", lambda stream, base: calls.append(base) or real_ingest(stream, base))
+
+    first = post_photo(client, sid, "foto.jpg", f"{sid}:0:foto.jpg").get_json()
+    retry = post_photo(client, sid, "foto.jpg", f"{sid}:0:foto.jpg").get_json()
+    other = post_photo(client, sid, "foto.jpg", f"{sid}:1:foto.jpg").get_json()
+
+    assert retry == dict(first, duplicate=True)
+    assert other["filename"] != first["filename"] and len(calls) == 2
+    assert sorted(p.name for p in app.WORK_DIR.iterdir()) == sorted([first["filename"], other["filename"]])
+
+
+def test_finalize_merges_in_client_order_without_lost_updates(client):
+    sid = client.post("/start_session", data={"nat": "1/2026"}).get_json()["sid"]
+    batches = [[f"b{b}_{i}.jpg" for i in range(5)] for b in range(8)]
+
+    threads = [threading.Thread(target=app.patch_gcs_session, args=(app.upload_manifest_patch(files), sid))
+               for files in batches]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    client.post(f"/finalize_upload?sid={sid}", json={"files": batches[0]})  # reintent: no duplica
+
+    sdata = app.load_gcs_session(sid)
+    assert sorted(sdata["image_order"]) == sorted(f for files in batches for f in files)
+    assert len(sdata["latest_uploads"]) == 40
+    for files in batches:  # cada lot manté l'ordre del client
+        positions = [sdata["image_order"].index(f) for f in files]
+        assert positions == sorted(positions)